@@ -1,6 +1,8 @@
 import discord
 from discord.ext import commands
 import json
+from utils import admission, analyticssink, embeddingcache, executors, httphandler, jobscheduler, ltmarchiver, mongorepository, mutationqueue, responseindex, retrievalcache, services, vectorstore, webhookhandler
+from extensions.uiactions import ResponseControlButton
 
 class DisAI(commands.Bot):
     def __init__(self, app_id):
@@ -14,3 +16,34 @@ class DisAI(commands.Bot):
         self.platforms = {}
         self.COOKIES = json.loads(open("./cookies.json", encoding="utf-8").read())
         self.left_guilds = []
+        self.http_pool = services.register("http_pool", httphandler.HTTPPool()) # shared keep-alive session for OpenAI, YouTube, etc. (self.http is taken by discord.py)
+        self.webhook_registry = services.register("webhook_registry", webhookhandler.WebhookRegistry()) # channel id -> Dis.AI webhook
+        self.response_index = services.register("response_index", responseindex.ResponseIndex()) # reply message id -> (platform id, chatbot), for on_raw_reaction_add
+        self.admission = services.register("admission", admission.AdmissionController()) # per-server + global token buckets for chatbot replies
+        self.executors = services.register("executors", executors.ExecutorService()) # I/O and CPU pools for every blocking call
+        self.database = services.register("database", mongorepository.MongoRepository()) # MongoDB, in its own thread pool with per-operation timeouts
+        self.analytics_sink = services.register("analytics_sink", analyticssink.AnalyticsSink()) # analytics events -> their own collection, in batches
+        self.embedding_cache = services.register("embedding_cache", embeddingcache.EmbeddingCache()) # (model, sha256(text)) -> embedding, in memory + SQLite
+        self.vector_store = services.register("vector_store", vectorstore.make_store()) # Pinecone, local (memory-mapped NumPy) or tiered, from VECTOR_STORE
+        self.retrieval_cache = services.register("retrieval_cache", retrievalcache.RetrievalCache()) # (namespace, query embedding) -> top results, versioned per namespace
+        self.vector_queue = services.register("vector_queue", mutationqueue.MutationQueue()) # upserts + deletes, applied in the background. pending deletes survive restarts
+        self.jobs = services.register("jobs", jobscheduler.JobScheduler()) # PDF / video / lorebook ingestion. started in on_ready, once the platforms are loaded
+        self.ltm_archiver = services.register("ltm_archiver", ltmarchiver.LTMArchiver()) # evicted messages -> long term memory, batched off the reply path
+
+    async def setup_hook(self):
+        await self.http_pool.start()
+        await self.vector_queue.start()
+        await self.analytics_sink.start()
+        self.add_dynamic_items(ResponseControlButton) # regenerate/continue/delete buttons on replies, including ones sent before a restart
+
+    async def close(self):
+        await self.jobs.close() # before the pools go away, so running jobs can save their offset
+        await self.ltm_archiver.close()
+        await super().close()
+        await self.http_pool.close()
+        await self.vector_queue.close()
+        await self.analytics_sink.close() # spools through the I/O pool, so before it shuts down
+        await self.executors.shutdown()
+        self.embedding_cache.close()
+        self.vector_store.close()
+        await self.database.close() # last: the shutdown steps above may still save jobs
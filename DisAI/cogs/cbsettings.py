@@ -12,7 +12,7 @@ from extensions.constants import Analytics
 from extensions.embeds import get_credits_needed_embed
 import extensions.helpers as helpers
 from extensions.uiactions import CreateCBView, SettingsView
-from utils import dbhandler, messagehandler
+from utils import chatbotqueue, dbhandler, ltmarchiver, messagehandler
 from utils.messagehandler import handle_gpt_response
 from utils.pineconehandler import delete_namespace
 
@@ -40,7 +40,8 @@ def append_prompt_context(chatbot, name, scenario_str):
     chatbot.context.append({'role':'system', 'content':f"{chatbot.prompt}\nWrite one response as {name}.\n{scenario_str}"})
 
 async def handle_conversation_response(platform, chatbot, last_message, cost, interaction):
-    response_success = await messagehandler.handle_gpt_response(platform, chatbot, last_message, credits_cost=cost, converse_mode=True, should_make_buttons=False)
+    async with chatbotqueue.get_queue(chatbot).turn():
+        response_success = await messagehandler.handle_gpt_response(platform, chatbot, last_message, credits_cost=cost, converse_mode=True, should_make_buttons=False)
     if response_success:
         platform.credits -= cost
         await asyncio.sleep(4)
@@ -222,7 +223,7 @@ class ChatBotSettings(commands.Cog):
             platform = await helpers.get_platform(self.bot.platforms, interaction, Analytics.SHOWENABLEDHERE.value)
             if not await helpers.has_correct_perms(platform, interaction):
                 return
-            embed = discord.Embed(title="List of chatbots enabled in current channel", description="\n".join([chatbot.name for chatbot in platform.chatbots if interaction.channel.id in chatbot.channels]), colour=Colour.blue())
+            embed = discord.Embed(title="List of chatbots enabled in current channel", description="\n".join([chatbot.name for chatbot in platform.chatbots_in_channel(interaction.channel.id)]), colour=Colour.blue())
             await interaction.response.send_message(embed=embed, ephemeral=True, delete_after=TIMEOUT_TIME)
         except Exception as e:
             logger.error(e)
@@ -267,8 +268,8 @@ class ChatBotSettings(commands.Cog):
 
     async def add_chatbot_to_channel(self, interaction: discord.Interaction, platform, chatbot):
         """Adds the given chatbot to the channel of the given interaction."""
-        chatbot.channels.append(interaction.channel.id)
-        await dbhandler.change_cb_setting_in_db(platform.id, chatbot.name, "channels", chatbot.channels)
+        platform.enable_chatbot(chatbot, interaction.channel.id)
+        await dbhandler.change_cb_setting_in_db(platform.id, chatbot.name, "channels", list(chatbot.channels))
         embed = discord.Embed(title=f"{chatbot.name} has been added to this channel", description=f"{chatbot.name} will now respond to messages in this channel.\nJust start chatting! ✨\n\nUse `/disable {chatbot.name}` to disable.", colour=BLUE_COLOUR)
         await interaction.response.send_message(embed=embed, ephemeral=False, delete_after=TIMEOUT_TIME)
         await self.send_greeting(interaction, chatbot)
@@ -287,14 +288,7 @@ class ChatBotSettings(commands.Cog):
     async def send_message(self, interaction: discord.Interaction, chatbot, message):
         """Sends a message from the given chatbot."""
         if not isinstance(interaction.channel, discord.DMChannel):
-            channel = interaction.channel.parent if isinstance(interaction.channel, discord.Thread) else interaction.channel
-            webhooks = await channel.webhooks()
-            for webhook in webhooks:
-                if webhook.name == "Dis.AI Webhook":
-                    og_webhook = webhook
-                    break
-            else:
-                og_webhook = await channel.create_webhook(name="Dis.AI Webhook")
+            og_webhook = await self.bot.webhook_registry.get(interaction.channel) # resolves threads to their parent
             if og_webhook:
                 if isinstance(interaction.channel, discord.Thread):
                     await og_webhook.send(username=chatbot.name, wait=True, content=message, avatar_url=chatbot.avatar_url, thread=interaction.channel)
@@ -315,12 +309,9 @@ class ChatBotSettings(commands.Cog):
         if not chatbot:
             await helpers.send_error_message("Please make sure you have entered the name correctly\nUse /listchatbots to see all created chatbots.", interaction, True)
             return
-        try:
-            chatbot.channels.remove(interaction.channel.id)
-            chatbot.bing_bots.pop(interaction.channel.id)
-        except Exception as e:
-            logging.error(e)
-        await dbhandler.change_cb_setting_in_db(platform.id, chatbot.name, "channels", chatbot.channels)
+        platform.disable_chatbot(chatbot, interaction.channel.id)
+        chatbot.bing_bots.pop(interaction.channel.id, None)
+        await dbhandler.change_cb_setting_in_db(platform.id, chatbot.name, "channels", list(chatbot.channels))
         embed = discord.Embed(title=f"{chatbot.name} has been removed from the current channel", colour=BLUE_COLOUR)
         await interaction.response.send_message(embed=embed, ephemeral=False, delete_after=TIMEOUT_TIME)
         
@@ -339,6 +330,7 @@ class ChatBotSettings(commands.Cog):
             if number_of_messages_to_delete <= 0:
                 chatbot.context.clear()
                 try:
+                    ltmarchiver.get_archiver().discard(chatbot)
                     await delete_namespace(f"{platform.id}-{chatbot.name}") # also clear long term memory
                     await delete_namespace(f"{platform.id}-{chatbot.name}-data")
                 except Exception as e:
@@ -354,6 +346,7 @@ class ChatBotSettings(commands.Cog):
             context_length = len(chatbot.context)
             chatbot.context.clear()
             try:
+                ltmarchiver.get_archiver().discard(chatbot)
                 await delete_namespace(f"{platform.id}-{chatbot.name}")
                 await delete_namespace(f"{platform.id}-{chatbot.name}-data")
             except Exception as e:
@@ -408,7 +401,8 @@ class ChatBotSettings(commands.Cog):
             original_response = await interaction.original_response()
             
             cost = helpers.get_credits_cost(chatbot.model)
-            response_success = await handle_gpt_response(platform, chatbot, original_response, cost, None, False, chatbot.should_make_buttons, should_append_context=False)
+            async with chatbotqueue.get_queue(chatbot).turn():
+                response_success = await handle_gpt_response(platform, chatbot, original_response, cost, None, False, chatbot.should_make_buttons, should_append_context=False)
             if response_success:
                 platform.credits -= cost
         except Exception as e:
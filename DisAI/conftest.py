@@ -0,0 +1 @@
+# Lets the tests import the bot's packages (utils, core, ...) the same way the bot does, from this folder.
@@ -1,21 +1,29 @@
 from config import ICON_URL, MAX_TOKENS, PROMPT1VALUE
+import hashlib
 import tiktoken
+from core.tracking import Tracked
 # must add web_search and should_make_buttons, lorebooks to mongodb. make websearch false by default
 # Set up models
 encgpt3 = tiktoken.encoding_for_model('gpt-3.5-turbo')
 encgpt4 = tiktoken.encoding_for_model('gpt-4')
-class ChatBot:
+class ChatBot(Tracked):
     """
     A class to represent a chatbot.
     """
-    def __init__(self, name: str, channels: list, model: str, prompt: str, temperature: float, top_p: float, presence_penalty: float, 
+    TRACKED_FIELDS = frozenset(("name", "channels", "model", "prompt", "temperature", "top_p", "presence_penalty", "frequency_penalty",
+                                "include_usernames", "long_term_memory", "batch_number", "should_make_buttons", "data_name", "mention_mode",
+                                "web_search", "context", "avatar_url", "lorebooks", "sees_other_bots", "ltm_archived", "ltm_pending",
+                                "last_message_id")) # saved by backup_db
+
+    def __init__(self, name: str, channels: set, model: str, prompt: str, temperature: float, top_p: float, presence_penalty: float, 
                  frequency_penalty, include_usernames: bool, long_term_memory: bool, batch_number: int, should_make_buttons: bool,
-                 last_message, data_name: str, mention_mode: bool, web_search: bool, context: list = None, avatar_url: str = ICON_URL, lorebooks: list = None):
+                 last_message, data_name: str, mention_mode: bool, web_search: bool, context: list = None, avatar_url: str = ICON_URL, lorebooks: list = None,
+                 sees_other_bots: bool = True, ltm_archived: int = 0, ltm_pending: list = None, last_message_id: int = None):
         """
         Initialize a ChatBot instance.
         """
         self.name = name
-        self.channels = channels
+        self.channels = set(channels) # ids of the channels it's enabled in. stored as a list in the database
         self.model = model
         self.prompt = prompt
         self.temperature = temperature
@@ -27,6 +35,7 @@ class ChatBot:
         self.batch_number = batch_number
         self.should_make_buttons = should_make_buttons
         self.last_message = last_message
+        self.last_message_id = last_message_id # id of the latest reply, which alone can be regenerated/continued/deleted. kept across restarts, unlike last_message
         self.data_name = data_name
         self.mention_mode = mention_mode
         self.web_search = web_search
@@ -34,6 +43,14 @@ class ChatBot:
         self.avatar_url = avatar_url
         self.bing_bots = {} 
         self.lorebooks = lorebooks if lorebooks else [] # list of loerbook names
+        self.sees_other_bots = sees_other_bots # if False, replies in parallel with the other chatbots without seeing their replies first
+        self.ltm_archived = ltm_archived # messages archived to long term memory so far
+        self.ltm_pending = ltm_pending if ltm_pending else [] # evicted from the context, waiting for utils/ltmarchiver
+        self.saved_name = None # name in the database as of the last backup, to update this chatbot's entry in place
+
+    def mark_clean(self):
+        super().mark_clean()
+        self.saved_name = self.name
 
     def __str__(self):
         print(self.lorebooks)
@@ -45,6 +62,7 @@ class ChatBot:
     **Include usernames:** {self.include_usernames}
     **PDF/Youtube Video:** {self.data_name}   
     **Mention Mode:** {self.mention_mode}
+    **Multi-bot replies:** {'Sees earlier chatbots' if self.sees_other_bots else 'Independent'}
     **Long Term Memory:** {self.long_term_memory}
     **Regenerate/continue/delete reactions:** {self.should_make_buttons}
     **Avatar URL:** {self.avatar_url}
@@ -68,6 +86,10 @@ class ChatBot:
             return True
         return False
 
+def chatbot_key(name: str) -> str:
+    """Short, stable id for a chatbot name. Used in component custom_ids, which are capped at 100 characters."""
+    return hashlib.sha1(name.lower().encode('utf-8')).hexdigest()[:12]
+
 def get_tokens(model, messages):
     if model.startswith("gpt-4"):
         tokens_per_message = 4
@@ -94,9 +116,10 @@ async def default_chat_bot(name: str):
     """
     Create a default chat bot.
     """
-    return ChatBot(name=name, channels=[], model="gpt-3.5-turbo", prompt=PROMPT1VALUE, temperature=0.7, top_p=1, presence_penalty=0.9,
+    return ChatBot(name=name, channels=set(), model="gpt-3.5-turbo", prompt=PROMPT1VALUE, temperature=0.7, top_p=1, presence_penalty=0.9,
                    frequency_penalty=0.9, include_usernames=True, long_term_memory=True, batch_number=0, should_make_buttons=True, 
-                   last_message=None, data_name=None, mention_mode=False, web_search=True, context=[], avatar_url=ICON_URL, lorebooks=[])
+                   last_message=None, data_name=None, mention_mode=False, web_search=True, context=[], avatar_url=ICON_URL, lorebooks=[],
+                   sees_other_bots=True)
 
 async def chatbot_clone(og: ChatBot):
     """
@@ -107,4 +130,5 @@ async def chatbot_clone(og: ChatBot):
                    top_p=og.top_p, presence_penalty=og.presence_penalty, frequency_penalty=og.frequency_penalty,
                    include_usernames=og.include_usernames, long_term_memory=og.long_term_memory, batch_number=og.batch_number,
                    should_make_buttons=og.should_make_buttons, last_message=og.last_message, data_name=og.data_name,
-                   mention_mode=og.mention_mode, web_search=og.web_search, context=[], avatar_url=og.avatar_url, lorebooks=og.lorebooks)
\ No newline at end of file
+                   mention_mode=og.mention_mode, web_search=og.web_search, context=[], avatar_url=og.avatar_url, lorebooks=og.lorebooks,
+                   sees_other_bots=og.sees_other_bots, last_message_id=og.last_message_id)
\ No newline at end of file
@@ -1,6 +1,16 @@
+import asyncio
+from collections import deque
 from datetime import datetime
 from core.ChatBot import ChatBot
-class Platform():
+from core.tracking import Tracked
+from utils.namematcher import NameMatcher
+
+MAX_CONCURRENT_RESPONSES = 4 # chatbots generating a reply at the same time in one server
+ANALYTICS_HISTORY = 1000 # recent analytics events kept in memory per server, for the stats
+
+class Platform(Tracked):
+    TRACKED_FIELDS = frozenset(("name", "last_interaction_date", "chatbots", "credits", "claimers", "prompts")) # saved by backup_db
+
     def __init__(self, id: int, name: str, last_interaction_date: datetime, waiting_for: str, current_cb: ChatBot, credits: int, analytics: dict, 
                  claimers: dict, last_creditsembed_date: datetime, prompts: dict):
         self.id = id
@@ -10,10 +20,47 @@ class Platform():
         self.current_cb = current_cb 
         self.chatbots= []
         self.credits=credits
-        self.analytics = analytics
+        self.analytics = deque(analytics, maxlen=ANALYTICS_HISTORY) # recent events, for the stats. the database copy goes through utils/analyticssink
         self.claimers=claimers
         self.last_creditsembed_date=last_creditsembed_date
         self.prompts=prompts
+        self.response_semaphore = asyncio.Semaphore(MAX_CONCURRENT_RESPONSES) # bounds concurrent replies in this server
+        self._name_matcher = None # built on first use, dropped by chatbots_changed
+        self._channel_index = {} # channel id -> tuple of the chatbots enabled there, in self.chatbots order
+    
+    def chatbots_changed(self):
+        """Call after adding, removing or renaming a chatbot (and after loading them)."""
+        self._name_matcher = None
+        channel_index = {}
+        for chatbot in self.chatbots:
+            for channel_id in chatbot.channels:
+                channel_index.setdefault(channel_id, []).append(chatbot)
+        self._channel_index = {channel_id: tuple(chatbots) for channel_id, chatbots in channel_index.items()}
+
+    def chatbots_in_channel(self, channel_id: int) -> tuple:
+        """The chatbots enabled in a channel. A channel without any costs one dict lookup."""
+        return self._channel_index.get(channel_id, ())
+
+    def enable_chatbot(self, chatbot: ChatBot, channel_id: int):
+        chatbot.channels.add(channel_id)
+        self._reindex_channel(channel_id)
+
+    def disable_chatbot(self, chatbot: ChatBot, channel_id: int):
+        chatbot.channels.discard(channel_id)
+        self._reindex_channel(channel_id)
+
+    def _reindex_channel(self, channel_id: int):
+        chatbots = tuple(chatbot for chatbot in self.chatbots if channel_id in chatbot.channels)
+        if chatbots:
+            self._channel_index[channel_id] = chatbots
+        else:
+            self._channel_index.pop(channel_id, None)
+
+    def find_named_chatbots(self, text: str) -> list:
+        """Chatbots whose (lowercase) name appears in text, in order of first appearance."""
+        if self._name_matcher is None:
+            self._name_matcher = NameMatcher(self.chatbots)
+        return self._name_matcher.find_order(text)
     
     def __str__(self):
         return f""""id": {self.id},
@@ -1,5 +1,7 @@
 from core.Platform import Platform
 class Server(Platform):
+    TRACKED_FIELDS = Platform.TRACKED_FIELDS | {"voting_channel_id", "adminroles"}
+
     def __init__(self, id, name, last_interaction_date, waiting_for, current_cb, voting_channel_id, adminroles, credits, analytics, claimers, last_creditsembed_date, prompts):
         super().__init__(id, name, last_interaction_date, waiting_for, current_cb, credits, analytics, claimers, last_creditsembed_date, prompts)
         self.voting_channel_id=voting_channel_id
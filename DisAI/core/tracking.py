@@ -0,0 +1,90 @@
+import weakref
+
+"""Change tracking for the objects backup_db saves. Assigning to a tracked field, or changing a list, dict or set stored in one
+(context.append, prompts[name] = ..., channels.add, ...), records the field in the owner's dirty_fields, so a backup only writes
+what changed. Containers are replaced by tracked copies when assigned; changes to the items inside them (a message dict) aren't seen."""
+
+
+_MISSING = object()
+
+
+class TrackedContainer:
+    __slots__ = ()
+
+    def _track(self, owner, field: str):
+        if not hasattr(self, "_owners"):
+            self._owners = weakref.WeakKeyDictionary()
+        self._owners[owner] = field
+
+    def _changed(self):
+        owners = getattr(self, "_owners", None)
+        if owners:
+            for owner, field in list(owners.items()):
+                owner.mark_dirty(field)
+
+
+def _mutators(base, names):
+    """Wrap base's mutating methods so they report the change after running."""
+    def wrap(name):
+        original = getattr(base, name)
+        def method(self, *args, **kwargs):
+            result = original(self, *args, **kwargs)
+            self._changed()
+            return result
+        method.__name__ = name
+        return method
+    return {name: wrap(name) for name in names}
+
+
+TrackedList = type("TrackedList", (TrackedContainer, list), {"__slots__": ("_owners",), **_mutators(list, (
+    "__setitem__", "__delitem__", "__iadd__", "__imul__", "append", "extend", "insert", "pop", "remove", "clear", "sort", "reverse"))})
+TrackedDict = type("TrackedDict", (TrackedContainer, dict), {"__slots__": ("_owners",), **_mutators(dict, (
+    "__setitem__", "__delitem__", "__ior__", "pop", "popitem", "clear", "update", "setdefault"))})
+TrackedSet = type("TrackedSet", (TrackedContainer, set), {"__slots__": ("_owners",), **_mutators(set, (
+    "__ior__", "__iand__", "__isub__", "__ixor__", "add", "discard", "remove", "pop", "clear", "update", "difference_update",
+    "intersection_update", "symmetric_difference_update"))})
+
+
+def track(value, owner, field: str):
+    """value as a tracked container that reports to owner (the same object if it's already tracked). Other values are returned as is."""
+    if isinstance(value, TrackedContainer):
+        tracked = value
+    elif isinstance(value, list):
+        tracked = TrackedList(value)
+    elif isinstance(value, dict):
+        tracked = TrackedDict(value)
+    elif isinstance(value, set):
+        tracked = TrackedSet(value)
+    else:
+        return value
+    tracked._track(owner, field)
+    return tracked
+
+
+class Tracked:
+    """
+    Mixin for Platform and ChatBot. Fields in TRACKED_FIELDS mark the object dirty when they change. A new object starts with every
+    field dirty; the loader calls mark_clean once it matches the database.
+    """
+    TRACKED_FIELDS = frozenset()
+
+    def __setattr__(self, name, value):
+        if name in self.TRACKED_FIELDS:
+            tracked = track(value, self, name)
+            if tracked is not value or getattr(self, name, _MISSING) != value: # containers always count; scalars only if they changed
+                self.mark_dirty(name)
+            value = tracked
+        object.__setattr__(self, name, value)
+
+    def mark_dirty(self, field: str):
+        try:
+            self.dirty_fields.add(field)
+        except AttributeError: # first tracked assignment in __init__
+            object.__setattr__(self, "dirty_fields", {field})
+
+    def mark_clean(self):
+        object.__setattr__(self, "dirty_fields", set())
+
+    @property
+    def dirty(self) -> bool:
+        return bool(getattr(self, "dirty_fields", None))
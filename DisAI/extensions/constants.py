@@ -42,6 +42,7 @@ class Analytics(Enum):
     TOPP = 36
     RAN_OUT_OF_CREDITS = 37
     LOREBOOKS = 38
+    MULTIBOTREPLIES = 39
     
     
     HALF_DAY_IN_SECONDS = 43200
\ No newline at end of file
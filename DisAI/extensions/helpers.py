@@ -16,6 +16,7 @@ from config import (
 from core.ChatBot import get_tokens
 from extensions.constants import Analytics
 from extensions.embeds import claim_embed
+from utils import analyticssink
 from utils.dbhandler import load_platform_to_memory
 
 logger = logging.getLogger(__name__)
@@ -54,8 +55,11 @@ async def send_error_message(description, interaction, send_invite=True, view=No
         await interaction.send(content=None, embed=embed, view=view, delete_after=TIMEOUT_TIME)
 
 
-async def update_analytics(analytics, stat):
-    analytics.append((stat, datetime.now()))
+async def update_analytics(platform, stat, value=None):
+    """Record an analytics event: in platform.analytics for the stats since restart, and in the analytics sink for the database."""
+    now = datetime.now()
+    platform.analytics.append((stat, now) if value is None else (stat, now, value))
+    analyticssink.get_sink().record(platform.id, stat, now, value)
 
 async def get_platform(bot_platforms, interaction, stat=-1, id = None):
     platform = None
@@ -65,7 +69,7 @@ async def get_platform(bot_platforms, interaction, stat=-1, id = None):
         if id in bot_platforms:
             platform = bot_platforms[id]
             if stat != -1:
-                await update_analytics(platform.analytics, stat)
+                await update_analytics(platform, stat)
         elif id not in bot_platforms:
             platform = await load_platform_to_memory(id, bot_platforms)
             
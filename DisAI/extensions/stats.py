@@ -3,6 +3,7 @@ from datetime import datetime, timezone, timedelta
 import psutil
 from core.Server import Server
 from extensions.constants import Analytics
+from utils import chatbotqueue, dbhandler, liverender, pineconehandler
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 logger = logging.getLogger(__name__)
@@ -43,7 +44,7 @@ async def get_claim_stats(bot, datestr):
     date = datetime.strptime(datestr, DATE_FORMAT)
     total_claimers = len([(platform.name, str(analytic[1])) for platform in bot.platforms.values() for analytic in platform.analytics if analytic[0] == Analytics.CREDITSCLAIM.value])
     claimers_after_date = len([(platform.name, str(analytic[1])) for platform in bot.platforms.values() for analytic in platform.analytics if analytic[0] == Analytics.CREDITSCLAIM.value and analytic[1] > date])
-    total_analytics_collected = sum(len(platform.analytics) for platform in bot.platforms.values())
+    total_analytics_collected = bot.analytics_sink.get_stats()['recorded'] # platform.analytics only keeps the recent ones
     return total_claimers, claimers_after_date, total_analytics_collected
     
 
@@ -62,6 +63,127 @@ async def get_stopusingtime(bot):
     q3 = hours_sorted[int(len(hours_sorted)*0.75)]
     return q1, median, q3, mean
 
+def get_http_pool_stats(bot):
+    """Get the connection reuse and queueing counters of the shared HTTP pool."""
+    pool_stats = bot.http_pool.stats()
+    return f"""HTTP requests: {pool_stats['requests']}, connection reuse: {pool_stats['connection_hits']} hits / {pool_stats['connection_misses']} misses ({pool_stats['connection_hit_rate']:.1%})
+DNS cache: {pool_stats['dns_cache_hits']} hits / {pool_stats['dns_cache_misses']} misses
+Requests queued for a connection: {pool_stats['queued']} (avg wait {pool_stats['avg_queue_wait'] * 1000:0.1f} ms)"""
+
+def get_live_render_stats():
+    """Get the Discord edit counters of streamed replies."""
+    render_stats = liverender.get_stats()
+    return f"Streamed reply edits: {render_stats['edits_sent']} sent, {render_stats['edits_coalesced']} coalesced, {render_stats['edits_skipped']} skipped (no-op), {render_stats['ratelimits_avoided']} 429s avoided"
+
+def get_webhook_registry_stats(bot):
+    """Get the hit/miss counters of the per-channel webhook cache."""
+    registry_stats = bot.webhook_registry.stats()
+    return f"Webhook cache: {registry_stats['channels']} channels, {registry_stats['hits']} hits / {registry_stats['misses']} misses, {registry_stats['created']} created, {registry_stats['invalidations']} invalidated"
+
+def get_response_index_stats(bot):
+    """Get how many raw reaction events were dropped without any REST calls."""
+    return f"Reply index: {len(bot.response_index)} replies tracked, {bot.response_index.rejected} raw reaction events rejected for free"
+
+def get_chatbot_queue_stats():
+    """Get how well bursts of messages are being merged into single replies."""
+    queue_stats = chatbotqueue.get_stats()
+    return (f"Chatbot queues: {queue_stats['requests']} messages, {queue_stats['turns']} replies ({queue_stats['coalescing_ratio']:0.2f} messages per reply), "
+            f"{queue_stats['coalesced']} coalesced, {queue_stats['shed']} shed, {queue_stats['pending']} pending, "
+            f"latency avg {queue_stats['avg_latency']:0.2f}s / p95 {queue_stats['p95_latency']:0.2f}s")
+
+def get_admission_stats(bot):
+    """Get how many messages were admitted, made to wait, merged and shed by admission control."""
+    admission_stats = bot.admission.stats()
+    top_shed = ", ".join(f"{guild_id}: {shed}" for guild_id, shed in bot.admission.top_shed_guilds())
+    return (f"Admission: {admission_stats['admitted']} admitted, {admission_stats['queued']} queued, {admission_stats['coalesced']} coalesced, "
+            f"{admission_stats['shed']} shed, {admission_stats['waiting']} waiting now across {admission_stats['guilds']} servers"
+            f"{f' (most shed: {top_shed})' if top_shed else ''}")
+
+def get_retrieval_stats():
+    """Get how long the retrieval stage (one embedding, concurrent namespace queries) takes."""
+    retrieval_stats = pineconehandler.get_retrieval_stats()
+    return (f"Retrieval: {retrieval_stats['retrievals']} retrievals, {retrieval_stats['namespace_queries']} namespace queries, "
+            f"avg embed {retrieval_stats['avg_embed_time']:0.3f}s, avg queries {retrieval_stats['avg_query_time']:0.3f}s, "
+            f"{retrieval_stats['deadline_misses']} deadline misses")
+
+def get_retrieval_cache_stats(bot):
+    """Get how many namespace queries were answered from the retrieval cache."""
+    cache_stats = bot.retrieval_cache.get_stats()
+    return (f"Retrieval cache: {cache_stats['hit_rate'] * 100:0.1f}% hit rate ({cache_stats['hits']} hits, {cache_stats['misses']} misses), "
+            f"{cache_stats['saved_time']:0.1f}s of queries saved, {cache_stats['invalidations']} invalidations, {cache_stats['entries']} entries")
+
+def get_ingestion_stats():
+    """Get how much data upsert_data stored and how often it had to back off."""
+    ingestion_stats = pineconehandler.get_ingestion_stats()
+    return (f"Ingestion: {ingestion_stats['ingestions']} ingestions, {ingestion_stats['batches']} batches, {ingestion_stats['vectors']} vectors, "
+            f"{ingestion_stats['retries']} retries, {ingestion_stats['dead_lettered']} batches dead-lettered, {ingestion_stats['budget_left']} embedding tokens left this minute")
+
+def get_embed_batcher_stats():
+    """Get how many small embedding requests were merged into one API call, and the batch sizes."""
+    batcher_stats = pineconehandler.get_embed_batcher_stats()
+    sizes = ", ".join(f"{bucket}: {count}" for bucket, count in batcher_stats['sizes'].items())
+    return (f"Embedding batcher: {batcher_stats['requests']} requests in {batcher_stats['batches']} batches ({batcher_stats['texts']} texts, "
+            f"avg {batcher_stats['avg_batch_size']:0.1f} per batch), {batcher_stats['failed_batches']} failed ({batcher_stats['failed_requests']} requests still failed alone). Batch sizes: {sizes if sizes else 'none yet'}")
+
+def get_executor_stats(bot):
+    """Get queue depth and wait times of the I/O and CPU pools."""
+    lines = []
+    for name, pool_stats in bot.executors.stats().items():
+        lines.append(f"{name.upper()} pool ({pool_stats['workers']} workers): {pool_stats['submitted']} calls, {pool_stats['failed']} failed, {pool_stats['dropped']} dropped, "
+                     f"{pool_stats['queued']} queued / {pool_stats['running']} running now, "
+                     f"wait avg {pool_stats['avg_wait'] * 1000:0.1f} ms / max {pool_stats['max_wait'] * 1000:0.1f} ms, run avg {pool_stats['avg_run'] * 1000:0.1f} ms")
+    return "\n".join(lines)
+
+def get_backup_stats():
+    """Get how much the database backups write."""
+    backup_stats = dbhandler.backup_stats
+    return (f"Backups: {backup_stats['cycles']} cycles, {backup_stats['documents']} documents / {backup_stats['bytes'] / 1e6:0.2f} MB written, {backup_stats['failed']} failed. "
+            f"Last: {backup_stats['last_documents']} documents, {backup_stats['last_bytes'] / 1e3:0.1f} KB, {backup_stats['last_skipped']} unchanged skipped, "
+            f"{backup_stats['last_duration']:0.2f}s")
+
+def get_analytics_sink_stats(bot):
+    """Get how many analytics events were written to the database, and how many are waiting."""
+    sink_stats = bot.analytics_sink.get_stats()
+    return (f"Analytics sink: {sink_stats['recorded']} recorded, {sink_stats['written']} written in {sink_stats['flushes']} flushes "
+            f"({sink_stats['failed_flushes']} failed, {sink_stats['duplicates']} duplicates skipped), {sink_stats['dropped']} dropped (buffer full), "
+            f"{sink_stats['buffered']} buffered / {sink_stats['unsent']} unsent now")
+
+def get_database_stats(bot):
+    """Get MongoDB latency per operation, and how long calls waited for a database thread."""
+    database_stats = bot.database.get_stats()
+    pool_stats = database_stats['pool']
+    lines = [f"Database pool ({pool_stats['workers']} workers): {pool_stats['queued']} queued / {pool_stats['running']} running now, "
+             f"wait avg {pool_stats['avg_wait'] * 1000:0.1f} ms / max {pool_stats['max_wait'] * 1000:0.1f} ms"]
+    for operation, op_stats in database_stats['operations'].items():
+        lines.append(f"Mongo {operation}: {op_stats['calls']} calls, {op_stats['errors']} errors, avg {op_stats['avg_ms']:0.1f} ms, "
+                     f"p50 <= {op_stats['p50_ms']} ms, p95 <= {op_stats['p95_ms']} ms")
+    return "\n".join(lines)
+
+def get_embedding_cache_stats(bot):
+    """Get how many embeddings were served without calling OpenAI."""
+    cache_stats = bot.embedding_cache.stats()
+    return (f"Embedding cache: {cache_stats['hit_rate'] * 100:0.1f}% hit rate ({cache_stats['memory_hits']} memory hits, {cache_stats['disk_hits']} disk hits, "
+            f"{cache_stats['misses']} misses), {cache_stats['memory_entries']} in memory, {cache_stats['disk_entries']} on disk, {cache_stats['evictions']} evicted")
+
+def get_vector_queue_stats(bot):
+    """Get how many vector store mutations were applied, merged and retried."""
+    queue_stats = bot.vector_queue.get_stats()
+    return (f"Vector store queue: {queue_stats['upserts']} upserts, {queue_stats['deletes']} deletes, {queue_stats['superseded']} upserts skipped by a later delete, "
+            f"{queue_stats['batches']} batches, {queue_stats['retries']} retries, {queue_stats['failed']} failed, "
+            f"{queue_stats['pending']} pending / {queue_stats['deleting']} namespaces being deleted now")
+
+def get_job_stats(bot):
+    """Get how many ingestion jobs ran, and how many are waiting."""
+    job_stats = bot.jobs.get_stats()
+    return (f"Ingestion jobs: {job_stats['submitted']} submitted, {job_stats['resumed']} resumed, {job_stats['done']} done, {job_stats['failed']} failed, "
+            f"{job_stats['cancelled']} cancelled, {job_stats['rejected']} rejected (queue full), {job_stats['queued']} queued / {job_stats['running']} running now")
+
+def get_ltm_archiver_stats(bot):
+    """Get how many evicted messages were archived to long term memory."""
+    ltm_stats = bot.ltm_archiver.get_stats()
+    return (f"Long term memory archiver: {ltm_stats['archived']} messages archived in {ltm_stats['windows']} windows, {ltm_stats['flushes']} flushes, "
+            f"{ltm_stats['failed_flushes']} failed, {ltm_stats['discarded']} discarded (memory cleared), {ltm_stats['pending_chatbots']} chatbots pending now")
+
 def credits_needed_analytics(bot):
     number_of_credits_needed_msgs_sent = 0
     number_of_gpt_responses_sent = 0
@@ -140,6 +262,43 @@ async def get_all_stats(bot, votes_channel, hours=1):
         memory_usage = psutil.Process().memory_info().rss / (1024 ** 2)  # Convert to MB
         print("memory_usage =", memory_usage)
         
+        http_pool_stats = get_http_pool_stats(bot)
+        print(http_pool_stats)
+        live_render_stats = get_live_render_stats()
+        print(live_render_stats)
+        webhook_registry_stats = get_webhook_registry_stats(bot)
+        print(webhook_registry_stats)
+        response_index_stats = get_response_index_stats(bot)
+        print(response_index_stats)
+        chatbot_queue_stats = get_chatbot_queue_stats()
+        print(chatbot_queue_stats)
+        admission_stats = get_admission_stats(bot)
+        print(admission_stats)
+        retrieval_stats = get_retrieval_stats()
+        print(retrieval_stats)
+        retrieval_cache_stats = get_retrieval_cache_stats(bot)
+        print(retrieval_cache_stats)
+        ingestion_stats = get_ingestion_stats()
+        print(ingestion_stats)
+        embed_batcher_stats = get_embed_batcher_stats()
+        print(embed_batcher_stats)
+        executor_stats = get_executor_stats(bot)
+        print(executor_stats)
+        database_stats = get_database_stats(bot)
+        print(database_stats)
+        backup_stats = get_backup_stats()
+        print(backup_stats)
+        analytics_sink_stats = get_analytics_sink_stats(bot)
+        print(analytics_sink_stats)
+        embedding_cache_stats = get_embedding_cache_stats(bot)
+        print(embedding_cache_stats)
+        vector_queue_stats = get_vector_queue_stats(bot)
+        print(vector_queue_stats)
+        job_stats = get_job_stats(bot)
+        print(job_stats)
+        ltm_archiver_stats = get_ltm_archiver_stats(bot)
+        print(ltm_archiver_stats)
+        
         return f"""Total user count: {user_count} users across {guild_count} servers.
 Users in the last {hours} hours: {active_users_1h} users across {guild_count_1h} servers.
 Users in the last day: {active_users_1d} users across {guild_count_1d} servers.
@@ -158,6 +317,25 @@ Memory usage: {memory_usage:0.1f} MB
 Average tokens since last restart: {avg_tokens:0.1f}
 Number of times ran out of credits: {number_of_credits_needed_msgs_sent}
 Number of GPT responses sent: {number_of_gpt_responses_sent}
+
+{http_pool_stats}
+{live_render_stats}
+{webhook_registry_stats}
+{response_index_stats}
+{chatbot_queue_stats}
+{admission_stats}
+{retrieval_stats}
+{retrieval_cache_stats}
+{ingestion_stats}
+{embed_batcher_stats}
+{executor_stats}
+{database_stats}
+{backup_stats}
+{analytics_sink_stats}
+{embedding_cache_stats}
+{vector_queue_stats}
+{job_stats}
+{ltm_archiver_stats}
 """
     except Exception as e:
         print(e)
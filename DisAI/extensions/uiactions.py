@@ -8,14 +8,16 @@ from discord import ui, Colour, Interaction
 import discord
 
 from extensions.constants import Analytics
-from core.ChatBot import ChatBot, default_chat_bot
+from core.ChatBot import ChatBot, default_chat_bot, chatbot_key
 import utils.dbhandler as dbhandler
+import utils.jobscheduler as jobscheduler
+import utils.ltmarchiver as ltmarchiver
 from extensions.embeds import (
     send_discord_invite, commands_help_embed, commands_help2_embed, 
     help_overview_embed, chatbot_settings_embed, chatbot_settings2_embed, 
     prompt_cb_embed
 )
-from extensions.helpers import get_platform_id, send_error_message, get_chatbot_settings_embed, update_analytics, get_prompt_library_embed, make_inviteview
+from extensions.helpers import get_platform_id, send_error_message, get_chatbot_settings_embed, update_analytics, get_prompt_library_embed, make_inviteview, get_platform, has_correct_perms
 from utils.pineconehandler import delete_namespace
 import stripe
 from config import (
@@ -70,6 +72,7 @@ VOTE_CREDITS_LABEL = "Vote 🪙 x{} (FREE)"
 BUY_CREDITS_LABEL = "Buy 🪙 x{} Credits (${})"
 MAX_PROMPTS = 20
 MAX_PROMPT_NAME_LENGTH = 60
+RESPONSE_CONTROL_EMOJIS = {"continue": '⏩', "regen": '🔃', "delete": '🗑️'}
 newprompts_avatars = [(PROMPT1NAME, PROMPT1AVATAR),(PROMPT2NAME, PROMPT2AVATAR),(PROMPT3NAME, PROMPT3AVATAR),(PROMPT4NAME, PROMPT4AVATAR),(PROMPT5NAME, PROMPT5AVATAR)]
 
 # Set up logging
@@ -201,6 +204,7 @@ class DeleteButton(ui.Button):
             if self.chatbotdropdown.chatbot:
                 if len(self.platform.chatbots) >= 2:
                     try:
+                        ltmarchiver.get_archiver().discard(self.chatbotdropdown.chatbot)
                         await delete_namespace(f"{self.platform.id}-{self.chatbotdropdown.chatbot.name}")
                         await delete_namespace(f"{self.platform.id}-{self.chatbotdropdown.chatbot.name}-data")
                     except Exception as error:
@@ -208,6 +212,7 @@ class DeleteButton(ui.Button):
                         raise
                     await dbhandler.remove_cb_from_db(self.platform.id, self.chatbotdropdown.chatbot.name)
                     self.chatbots.remove(self.chatbotdropdown.chatbot)
+                    self.platform.chatbots_changed()
                     embed = discord.Embed(title=f"Deleted chatbot: {self.chatbotdropdown.chatbot.name}", colour=Colour.blue())
                     view = ui.View()
                     view.add_item(BackToChatbotSelectionButton(self.platform))
@@ -268,18 +273,18 @@ class SettingsListDropdown(ui.Select):
         match self.values[0]:
             case "📚  Prompt Library  📚":
                 try:
-                    await update_analytics(self.platform.analytics, Analytics.PROMPT.value)
+                    await update_analytics(self.platform, Analytics.PROMPT.value)
                     embed=get_prompt_library_embed(self.chatbot.name)
                     await interaction.response.edit_message(embed=embed, view=PromptView(self.platform, self.chatbot))
                 except Exception as e:
                     print(f"in selection stuff, prompt err {e}")
             case "👥 Include Usernames":
-                await update_analytics(self.platform.analytics, Analytics.INCLUDEUSERNAMES.value)
+                await update_analytics(self.platform, Analytics.INCLUDEUSERNAMES.value)
                 await interaction.response.edit_message(embed=discord.Embed(title="Include Usernames", description="Allows chatbots to understand usernames", color=discord.Colour.blue()), view=IUMenu(self.chatbot, self.backview))
                 # await interaction.followup.send(
             case "📄/🎥 PDF / YouTube Video":
                 try:
-                    await update_analytics(self.platform.analytics, Analytics.PDFORVIDEO.value)
+                    await update_analytics(self.platform, Analytics.PDFORVIDEO.value)
                     name = "PDF / Youtube Video: None" if not self.chatbot.data_name else self.chatbot.data_name
                     await interaction.response.edit_message(view=AddDataView(self.chatbot, self.platform, self.backview), embed=discord.Embed(title=f"Current {name}", color=discord.Colour.blue()))
                 except Exception as e:
@@ -288,20 +293,20 @@ class SettingsListDropdown(ui.Select):
                 await interaction.response.send_modal(EditAvatarModal(self.chatbot, self.backview))
             case "📣 Mention Mode":
                 try:
-                    await update_analytics(self.platform.analytics, Analytics.MENTIONMODE.value)
+                    await update_analytics(self.platform, Analytics.MENTIONMODE.value)
                     await interaction.response.defer()
                     await interaction.followup.edit_message(interaction.message.id, view=MentionModeView(self.chatbot, self.backview), embed=discord.Embed(title="Mention Mode Settings", description=f"If Mention Mode is enabled, the chatbot will only respond if <@{APPLICATION_ID}> is mentioned.\nThe chatbot will still respond with context as long as it is enabled in the channel.", color=discord.Colour.blue()))
                 except Exception as e:
                     print(e)
             case "🧠 Long Term Memory":
-                await update_analytics(self.platform.analytics, Analytics.LONGTERMMEMORY.value)
+                await update_analytics(self.platform, Analytics.LONGTERMMEMORY.value)
                 await interaction.response.edit_message(view=LTMView(self.chatbot, self.backview))
             case "🌐 Web Search":
-                await update_analytics(self.platform.analytics, Analytics.WEBSEARCH.value)
+                await update_analytics(self.platform, Analytics.WEBSEARCH.value)
                 await interaction.response.edit_message(view=WebSearchView(self.chatbot, self.backview), embed=discord.Embed(title="Web Search settings", description="If enabled, chatbots will automatically perform web searches when appropriate. Web searches take longer. Disable if you don't want this.", color=discord.Colour.blue()))
             case "➕ Add Long Prompt":
                 try:
-                    await update_analytics(self.platform.analytics, Analytics.LONGPROMPT.value)
+                    await update_analytics(self.platform, Analytics.LONGPROMPT.value)
                     if len(self.platform.prompts) > 20:
                         await send_error_message("Too many prompts have been added (> 20)\nPlease delete some prompts from the prompt library before adding more.", interaction, view=self.backview)
                     embed=discord.Embed(title="Long Prompt: Attach text file with your prompt below", description="Allows you to bypass Discord's 2000 character limit.", color=discord.Colour.blue())
@@ -311,11 +316,11 @@ class SettingsListDropdown(ui.Select):
                 except Exception as e:
                     print(f"Long prompt error: {e}")
             case "🔄 Toggle reactions":
-                await update_analytics(self.platform.analytics, Analytics.REGENERATEORCONTINUEBUTTONS.value)
+                await update_analytics(self.platform, Analytics.REGENERATEORCONTINUEBUTTONS.value)
                 await interaction.response.edit_message(embed=discord.Embed(title="Toggle reactions", description="Toggle the regenerate, continue, and delete reactions that appear at the end of chatbot messages.", color=discord.Colour.blue()), view=ReactionButtonsView(self.chatbot, self.backview))
             case "📖 Lorebooks":
                 try:
-                    await update_analytics(self.platform.analytics, Analytics.LOREBOOKS.value)
+                    await update_analytics(self.platform, Analytics.LOREBOOKS.value)
                     lorebook_str = '\n'.join(self.chatbot.lorebooks)
                     if self.chatbot.lorebooks:
                         desc_str = f"Current lorebooks:\n{lorebook_str}"
@@ -340,7 +345,8 @@ class SettingsListDropdown2(ui.Select):
             discord.SelectOption(label="🔧 Temperature"),
             discord.SelectOption(label="🔧 Presence Penalty"),
             discord.SelectOption(label="🔧 Frequency Penalty"),
-            discord.SelectOption(label="🔧Top P")
+            discord.SelectOption(label="🔧Top P"),
+            discord.SelectOption(label="🤝 Multi-bot Replies")
         ]
         super().__init__(placeholder=SELECT_SETTING_PAGE_2, options=options, min_values=1, max_values=1)
 
@@ -354,23 +360,26 @@ class SettingsListDropdown2(ui.Select):
         try:
             match self.values[0]:
                 case "🤖 GPT Model":
-                    await update_analytics(self.platform.analytics, Analytics.AIMODEL.value)
+                    await update_analytics(self.platform, Analytics.AIMODEL.value)
                     await interaction.response.edit_message(view=ChangeModelView(self.chatbot, self.platform, self.backview))
                 case "💉 Inject Message":
-                    await update_analytics(self.platform.analytics, Analytics.INJECTMESSAGE.value)
+                    await update_analytics(self.platform, Analytics.INJECTMESSAGE.value)
                     await interaction.response.send_modal(IJModal(self.chatbot, self.backview))
                 case "🔧 Temperature":
-                    await update_analytics(self.platform.analytics, Analytics.TEMPERATURE.value)
+                    await update_analytics(self.platform, Analytics.TEMPERATURE.value)
                     await interaction.response.send_modal(TempModal(self.chatbot, self.backview))
                 case "🔧 Presence Penalty":
-                    await update_analytics(self.platform.analytics, Analytics.PP.value)
+                    await update_analytics(self.platform, Analytics.PP.value)
                     await interaction.response.send_modal(PPModal(self.chatbot, self.backview))
                 case "🔧 Frequency Penalty":
-                    await update_analytics(self.platform.analytics, Analytics.FP.value)
+                    await update_analytics(self.platform, Analytics.FP.value)
                     await interaction.response.send_modal(FPModal(self.chatbot, self.backview))
                 case "🔧Top P":
-                    await update_analytics(self.platform.analytics, Analytics.TOPP.value)
+                    await update_analytics(self.platform, Analytics.TOPP.value)
                     await interaction.response.send_modal(TopPModal(self.chatbot, self.backview))
+                case "🤝 Multi-bot Replies":
+                    await update_analytics(self.platform, Analytics.MULTIBOTREPLIES.value)
+                    await interaction.response.edit_message(view=MultiBotRepliesView(self.chatbot, self.backview), embed=discord.Embed(title="Multi-bot Replies", description="When several chatbots reply to the same message, a chatbot can either wait for and see the replies of the chatbots before it, or reply independently (faster, at the same time as the others).", color=discord.Colour.blue()))
                 case _:
                     await send_error_message("An error occurred. Please join the support sever and contact the developer.", interaction, send_invite=True)
         except Exception as e:
@@ -697,6 +706,7 @@ class LTMView(discord.ui.View):
         """Clear long term memory."""
         
         try:
+            ltmarchiver.get_archiver().discard(self.chatbot)
             await delete_namespace(f"{get_platform_id(interaction)}-{self.chatbot.name}")
             await delete_namespace(f"{get_platform_id(interaction)}-{self.chatbot.name}-data")
         except Exception as e:
@@ -773,6 +783,38 @@ class MentionModeView(BaseView):
         await interaction.response.edit_message(view=self.backview, embed=embed)
 
 
+class CancelJobView(ui.View):
+    """Cancel button under a PDF / video / lorebook upload while its ingestion job is queued or running."""
+    def __init__(self, platform, job_id):
+        super().__init__(timeout=None)
+        self.platform = platform
+        self.job_id = job_id
+
+    @discord.ui.button(label="Cancel", style=discord.ButtonStyle.red)
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if not await has_correct_perms(self.platform, interaction):
+            return
+        if await jobscheduler.get_scheduler().cancel(self.job_id):
+            await interaction.response.send_message("Cancelling upload...", ephemeral=True)
+        else:
+            await interaction.response.send_message("This upload has already finished.", ephemeral=True)
+
+
+class MultiBotRepliesView(BaseView):
+    """View for how a chatbot replies alongside other chatbots."""
+    @discord.ui.button(label="Sees earlier chatbots", style=discord.ButtonStyle.green)
+    async def enable(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.chatbot.sees_other_bots = True
+        embed = discord.Embed(title="Multi-bot Replies: sees earlier chatbots", description=f"{self.chatbot.name} will wait for the chatbots replying before it and respond to what they said.", color=BLUE_COLOUR)
+        await interaction.response.edit_message(view=self.backview, embed=embed)
+
+    @discord.ui.button(label="Independent", style=discord.ButtonStyle.blurple)
+    async def disable(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.chatbot.sees_other_bots = False
+        embed = discord.Embed(title="Multi-bot Replies: independent", description=f"{self.chatbot.name} will reply at the same time as the other chatbots, without seeing their replies to the same message.", color=BLUE_COLOUR)
+        await interaction.response.edit_message(view=self.backview, embed=embed)
+
+
 class ReactionButtonsView(BaseView):
     """View for reaction buttons setting from /settings."""
 
@@ -789,6 +831,52 @@ class ReactionButtonsView(BaseView):
         await interaction.response.edit_message(view=self.backview, embed=embed)
 
 
+class ResponseControlButton(discord.ui.DynamicItem[discord.ui.Button], template=r"disai:(?P<action>continue|regen|delete):(?P<platform_id>[0-9]+):(?P<chatbot_key>[0-9a-f]+)"):
+    """Continue/regenerate/delete button sent with every chatbot reply.
+    The custom_id carries the platform and chatbot, so clicks keep working after a restart (registered with bot.add_dynamic_items)."""
+    def __init__(self, action: str, platform_id: int, key: str):
+        self.action = action
+        self.platform_id = platform_id
+        self.chatbot_key = key
+        super().__init__(discord.ui.Button(emoji=RESPONSE_CONTROL_EMOJIS[action], style=discord.ButtonStyle.gray, custom_id=f"disai:{action}:{platform_id}:{key}"))
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: discord.ui.Button, match):
+        return cls(match['action'], int(match['platform_id']), match['chatbot_key'])
+
+    async def callback(self, interaction: Interaction):
+        from utils.events import handle_reaction, handle_delete_reaction # imported here because utils.events imports this module
+        try:
+            platform = await get_platform(interaction.client.platforms, None, id=self.platform_id)
+            chatbot = next((chatbot for chatbot in platform.chatbots if chatbot_key(chatbot.name) == self.chatbot_key), None) if platform else None
+            if chatbot is None:
+                await interaction.response.send_message(embed=discord.Embed(title="This chatbot no longer exists.", color=BLUE_COLOUR), ephemeral=True)
+                return
+            if chatbot.last_message_id != interaction.message.id: # also after a restart or a continue, when last_message isn't loaded
+                await interaction.response.send_message(embed=discord.Embed(title=f"Only {chatbot.name}'s latest message can be regenerated, continued, or deleted.", color=BLUE_COLOUR), ephemeral=True)
+                return
+            if self.action == "delete":
+                await interaction.response.defer()
+                await handle_delete_reaction(chatbot, interaction)
+                return
+            await interaction.response.edit_message(view=None) # acknowledges the click and removes the buttons in one call
+            if self.action == "regen":
+                await handle_reaction(chatbot, interaction.message, platform, Analytics.REGENERATE.value, True)
+            else:
+                chatbot.last_message = None # its buttons are already gone
+                await handle_reaction(chatbot, interaction.message, platform, Analytics.CONTINUE.value, False)
+        except Exception as e:
+            logger.error(f"response control err: {type(e)} - {e}")
+
+def make_response_controls_view(platform_id, chatbot, converse_mode=False):
+    """Buttons attached to a chatbot's reply. Delete is left out in /conversation mode."""
+    view = discord.ui.View(timeout=None)
+    actions = ["continue", "regen"] if converse_mode else ["continue", "regen", "delete"]
+    for action in actions:
+        view.add_item(ResponseControlButton(action, platform_id, chatbot_key(chatbot.name)))
+    return view
+
+
 
 def create_stripe_product(name, price):
     """Create a stripe product and price."""
@@ -859,7 +947,7 @@ class CreditsDropdown(discord.ui.Select):
 
     async def update_analytics_and_add_button(self, interaction, analytics, button_class, amount=None, price=None):
         """Update analytics and add button to view."""
-        await update_analytics(self.platform.analytics, analytics)
+        await update_analytics(self.platform, analytics)
         if amount and price:
             url = await get_checkout_url(interaction.user.id, self.platform.id, interaction.channel.id, price.id, amount)
             button = button_class(self.platform, amount, price.unit_amount, url)
@@ -1141,6 +1229,7 @@ class PromptSetButton(ui.Button):
 
     async def handle_namespace_deletion(self):
         try:
+            ltmarchiver.get_archiver().discard(self.chatbot)
             await delete_namespace(f"{self.platform.id}-{self.chatbot.name}")
         except Exception as e:
             logger.error(e)
@@ -1162,6 +1251,7 @@ class PromptSetButton(ui.Button):
     async def handle_chatbot_creation(self, interaction):
         await dbhandler.add_cb_to_db(self.platform.id, await dbhandler.make_bot_dict(self.chatbot))
         self.platform.chatbots.append(self.chatbot)
+        self.platform.chatbots_changed()
         self.chatbot.context.clear()
         self.chatbot.prompt = str(self.platform.prompts[self.promptdropdown.promptname])
         embed = discord.Embed(title=f"🌟  Chatbot created: {self.chatbot.name}",
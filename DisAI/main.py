@@ -50,6 +50,11 @@ async def main():
         """Event handler for when a reaction is added."""
         await events.on_raw_reaction_add(bot, payload)
 
+    @bot.event
+    async def on_webhooks_update(channel):
+        """Event handler for when a channel's webhooks are created, edited or deleted."""
+        bot.webhook_registry.webhooks_updated(channel.id)
+
     @bot.event
     async def on_guild_remove(guild):
         """Event handler for when a guild is removed."""
@@ -0,0 +1,23 @@
+import random
+
+from utils.namematcher import NameMatcher, _BenchBot, _legacy_find_order
+
+
+def bots(*names):
+    return [_BenchBot(name) for name in names]
+
+def test_order_of_first_appearance():
+    chatbots = bots("Alice", "Bob")
+    assert NameMatcher(chatbots).find_order("hey bob, ask alice. bob?") == [chatbots[1], chatbots[0]]
+
+def test_overlapping_names():
+    chatbots = bots("anna", "nab", "ann", "na")
+    # "anna" is matched; "ann" and "na" are inside it, "nab" starts inside it and runs past its end
+    assert NameMatcher(chatbots).find_order("annab") == _legacy_find_order("annab", chatbots) == [chatbots[0], chatbots[2], chatbots[1], chatbots[3]]
+
+def test_same_as_str_find():
+    random.seed(1)
+    for _ in range(2000):
+        chatbots = bots(*("".join(random.choices("ab", k=random.randint(1, 5))) for _ in range(random.randint(1, 8))))
+        text = "".join(random.choices("abc", k=random.randint(0, 30)))
+        assert NameMatcher(chatbots).find_order(text) == _legacy_find_order(text, chatbots)
@@ -0,0 +1,30 @@
+from utils.ssedecoder import SSEDecoder, _make_stream, _split_reads
+
+
+def feed_all(decoder, chunks):
+    return [event for chunk in chunks for event in decoder.feed(chunk)]
+
+def test_frames_split_across_reads():
+    stream = _make_stream(300)
+    decoder = SSEDecoder()
+    events = feed_all(decoder, _split_reads(stream, min_size=1, max_size=50))
+    assert len(events) == 300
+    assert decoder.done
+
+def test_crlf_split_between_reads():
+    decoder = SSEDecoder()
+    events = feed_all(decoder, [b'data: {"a":1}\r\n\r', b'\n', b'data: {"b":2}\n\n'])
+    assert events == [{"a": 1}, {"b": 2}]
+
+def test_crlf_byte_by_byte():
+    stream = b'data: {"a":1}\r\n\r\n: keep-alive\r\n\r\ndata: {"b":2}\r\n\r\ndata: [DONE]\r\n\r\n'
+    decoder = SSEDecoder()
+    events = feed_all(decoder, [stream[i:i + 1] for i in range(len(stream))])
+    assert events == [{"a": 1}, {"b": 2}]
+    assert decoder.done
+
+def test_bad_frame_is_skipped():
+    decoder = SSEDecoder()
+    events = decoder.feed(b'data: {"a":1}\n\ndata: {not json\n\ndata: {"b":2}\n\n')
+    assert events == [{"a": 1}, {"b": 2}]
+    assert decoder.bad_frames == 1
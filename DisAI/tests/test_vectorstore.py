@@ -0,0 +1,42 @@
+import math
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from utils import vectorstore
+from utils.vectorstore import LocalStore
+
+
+def make_vectors(start, count, dimension=8):
+    return [(str(i), [math.sin((i + 1) * (j + 1)) for j in range(dimension)], {"text": f"entry {i}"}) for i in range(start, start + count)]
+
+def test_upsert_query_delete(tmp_path):
+    store = LocalStore(str(tmp_path))
+    store.upsert("server-bot", make_vectors(0, 3))
+    matches = store.query("server-bot", make_vectors(1, 1)[0][1], top_k=2)
+    assert [match["id"] for match in matches][0] == "1"
+    assert matches[0]["metadata"] == {"text": "entry 1"}
+    assert matches[0]["score"] >= matches[1]["score"]
+    store.upsert("server-bot", [("1", make_vectors(2, 1)[0][1], {"text": "replaced"})]) # same id: overwritten, not added
+    assert store.namespace_stats("server-bot") == {"vector_count": 3}
+    store.delete_namespace("server-bot")
+    assert store.namespace_stats("server-bot") == {"vector_count": 0}
+    assert store.query("server-bot", make_vectors(0, 1)[0][1], top_k=3) == []
+
+def test_reopen_after_growth(tmp_path):
+    count = vectorstore.MIN_CAPACITY * 2 + 5 # the file has to grow twice
+    store = LocalStore(str(tmp_path))
+    for start in range(0, count, 50):
+        store.upsert("server-bot", make_vectors(start, min(50, count - start)))
+    store.close()
+    reopened = LocalStore(str(tmp_path)) # rebuilt from meta.json and the memory-mapped file
+    assert reopened.namespace_stats("server-bot") == {"vector_count": count}
+    last = make_vectors(count - 1, 1)[0]
+    match = reopened.query("server-bot", last[1], top_k=1)[0]
+    assert match["id"] == last[0] and match["metadata"] == last[2]
+    assert reopened.query("other", last[1], top_k=1) == []
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        vectorstore.VectorStore()
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from utils import services
+
+"""Admission control for chatbot replies. Every message that would make a chatbot reply takes a token from its server's bucket and from
+the global bucket. When a server runs dry its messages wait (fairly against other servers), get merged, or are shed, so one busy server
+can't eat the whole OpenAI quota and quiet servers are never starved."""
+
+# Constants
+GUILD_RATE = 0.5 # tokens per second, per server
+GUILD_BURST = 6 # bucket size, per server
+GLOBAL_RATE = 15 # tokens per second, whole bot
+GLOBAL_BURST = 40
+MAX_WAITING_PER_GUILD = 4 # waiting tickets per server
+MAX_WAITING = 200 # waiting tickets across all servers
+MAX_WAIT = 45 # seconds a ticket may wait before it's shed
+NOTICE_COOLDOWN = 60 # min seconds between "slow down" notices in a server
+
+# Policies for a message that can't be admitted right away
+QUEUE = "queue" # wait for a token
+COALESCE = "coalesce" # wait, but merge with a message already waiting in the same channel (one reply answers both)
+REJECT = "reject" # shed right away, with a notice
+
+# Decisions
+ADMITTED = "admitted"
+COALESCED = "coalesced"
+SHED = "shed"
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def has_token(self) -> bool:
+        self.refill()
+        return self.tokens >= 1
+
+    def take(self, n: float = 1):
+        self.tokens -= n
+
+    def time_until(self, n: float) -> float:
+        """Seconds until n tokens are there. More than the capacity only waits for a full bucket; take(n) then leaves it in debt."""
+        self.refill()
+        return max(0.0, (min(n, self.capacity) - self.tokens) / self.rate)
+
+    def time_until_token(self) -> float:
+        return self.time_until(1)
+
+
+class Ticket:
+    """A waiting message (plus any messages coalesced into it, oldest first)."""
+    def __init__(self, guild_id: int, message, finish_tag: float):
+        self.guild_id = guild_id
+        self.messages = [message]
+        self.channel_id = message.channel.id
+        self.finish_tag = finish_tag # virtual finish time, for weighted fair queueing
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class GuildState:
+    def __init__(self, rate: float, burst: float, weight: float = 1.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.weight = weight
+        self.waiting = deque()
+        self.last_finish_tag = 0.0
+        self.last_notice = float("-inf")
+        # counters
+        self.admitted = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.shed = 0
+
+
+class AdmissionResult:
+    """decision: ADMITTED / COALESCED / SHED. messages: what to reply to when admitted (the last one gets the reply).
+    notify: the caller should tell the channel to slow down."""
+    def __init__(self, decision: str, messages: list = None, notify: bool = False):
+        self.decision = decision
+        self.messages = messages if messages else []
+        self.notify = notify
+
+
+class AdmissionController:
+    """
+    Per-server and global token buckets in front of process_ai_response.
+    Waiting tickets are released by weighted fair queueing: each ticket gets a virtual finish tag of 1/weight past its server's previous one,
+    and the dispatcher always releases the smallest tag whose server has a token.
+    """
+    def __init__(self, guild_rate: float = GUILD_RATE, guild_burst: float = GUILD_BURST, global_rate: float = GLOBAL_RATE,
+                 global_burst: float = GLOBAL_BURST, policy: str = COALESCE, max_waiting_per_guild: int = MAX_WAITING_PER_GUILD,
+                 max_waiting: int = MAX_WAITING, max_wait: float = MAX_WAIT):
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.policy = policy
+        self.max_waiting_per_guild = max_waiting_per_guild
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self._guilds = {}
+        self._waiting_guilds = set() # ids of the servers with waiting tickets
+        self._weights = {}
+        self._waiting = 0
+        self._virtual_time = 0.0
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+
+    def _guild(self, guild_id: int) -> GuildState:
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = GuildState(self.guild_rate, self.guild_burst, self._weights.get(guild_id, 1.0))
+        return guild
+
+    def set_weight(self, guild_id: int, weight: float):
+        """Relative share of the global bucket a server gets while servers are competing for it."""
+        self._weights[guild_id] = weight
+        if guild_id in self._guilds:
+            self._guilds[guild_id].weight = weight
+
+    async def admit(self, guild_id: int, message) -> AdmissionResult:
+        guild = self._guild(guild_id)
+        if not guild.waiting and not self._waiting and guild.bucket.has_token() and self.global_bucket.has_token(): # fast path, nobody is queued
+            guild.bucket.take()
+            self.global_bucket.take()
+            guild.admitted += 1
+            return AdmissionResult(ADMITTED, [message])
+        if self.policy == COALESCE:
+            for ticket in guild.waiting:
+                if ticket.channel_id == message.channel.id:
+                    ticket.messages.append(message)
+                    guild.coalesced += 1
+                    return AdmissionResult(COALESCED)
+        if self.policy == REJECT or len(guild.waiting) >= self.max_waiting_per_guild or self._waiting >= self.max_waiting:
+            return self._shed(guild)
+
+        ticket = Ticket(guild_id, message, max(self._virtual_time, guild.last_finish_tag) + 1 / guild.weight)
+        guild.last_finish_tag = ticket.finish_tag
+        guild.waiting.append(ticket)
+        self._waiting_guilds.add(guild_id)
+        guild.queued += 1
+        self._waiting += 1
+        self._wake_dispatcher()
+        try:
+            messages = await asyncio.wait_for(asyncio.shield(ticket.future), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            if ticket.future.done(): # released right as we timed out
+                messages = ticket.future.result()
+            else:
+                guild.waiting.remove(ticket)
+                if not guild.waiting:
+                    self._waiting_guilds.discard(guild_id)
+                self._waiting -= 1
+                ticket.future.cancel()
+                return self._shed(guild, len(ticket.messages))
+        guild.admitted += 1
+        return AdmissionResult(ADMITTED, messages)
+
+    def _shed(self, guild: GuildState, count: int = 1) -> AdmissionResult:
+        guild.shed += count
+        now = time.monotonic()
+        notify = now - guild.last_notice >= NOTICE_COOLDOWN
+        if notify:
+            guild.last_notice = now
+        return AdmissionResult(SHED, notify=notify)
+
+    def _wake_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        while self._waiting:
+            self._wakeup.clear()
+            waiting_guilds = [self._guilds[guild_id] for guild_id in self._waiting_guilds]
+            eligible = [guild for guild in waiting_guilds if guild.bucket.has_token()]
+            if eligible and self.global_bucket.has_token():
+                guild = min(eligible, key=lambda g: g.waiting[0].finish_tag)
+                ticket = guild.waiting.popleft()
+                if not guild.waiting:
+                    self._waiting_guilds.discard(ticket.guild_id)
+                self._waiting -= 1
+                guild.bucket.take()
+                self.global_bucket.take()
+                self._virtual_time = ticket.finish_tag
+                ticket.future.set_result(ticket.messages)
+                continue
+            delay = self.global_bucket.time_until_token()
+            if not eligible:
+                delay = max(delay, min(guild.bucket.time_until_token() for guild in waiting_guilds))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        guilds = self._guilds.values()
+        return {
+            "guilds": len(self._guilds),
+            "waiting": self._waiting,
+            "admitted": sum(guild.admitted for guild in guilds),
+            "queued": sum(guild.queued for guild in guilds),
+            "coalesced": sum(guild.coalesced for guild in guilds),
+            "shed": sum(guild.shed for guild in guilds),
+        }
+
+    def guild_stats(self, guild_id: int) -> dict:
+        guild = self._guild(guild_id)
+        return {"admitted": guild.admitted, "queued": guild.queued, "coalesced": guild.coalesced, "shed": guild.shed, "waiting": len(guild.waiting)}
+
+    def top_shed_guilds(self, count: int = 5) -> list:
+        """[(guild id, shed)] for the servers that lost the most messages."""
+        return sorted(((guild_id, guild.shed) for guild_id, guild in self._guilds.items() if guild.shed), key=lambda t: t[1], reverse=True)[:count]
+
+
+get_controller = services.accessor("admission", AdmissionController)
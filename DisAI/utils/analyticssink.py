@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError
+
+from utils import executors, services
+from utils.mongorepository import get_repository
+
+"""Buffered sink for analytics events. Events are written to their own collection in batches, instead of being pushed into the
+platform documents on every backup. Each event gets its _id when it's recorded, and a drained batch is spooled to disk until the
+insert succeeds: a batch retried after a failure or a restart only inserts what isn't there yet, so every event is stored exactly once."""
+
+# Constants
+COLLECTION = "analytics"
+SPOOL_PATH = "analytics_spool.json"
+FLUSH_INTERVAL = 60 # seconds between flushes
+FLUSH_SIZE = 500 # buffered events that trigger a flush right away
+WRITE_BATCH = 500 # events per insert_many
+MAX_BUFFERED = 20000 # events waiting to be written. more than that are dropped (and counted)
+DUPLICATE_KEY = 11000 # Mongo error code: the event was inserted by an earlier attempt
+
+logger = logging.getLogger(__name__)
+
+
+class AnalyticsSink:
+    """
+    record() only appends to the in-memory buffer. A flush drains the whole buffer at once (no await in between, so nothing recorded
+    meanwhile is lost or sent twice), adds it to the spooled events not yet written, saves the spool and inserts them in batches.
+    """
+    def __init__(self, path: str = SPOOL_PATH):
+        self.path = path
+        self._buffer = []
+        self._unsent = [] # drained and spooled, not yet confirmed written
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+        self.stats = {"recorded": 0, "written": 0, "duplicates": 0, "dropped": 0, "flushes": 0, "failed_flushes": 0}
+
+    async def start(self):
+        """Load the events spooled before the last shutdown and start flushing."""
+        try:
+            self._unsent = await executors.run_io(self._load)
+        except Exception as e:
+            logger.error(f"analytics spool load err: {e}")
+        if self._unsent:
+            logger.info(f"resuming {len(self._unsent)} unwritten analytics events")
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _load(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            events = json.load(f)
+        for event in events:
+            event['time'] = datetime.fromisoformat(event['time'])
+        return events
+
+    def _save(self, events: list):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(events, f, default=lambda value: value.isoformat())
+        os.replace(self.path + ".tmp", self.path)
+
+    def record(self, platform_id: int, event: int, time: datetime, value=None):
+        if len(self._buffer) + len(self._unsent) >= MAX_BUFFERED:
+            self.stats["dropped"] += 1
+            return
+        self._buffer.append({"_id": uuid.uuid4().hex, "platform_id": platform_id, "event": event, "time": time, "value": value})
+        self.stats["recorded"] += 1
+        if len(self._buffer) >= FLUSH_SIZE:
+            self._wake.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"analytics flush err: {e}")
+
+    async def flush(self):
+        async with self._lock:
+            batch, self._buffer = self._buffer, []
+            self._unsent.extend(batch)
+            if not self._unsent:
+                return
+            self.stats["flushes"] += 1
+            if batch:
+                await self._persist()
+            sent = 0
+            try:
+                while sent < len(self._unsent):
+                    await self._insert(self._unsent[sent:sent + WRITE_BATCH])
+                    sent += len(self._unsent[sent:sent + WRITE_BATCH])
+            except Exception as e:
+                self.stats["failed_flushes"] += 1
+                logger.error(f"analytics write err, {len(self._unsent) - sent} events kept for the next flush: {e}")
+            if sent:
+                del self._unsent[:sent]
+                await self._persist()
+
+    async def _persist(self):
+        # a spool that can't be saved shouldn't stop the insert: the events are still in _unsent
+        try:
+            await executors.run_io(self._save, list(self._unsent))
+        except Exception as e:
+            logger.error(f"analytics spool save err: {e}")
+
+    async def _insert(self, events: list):
+        try:
+            await get_repository().insert_many(COLLECTION, events, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(error['code'] != DUPLICATE_KEY for error in errors):
+                raise
+            self.stats["duplicates"] += len(errors)
+            self.stats["written"] += len(events) - len(errors)
+            return
+        self.stats["written"] += len(events)
+
+    async def close(self):
+        """Write what's buffered. Whatever doesn't make it stays in the spool for the next start."""
+        if self._task:
+            self._task.cancel()
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"analytics flush on shutdown err: {e}")
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "buffered": len(self._buffer), "unsent": len(self._unsent)}
+
+
+get_sink = services.accessor("analytics_sink", AnalyticsSink)
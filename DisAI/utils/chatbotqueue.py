@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+
+"""Per-chatbot request queue (an actor per chatbot). A chatbot works on one turn at a time, so its context is never mutated by two replies at once.
+Messages that arrive while a reply is being generated are merged into the next turn, so one completion answers the whole burst."""
+
+# Constants
+MAX_PENDING = 8 # messages waiting per chatbot. past this the oldest are shed
+LATENCY_SAMPLES = 1000 # recent request latencies kept for the percentile stats
+
+logger = logging.getLogger(__name__)
+
+stats = {
+    "requests": 0, # messages queued for a reply
+    "turns": 0, # completions actually run for them
+    "coalesced": 0, # messages merged into another message's turn
+    "shed": 0, # messages dropped because the queue was full
+}
+_latencies = deque(maxlen=LATENCY_SAMPLES) # seconds from queued to replied
+
+
+class ChatBotRequest:
+    """
+    A message one chatbot should reply to.
+    earlier: chatbots of the plan that come before this one in platform.chatbots. plan: the message's full (chatbot, should_respond) reply order.
+    wait_for: done events of the earlier chatbots' requests. the completion waits for them when the chatbot sees other bots.
+    """
+    def __init__(self, message, platform, plan: list, earlier: list, wait_for: list = None, make_buttons: bool = True):
+        self.message = message
+        self.platform = platform
+        self.plan = plan
+        self.earlier = earlier
+        self.wait_for = wait_for if wait_for else []
+        self.make_buttons = make_buttons
+        self.placeholder = None # loading message sent up front, if any
+        self.enqueued_at = time.perf_counter()
+        self.done = asyncio.Event() # set once the turn that handled this request is over (replied, coalesced or shed)
+
+
+class ChatBotQueue:
+    """Mailbox for one chatbot. The worker task only exists while there's something to do."""
+    def __init__(self, chatbot, max_pending: int = MAX_PENDING):
+        self._chatbot = weakref.ref(chatbot) # weak, or the queue would keep its own key alive in _queues
+        self.max_pending = max_pending
+        self.pending = deque()
+        self._lock = asyncio.Lock() # held for a whole turn
+        self._deferred = [] # context entries that arrived mid-turn
+        self._task = None
+
+    @property
+    def chatbot(self):
+        return self._chatbot()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked() or bool(self.pending)
+
+    def submit(self, request: ChatBotRequest, handler):
+        """Queue a request. handler(chatbot, batch) is awaited for each turn; batch is every request that was waiting, oldest first."""
+        stats["requests"] += 1
+        self.pending.append(request)
+        while len(self.pending) > self.max_pending: # backpressure: a flood only ever costs one turn of max_pending messages
+            shed = self.pending.popleft()
+            shed.done.set()
+            stats["shed"] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(handler))
+
+    def add_context(self, entry: dict):
+        """Append to the chatbot's context, or after the current turn if one is running (so it never lands inside a reply being streamed)."""
+        if self._lock.locked():
+            self._deferred.append(entry)
+        else:
+            self.chatbot.context.append(entry)
+
+    @asynccontextmanager
+    async def turn(self):
+        """Exclusive access to the chatbot's context. Regenerate/continue/delete, /converse and /forcemessage take it too."""
+        async with self._lock:
+            try:
+                yield
+            finally:
+                if self._deferred and self.chatbot is not None:
+                    self.chatbot.context.extend(self._deferred)
+                    self._deferred.clear()
+
+    async def _run(self, handler):
+        chatbot = self.chatbot
+        while self.pending and chatbot is not None:
+            async with self.turn():
+                batch = list(self.pending)
+                self.pending.clear()
+                stats["turns"] += 1
+                stats["coalesced"] += len(batch) - 1
+                try:
+                    await handler(chatbot, batch)
+                except Exception as e:
+                    logger.error(f"chatbot queue err {chatbot.name}: {type(e)} - {e}")
+                finally:
+                    now = time.perf_counter()
+                    for request in batch:
+                        _latencies.append(now - request.enqueued_at)
+                        request.done.set()
+
+
+_queues = weakref.WeakKeyDictionary() # chatbot -> ChatBotQueue. deleted chatbots drop out on their own
+
+def get_queue(chatbot) -> ChatBotQueue:
+    queue = _queues.get(chatbot)
+    if queue is None:
+        queue = _queues[chatbot] = ChatBotQueue(chatbot)
+    return queue
+
+def get_stats() -> dict:
+    latencies = sorted(_latencies)
+    return {
+        **stats,
+        "queues": len(_queues),
+        "pending": sum(len(queue.pending) for queue in _queues.values()),
+        "coalescing_ratio": (stats["requests"] - stats["shed"]) / stats["turns"] if stats["turns"] else 0, # messages answered per completion
+        "avg_latency": sum(latencies) / len(latencies) if latencies else 0,
+        "p95_latency": latencies[int(len(latencies) * 0.95)] if latencies else 0,
+    }
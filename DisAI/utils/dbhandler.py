@@ -1,30 +1,54 @@
-import pymongo
 import json
 import logging
+import time
 from datetime import datetime, timedelta
+
+import bson
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
 from core.ChatBot import ChatBot
 from core.Server import Server
 import utils.encrypt as encrypt
-from config import (MONGO_LINK, MONGO_NAME, PROMPT1NAME, PROMPT1VALUE, PROMPT2NAME, 
+from utils.mongorepository import get_repository
+from config import (PROMPT1NAME, PROMPT1VALUE, PROMPT2NAME, 
                     PROMPT2VALUE, PROMPT3NAME, PROMPT3VALUE, PROMPT4NAME, PROMPT4VALUE, 
                     PROMPT5NAME, PROMPT5VALUE, DEFAULTCREDITSAMOUNT)
 import asyncio
 
 # Constants
 SECONDS_DELAY = 45
+LOAD_TIMEOUT = 60 # seconds for the startup queries over every server
+BACKUP_BATCH = 100 # platform updates per bulk_write
+BACKUP_TIMEOUT = 60
+SETTINGS_FIELDS = {"last_interaction_date", "voting_channel_id", "adminroles", "prompts"} # tracked fields saved in the settings subdocument
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
-mongoclient = pymongo.MongoClient(MONGO_LINK)
-db = mongoclient[MONGO_NAME] # collection name
+backup_stats = {
+    "cycles": 0,
+    "documents": 0, # platform documents written, all cycles
+    "bytes": 0, # BSON size of the updates sent, all cycles
+    "failed": 0, # updates that didn't apply (retried next cycle)
+    "last_documents": 0,
+    "last_bytes": 0,
+    "last_skipped": 0, # unchanged platforms skipped in the last cycle
+    "last_duration": 0.0,
+}
 
 async def add_guilds_to_db(bot: ChatBot) -> None:
     """
     If a server joins while the bot is down, this function adds it to the database and to memory
     """
+    guild_ids = [guild.id for guild in bot.guilds]
+    try:
+        known_ids = {platform['_id'] for platform in await get_repository().find("platforms", {"_id": {"$in": guild_ids}}, {"_id": 1}, timeout=LOAD_TIMEOUT)}
+    except Exception as e:
+        logger.error(f"add guilds to db err: {e}")
+        return
     for guild in bot.guilds:
-        if not [gid for gid in db.platforms.find({"_id": guild.id})]:
+        if guild.id not in known_ids:
             try:
                 await add_guild_to_db(bot, guild)
             except Exception as e:
@@ -51,16 +75,17 @@ async def add_guild_to_db(bot: ChatBot, guild: Server) -> None:
         )
         bot.platforms[new_server.id] = new_server
         def_settings = await make_settings_dict(new_server)
-        db.platforms.insert_one({
+        await get_repository().insert_one("platforms", {
             "_id": guild.id,
             "name": guild.name,
             "settings": def_settings,
             "bots": [],
             'platform_type': "server",
             'credits': new_server.credits,
-            'analytics': new_server.analytics,
+            'analytics': [],
             'claimers': new_server.claimers,
             })
+        new_server.mark_clean()
     except Exception as e:
         logger.error(f"add guild to db err: {e}")
 
@@ -91,7 +116,7 @@ async def make_settings_dict(server: Server) -> dict:
 
 async def load_platform_to_memory(platform_id, bot_platforms):
     try:
-        platform = db.platforms.find_one({"_id": platform_id})
+        platform = await get_repository().find_one("platforms", {"_id": platform_id})
         if platform['platform_type'] == "server":
             newplatform = Server(
                 id=platform['_id'], 
@@ -117,19 +142,29 @@ async def load_platform_to_memory(platform_id, bot_platforms):
                 else:
                     our_model = "gpt-3.5-turbo"
                 nb = ChatBot(
-                    name=b['name'], channels=b['channels'], model=our_model, prompt=b['prompt'], temperature=b['temperature'], top_p=b['top_p'],
+                    name=b['name'], channels=set(b['channels']), model=our_model, prompt=b['prompt'], temperature=b['temperature'], top_p=b['top_p'],
                     presence_penalty=b['presence_penalty'], frequency_penalty=b['frequency_penalty'], include_usernames=b['include_usernames'],
                     long_term_memory=b['long_term_memory'], batch_number=b['batch_number'], should_make_buttons=b['should_make_buttons'],
                     last_message=None, data_name=b['data_name'], mention_mode=b['mention_mode'], web_search=b['web_search'],
-                    avatar_url=b['avatar_url'], lorebooks = b['lorebooks']
+                    avatar_url=b['avatar_url'], lorebooks = b['lorebooks'], sees_other_bots=b.get('sees_other_bots', True),
+                    ltm_archived=b.get('ltm_archived', 0), last_message_id=b.get('last_message_id')
                 ) 
                 try:
                     nb.context=json.loads(encrypt.decrypt_string(b['context'])) # Context is encrypted for privacy reasons (and because Discord wants you to encrypt it). Decrypt it.
                 except Exception as e:
                     logger.error("Decryption error. Resetting context.")
                     nb.context=[]
+                try:
+                    nb.ltm_pending=json.loads(encrypt.decrypt_string(b['ltm_pending'])) if 'ltm_pending' in b else []
+                except Exception as e:
+                    logger.error("Decryption error. Dropping pending long term memory.")
+                    nb.ltm_pending=[]
                 logger.info(f"\tChatbot: {nb.name}")
                 newplatform.chatbots.append(nb)
+        newplatform.chatbots_changed()
+        for chatbot in newplatform.chatbots: # in memory now matches the database, so the next backup skips them until they change
+            chatbot.mark_clean()
+        newplatform.mark_clean()
         return newplatform
     except Exception as e:
         logger.error(f"load platform to memory err: {e}")
@@ -141,7 +176,7 @@ async def load_database_to_memory(bot):
     try:
         bot.platforms.clear()
         current_guild_ids = [guild.id for guild in bot.guilds]
-        for platform in db.platforms.find():
+        for platform in await get_repository().find("platforms", {"_id": {"$in": current_guild_ids}}, {"_id": 1}, timeout=LOAD_TIMEOUT):
             try:
                 if platform['_id'] in current_guild_ids and platform['_id'] not in bot.platforms.keys():
                     await load_platform_to_memory(platform['_id'], bot.platforms)
@@ -151,30 +186,103 @@ async def load_database_to_memory(bot):
         logger.error(f"load db to mem err: {e}")
 
 async def backup_db(bot):
+    """Write what changed since the last backup: only platforms or chatbots marked dirty (see core/tracking), in bulk_write batches."""
     logger.info("Backup started")
     key = encrypt.generate_key()
     logger.info(key)
-    for server in bot.platforms.values():
-        await asyncio.sleep(0.01)
-        await set_platform(server)
-    logger.info("Backup finished")
+    tic = time.perf_counter()
+    pending = [] # (UpdateOne, size in bytes, done)
+    skipped = 0
+    for platform in list(bot.platforms.values()):
+        update = await make_platform_update(platform)
+        if update is None:
+            skipped += 1
+            continue
+        pending.append(update)
+        await asyncio.sleep(0) # serializing and encrypting contexts is CPU work. let replies run in between
+    documents = written_bytes = 0
+    for start in range(0, len(pending), BACKUP_BATCH):
+        batch = pending[start:start + BACKUP_BATCH]
+        failed = set(range(len(batch)))
+        try:
+            await get_repository().bulk_write("platforms", [request for request, _, _ in batch], ordered=False, timeout=BACKUP_TIMEOUT)
+            failed = set()
+        except BulkWriteError as e:
+            failed = {error['index'] for error in e.details.get('writeErrors', [])}
+        except Exception as e:
+            logger.error(f"backup batch err: {e}")
+        for i, (_, size, done) in enumerate(batch):
+            done(i not in failed)
+            if i not in failed:
+                documents += 1
+                written_bytes += size
+        backup_stats["failed"] += len(failed)
+    backup_stats["cycles"] += 1
+    backup_stats["documents"] += documents
+    backup_stats["bytes"] += written_bytes
+    backup_stats.update(last_documents=documents, last_bytes=written_bytes, last_skipped=skipped, last_duration=time.perf_counter() - tic)
+    logger.info(f"Backup finished: {documents} documents, {written_bytes} bytes, {skipped} unchanged platforms skipped")
+
+async def make_platform_update(platform):
+    """
+    (UpdateOne, size in bytes, done) bringing the platform's document up to date, or None if nothing changed. The dirty flags are cleared here, so
+    changes made while the write is in flight count for the next backup; done(applied) records the write or, if it failed, restores them.
+    """
+    dirty_bots = [chatbot for chatbot in platform.chatbots if chatbot.dirty]
+    if not platform.dirty and not dirty_bots:
+        return None
+    fields = set(platform.dirty_fields)
+    bots_state = [(chatbot, set(chatbot.dirty_fields), chatbot.saved_name) for chatbot in dirty_bots]
+    set_fields = {}
+    array_filters = []
+    if "name" in fields: # a new platform has every field dirty, so this writes the whole document
+        set_fields["name"] = platform.name
+        set_fields["platform_type"] = "server" if isinstance(platform, Server) else "user"
+    if "credits" in fields:
+        set_fields["credits"] = platform.credits
+    if "claimers" in fields:
+        set_fields["claimers"] = platform.claimers
+    if fields & SETTINGS_FIELDS:
+        set_fields["settings"] = await make_settings_dict(platform)
+    if "chatbots" in fields or any(chatbot.name != chatbot.saved_name for chatbot in dirty_bots): # added, removed or renamed
+        set_fields["bots"] = [await make_bot_dict(chatbot) for chatbot in platform.chatbots]
+    else: # only rewrite the chatbots that changed, matched by name
+        for i, chatbot in enumerate(dirty_bots):
+            set_fields[f"bots.$[b{i}]"] = await make_bot_dict(chatbot)
+            array_filters.append({f"b{i}.name": chatbot.saved_name})
+    platform.mark_clean()
+    for chatbot in dirty_bots:
+        chatbot.mark_clean()
+    if not set_fields:
+        return None
+
+    def done(applied):
+        if applied:
+            return
+        for field in fields:
+            platform.mark_dirty(field)
+        for chatbot, bot_fields, saved_name in bots_state:
+            for field in bot_fields:
+                chatbot.mark_dirty(field)
+            chatbot.saved_name = saved_name
+
+    update = {"$set": set_fields}
+    return UpdateOne({"_id": platform.id}, update, upsert=True, array_filters=array_filters if array_filters else None), len(bson.encode(update)), done
             
 async def set_platform(platform):
     def_settings = await make_settings_dict(platform)
     botlist = [await make_bot_dict(chatbot) for chatbot in platform.chatbots]
     platform_type = "server" if isinstance(platform, Server) else "user"
     try:
-        db.platforms.update_one({"_id": platform.id}, {"$set": {
+        update = {"$set": {
                     "_id": platform.id,
                     "name": platform.name,
                     "settings": def_settings,
                     "bots": botlist,
                     'platform_type': platform_type,
                     "credits": platform.credits,
-                    'claimers': platform.claimers}}, upsert=True)
-        for analytic in platform.analytics:
-            db.platforms.update_one({"_id": platform.id}, {"$push": {
-                'analytics': analytic}})
+                    'claimers': platform.claimers}} # analytics are written by utils/analyticssink
+        await get_repository().update_one("platforms", {"_id": platform.id}, update, upsert=True)
     except Exception as e:
         logger.error(f"set platform err: {e}")
     
@@ -182,7 +290,7 @@ async def make_bot_dict(chatbot):
     # given a ChatBot, format it into a dictionary for export to the database
     return {
         'name': chatbot.name,
-        "channels": chatbot.channels,
+        "channels": list(chatbot.channels),
         'model': chatbot.model,
         "prompt": chatbot.prompt,
         "temperature": chatbot.temperature,
@@ -198,11 +306,15 @@ async def make_bot_dict(chatbot):
         "web_search":chatbot.web_search,
         "context": encrypt.encrypt_string(json.dumps(list(chatbot.context))),
         "avatar_url" : chatbot.avatar_url,
-        "lorebooks": chatbot.lorebooks
+        "lorebooks": chatbot.lorebooks,
+        "sees_other_bots": chatbot.sees_other_bots,
+        "ltm_archived": chatbot.ltm_archived,
+        "last_message_id": chatbot.last_message_id,
+        "ltm_pending": encrypt.encrypt_string(json.dumps(list(chatbot.ltm_pending)))
         }
     
 async def add_cb_to_db(platform_id, dict):
-    db.platforms.update_one({"_id": platform_id}, {"$push": {"bots": dict}})
+    await get_repository().update_one("platforms", {"_id": platform_id}, {"$push": {"bots": dict}})
     
 async def get_cb(name, chatbots):
     """
@@ -215,9 +327,19 @@ async def get_cb(name, chatbots):
     return None
 
 async def remove_cb_from_db(guildid, botname):
-    db.platforms.update_one({"_id": guildid}, {"$pull": {"bots": {"name": botname}}})
+    await get_repository().update_one("platforms", {"_id": guildid}, {"$pull": {"bots": {"name": botname}}})
     
 async def change_cb_setting_in_db(guildid, botname, setting, newvalue):
-    db.platforms.update_one({"_id": guildid, "bots": { "$elemMatch": { "name": botname } }}, {"$set": { f"bots.$.{setting}": newvalue } })
+    await get_repository().update_one("platforms", {"_id": guildid, "bots": { "$elemMatch": { "name": botname } }}, {"$set": { f"bots.$.{setting}": newvalue } })
+
+async def get_jobs():
+    """Ingestion job records (see utils/jobscheduler) that haven't finished."""
+    return await get_repository().find("jobs")
+
+async def save_job(job_dict):
+    await get_repository().replace_one("jobs", {"_id": job_dict["_id"]}, job_dict, upsert=True)
+
+async def delete_job(job_id):
+    await get_repository().delete_one("jobs", {"_id": job_id})
 
 # use mongo cleint to add the sample stuffs
\ No newline at end of file
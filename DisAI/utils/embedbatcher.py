@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from collections import Counter
+
+"""Micro-batching for small embedding requests. Retrievals from different servers that arrive within a few milliseconds of each other
+share one embeddings API call instead of sending one single-text request each, which cuts per-request overhead and rate limit pressure."""
+
+# Constants
+MAX_WAIT = 0.005 # seconds the first request of a batch waits for others
+MAX_ITEMS = 64 # texts per batch. a batch this full is sent right away
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64) # batch size histogram bounds
+
+logger = logging.getLogger(__name__)
+
+
+def size_bucket(size: int) -> str:
+    low = 1
+    for high in SIZE_BUCKETS:
+        if size <= high:
+            return f"{low}-{high}" if low != high else str(high)
+        low = high + 1
+    return f"{low}+"
+
+
+def _checked(texts: list, vectors: list) -> list:
+    """vectors, if there's one per text. Otherwise the request can't be matched up and fails."""
+    if len(vectors) != len(texts):
+        raise ValueError(f"got {len(vectors)} embeddings for {len(texts)} texts")
+    return vectors
+
+
+class EmbeddingBatcher:
+    """
+    send(texts) is an async function returning one vector per text, in order. embed(texts) waits for the batch it joins and gets its
+    own vectors back. Texts asked for by several callers in the same batch are sent once. If a merged batch fails, each request is
+    retried on its own, so one bad input only fails the request it came from.
+    """
+    def __init__(self, send, max_wait: float = MAX_WAIT, max_items: int = MAX_ITEMS):
+        self.send = send
+        self.max_wait = max_wait
+        self.max_items = max_items
+        self._pending = [] # (texts, future)
+        self._pending_texts = {} # text -> None, unique texts of _pending in order
+        self._timer = None
+        self._tasks = set() # batches being sent. the loop only keeps weak references to tasks
+        self.stats = {"requests": 0, "batches": 0, "texts": 0, "failed_batches": 0, "split_retries": 0, "failed_requests": 0}
+        self.sizes = Counter() # size bucket -> batches
+
+    async def embed(self, texts: list) -> list:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((texts, future))
+        self._pending_texts.update(dict.fromkeys(texts))
+        self.stats["requests"] += 1
+        if len(self._pending_texts) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await asyncio.shield(future) # a caller timing out mustn't cancel the batch for the others
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, texts = self._pending, list(self._pending_texts)
+        self._pending, self._pending_texts = [], {}
+        task = asyncio.create_task(self._send(pending, texts))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pending: list, texts: list):
+        self.stats["batches"] += 1
+        self.stats["texts"] += len(texts)
+        self.sizes[size_bucket(len(texts))] += 1
+        try:
+            vectors = dict(zip(texts, _checked(texts, await self.send(texts))))
+        except Exception as e:
+            self.stats["failed_batches"] += 1
+            logger.error(f"embedding batch err ({len(texts)} texts, {len(pending)} requests): {e}")
+            if len(pending) == 1:
+                self._fail(pending[0][1], e)
+                return
+            self.stats["split_retries"] += 1
+            await asyncio.gather(*(self._send_alone(request_texts, future) for request_texts, future in pending))
+            return
+        for request_texts, future in pending:
+            if not future.done():
+                future.set_result([vectors[text] for text in request_texts])
+
+    async def _send_alone(self, texts: list, future):
+        try:
+            vectors = _checked(texts, await self.send(texts))
+        except Exception as e:
+            self._fail(future, e)
+            return
+        if not future.done():
+            future.set_result(vectors)
+
+    def _fail(self, future, error: Exception):
+        self.stats["failed_requests"] += 1
+        if not future.done():
+            future.set_exception(error)
+
+    def get_stats(self) -> dict:
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "avg_batch_size": self.stats["texts"] / batches if batches else 0,
+            "sizes": {bucket: self.sizes[bucket] for bucket in sorted(self.sizes, key=lambda bucket: int(bucket.split('-')[0].rstrip('+')))},
+        }
@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from utils import executors, services
+
+"""Content addressed embedding cache, keyed by (model, sha256(text)). An in-memory LRU sits in front of a SQLite file, so regenerate/continue,
+repeated questions and re-uploaded lorebooks don't pay for the same embedding twice, even across restarts."""
+
+# Constants
+CACHE_PATH = "embeddings.db"
+MEMORY_ENTRIES = 4000 # ~6 KB each for ada-002 (1536 float32s)
+DISK_ENTRIES = 100000 # ~600 MB
+MAX_AGE = 30 * 24 * 3600 # seconds since last use before an entry is evicted from disk
+EVICT_FRACTION = 0.1 # when the disk store is full, drop this share of the least recently used entries
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(model: str, text: str) -> str:
+    return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+
+class EmbeddingCache:
+    """
+    get_many/put_many are async; the SQLite side runs in the I/O pool.
+    Vectors are kept as float32 arrays (in memory and on disk) and handed out as lists of floats.
+    """
+    def __init__(self, path: str = CACHE_PATH, memory_entries: int = MEMORY_ENTRIES, disk_entries: int = DISK_ENTRIES, max_age: float = MAX_AGE):
+        self.path = path
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.max_age = max_age
+        self._memory = OrderedDict() # key -> array('f')
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._disk_count = None
+        # counters
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._db.execute("DELETE FROM embeddings WHERE last_used < ?", (time.time() - self.max_age,))
+            self._db.commit()
+            self._disk_count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self._db
+
+    def _remember(self, key: str, vector: array):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    async def get_many(self, model: str, texts: list) -> list:
+        """Returns one vector (list of floats) or None per text."""
+        keys = [make_key(model, text) for text in texts]
+        found = {}
+        for key in keys:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                found[key] = vector
+        self.memory_hits += sum(1 for key in keys if key in found)
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            try:
+                from_disk = await executors.run_io(self._read, missing)
+            except Exception as e:
+                logger.error(f"embedding cache read err: {e}")
+                from_disk = {}
+            for key, vector in from_disk.items():
+                self._remember(key, vector)
+                found[key] = vector
+            self.disk_hits += len([key for key in keys if key in from_disk])
+            self.misses += len([key for key in keys if key not in found])
+        return [found[key].tolist() if key in found else None for key in keys]
+
+    async def put_many(self, model: str, texts: list, vectors: list):
+        rows = {}
+        for text, vector in zip(texts, vectors):
+            key = make_key(model, text)
+            packed = array('f', vector)
+            self._remember(key, packed)
+            rows[key] = packed
+        try:
+            await executors.run_io(self._write, rows)
+        except Exception as e:
+            logger.error(f"embedding cache write err: {e}")
+
+    def _read(self, keys: list) -> dict:
+        with self._db_lock:
+            db = self._connect()
+            found = {}
+            for start in range(0, len(keys), 500): # SQLite caps the number of ? parameters
+                chunk = keys[start:start + 500]
+                rows = db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, blob in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    found[key] = vector
+            if found:
+                db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+                db.commit()
+            return found
+
+    def _write(self, rows: dict):
+        with self._db_lock:
+            db = self._connect()
+            now = time.time()
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                           [(key, vector.tobytes(), now) for key, vector in rows.items()])
+            self._disk_count += db.total_changes - before
+            if self._disk_count > self.disk_entries:
+                evict = max(1, int(self.disk_entries * EVICT_FRACTION)) + self._disk_count - self.disk_entries
+                db.execute("DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (evict,))
+                self._disk_count -= evict
+                self.evictions += evict
+            db.commit()
+
+    def close(self):
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "disk_entries": self._disk_count or 0,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0,
+            "evictions": self.evictions,
+        }
+
+
+get_cache = services.accessor("embedding_cache", EmbeddingCache)
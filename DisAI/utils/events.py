@@ -15,21 +15,18 @@ from PIL.ExifTags import TAGS
 import discord
 import aiohttp
 from bs4 import BeautifulSoup
-import PyPDF2
 import topgg
 from youtube_transcript_api import YouTubeTranscriptApi
 from typing import Optional
-from pathlib import Path
 import logging
 
-from utils import dbhandler
+from utils import chatbotqueue, dbhandler, executors, httphandler, jobscheduler, ltmarchiver, pdfextract, responseindex
 import utils.encrypt as encrypt
 from utils.messagehandler import process_ai_response, handle_gpt_response
-from utils.pineconehandler import upsert_data, delete_namespace
-from extensions.uiactions import PromptJailbreakButton
+from utils.pineconehandler import IngestionIncomplete, upsert_data, delete_namespace
+from extensions.uiactions import CancelJobView, PromptJailbreakButton
 from extensions.helpers import (
     send_error_message,
-    has_time_passed,
     make_inviteview,
     get_platform,
     update_analytics,
@@ -80,12 +77,15 @@ LOREBOOK_WAITING = "lorebook"
 TAVERN_WAITING = "Tavern"
 LONG_PROMPT_WAITING = "Long Prompt"
 DATA_WAITING = "data"
+LOREBOOK_JOB = "lorebook"
+VIDEO_JOB = "video"
+PDF_JOB = "pdf"
 CLAIM_COMMAND = "/claim"
 
 REGENERATE_EMOJI = '🔃'
 CONTINUE_EMOJI = '⏩'
 DELETE_EMOJI = '🗑️'
-WEBHOOK_NAME = "Dis.AI Webhook"
+CONTROL_EMOJIS = (REGENERATE_EMOJI, CONTINUE_EMOJI, DELETE_EMOJI)
 logger = logging.getLogger(__name__)
 
 async def convert_seconds_to_timestamp(seconds: int) -> str:
@@ -143,44 +143,49 @@ def check_for_youtube_link(message_content: str) -> Optional[str]:
 async def get_video_title(video_id: str) -> str:
     """Get the title of a YouTube video."""
     url = f"https://www.googleapis.com/youtube/v3/videos?id={video_id}&key={YOUTUBE_API_KEY}&part=snippet"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            data = await response.json()
-            if "items" in data and data["items"]:
-                return data["items"][0]["snippet"]["title"]
-            else:
-                return ""
+    session = await httphandler.get_session()
+    async with session.get(url) as response:
+        data = await response.json()
+        if "items" in data and data["items"]:
+            return data["items"][0]["snippet"]["title"]
+        else:
+            return ""
 
 
-async def download_pdf(url: str, file_name: str) -> str:
-    """Download a PDF and extract its text."""
+async def download_pdf(url: str):
+    """Download a PDF into memory. Returns its bytes, -1 if it's bigger than MAX_FILE_SIZE_MB, or b"" if the download failed."""
+    max_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
     try:
-        return await handle_pdf_download(url, file_name)
+        session = await httphandler.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                return b""
+            if response.content_length and response.content_length > max_bytes: # checked before downloading anything
+                return -1
+            pdf_data = bytearray()
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                pdf_data += chunk
+                if len(pdf_data) > max_bytes: # no (or a wrong) Content-Length
+                    return -1
+            return bytes(pdf_data)
     except Exception as error:
         logging.error(f"dl pdf err: {error}")
-        return ""
+        return b""
 
-
-async def handle_pdf_download(url: str, file_name: str) -> str:
-    """Handle the PDF download process."""
-    text_w_pages = {}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                pdf_data = await response.read()  # Read response content as bytes
-                file_path = Path(f"pdfs/{file_name}.txt")
-                file_path.write_bytes(pdf_data)
-                pdf_reader = PyPDF2.PdfReader(file_path.open('rb'))
-                file_size = file_path.stat().st_size
-                num_pages = len(pdf_reader.pages)
-                if file_size / (1024 * 1024) > MAX_FILE_SIZE_MB or num_pages > MAX_PAGES:
-                    return -1
-                text = ''
-                for page_num in range(num_pages):
-                    await asyncio.sleep(0)  # so the bot can do other stuff
-                    page = pdf_reader.pages[page_num]
-                    text_w_pages[page_num] = page.extract_text().replace('\n', '')
-                return text_w_pages
+async def iter_pdf_pages(pdf_data: bytes, num_pages: int):
+    """
+    Yields (page number, text) in page order. Page ranges are extracted in parallel in the process pool,
+    and each page is yielded as soon as it and every page before it are done.
+    """
+    ranges = pdfextract.split_pages(num_pages, executors.get_service().process.max_workers)
+    tasks = [asyncio.ensure_future(executors.run_process(pdfextract.extract_pages, pdf_data, start, end)) for start, end in ranges]
+    try:
+        for task in tasks:
+            for page, text in await task:
+                yield page, text
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 
@@ -205,6 +210,9 @@ async def on_ready(bot):
         await dbhandler.load_database_to_memory(bot)
         toc = perf_counter()
         logger.info(f"Loaded database to memory in {toc - tic:0.4f} seconds")
+        bot.ltm_archiver.resume(bot.platforms) # messages evicted before the last backup but not archived yet
+        register_ingestion_jobs(bot.jobs)
+        await bot.jobs.start(bot) # needs the platforms loaded, to resume unfinished uploads
         try: # send a message to the status channel in the support server
             support_server = await bot.fetch_guild(SUPPORT_SERVER_ID)
             status_channel = await support_server.fetch_channel(STATUS_CHANNEL_ID)
@@ -254,9 +262,7 @@ async def on_message(bot, message):
 
         
         platform = await get_platform(bot.platforms, None, -1, message.guild.id) # get the platform for this guild
-        if not has_time_passed(platform.last_interaction_date, 2): # effecitvely a 2 second cooldown
-            return
-
+        # no cooldown here: replies are rate limited per server by utils/admission and bursts are merged per chatbot by utils/chatbotqueue
         now = datetime.now()
         platform.last_interaction_date = now
 
@@ -304,18 +310,20 @@ async def handle_waiting_for(platform, message):
         handler = handle_lorebook_waiting_for
     else:
         handler = handlers.get(platform.waiting_for)
-    if handler:
-        await handler(platform, message)
-    platform.current_cb = None
-    platform.waiting_for = None
+    try:
+        if handler:
+            await handler(platform, message)
+    finally:
+        platform.current_cb = None
+        platform.waiting_for = None
 
 async def extract_text_from_url(url):
     """Extracts the raw text data from a url."""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                response.raise_for_status()  # Raise an exception if the request was not successful
-                return await response.text()
+        session = await httphandler.get_session()
+        async with session.get(url) as response:
+            response.raise_for_status()  # Raise an exception if the request was not successful
+            return await response.text()
     except aiohttp.ClientError as e:
         print(f"An error occurred: {e}")
         return None
@@ -331,51 +339,122 @@ async def handle_lorebook_waiting_for(platform, message):
         
 async def handle_lorebook_rentry(platform, message):
     """Handles Lorebook rentry.org links."""
-    try:
-        url = message.content
-        rentry_index = url.find('rentry.org')
-        # first, make sure the url is in the form https://rentry.org/blahblahblah/raw
-        if not url.startswith("https://"):
-            url = url[rentry_index:]
-            url = "https://" + url
-        if not url.endswith("/raw") and url[-1] == '/': # add /raw if it's not there
-            url = url + "raw"
-        elif not url.endswith("/raw") and url[-1] != '/': # in case there's no '/' at the end   
-            url = url + "/raw"
-            
-        text = await extract_text_from_url(url)
-        lines = text.split('\n')
-        chunked_text = [line for line in lines if line.strip() != ''] # get rid of empty lines
-        lorebook_name = platform.waiting_for[platform.waiting_for.find(":") + 1:].strip() # get the lorebook name from the waiting_for string, which is in the form "lorebook:lorebook_name"
-        embed = discord.Embed(title="Lorebook Creation", description=f"Creating lorebook: {lorebook_name}", color=discord.Color.blue())
-        message_to_edit = await message.channel.send(embed=embed) 
-        data = [{'role': 'entry', 'content': line} for line in chunked_text]
-        await upsert_data(data, f"{platform.id}-{platform.current_cb.name}-{lorebook_name}", 0, 2, 2, batch_size=100, type="lorebook", message_to_edit=message_to_edit)
-        platform.current_cb.lorebooks.append(lorebook_name)
-        embed=discord.Embed(title=f"Lorebook: {lorebook_name}", description="Lorebook created!", color=discord.Color.blue())
-        await message_to_edit.edit(embed=embed)
-        
-    except Exception as e:
-        print(e)
-        await send_error_message("Invalid Rentry link. Try again from `/settings` with a valid link", message)
+    url = message.content
+    rentry_index = url.find('rentry.org')
+    # first, make sure the url is in the form https://rentry.org/blahblahblah/raw
+    if not url.startswith("https://"):
+        url = url[rentry_index:]
+        url = "https://" + url
+    if not url.endswith("/raw") and url[-1] == '/': # add /raw if it's not there
+        url = url + "raw"
+    elif not url.endswith("/raw") and url[-1] != '/': # in case there's no '/' at the end   
+        url = url + "/raw"
+    await enqueue_lorebook(platform, message, url)
 
 async def handle_lorebook_txt(platform, message):
+    await enqueue_lorebook(platform, message, message.attachments[0].url)
+
+async def enqueue_lorebook(platform, message, url):
+    lorebook_name = platform.waiting_for[platform.waiting_for.find(":") + 1:].strip() # get the lorebook name from the waiting_for string, which is in the form "lorebook:lorebook_name"
+    embed = discord.Embed(title="Lorebook Creation", description=f"Creating lorebook: {lorebook_name}", color=discord.Color.blue())
+    await enqueue_ingestion(platform, message, LOREBOOK_JOB, url, lorebook_name, f"{platform.id}-{platform.current_cb.name}-{lorebook_name}", 0, jobscheduler.HIGH, embed)
+
+async def enqueue_ingestion(platform, message, kind, source, name, namespace, batch_number, priority, embed):
+    """Queue an ingestion job for platform.current_cb. Its progress message (with a cancel button) is sent right away and updated by the job."""
+    scheduler = jobscheduler.get_scheduler()
+    job = jobscheduler.Job(kind, platform.id, platform.current_cb.name, message.channel.id, None, message.author.id, source, name, namespace,
+                           batch_number=batch_number, priority=priority)
+    message_to_edit = await message.channel.send(embed=embed, view=CancelJobView(platform, job.id))
+    job.message_id = message_to_edit.id
+    try:
+        submitted = await scheduler.submit(job, message_to_edit)
+    except Exception as e: # the job record couldn't be saved, so there's no job to cancel
+        logger.error(f"submit job err ({kind}, {namespace}): {e}")
+        await message_to_edit.edit(embed=discord.Embed(title="Error", description="Couldn't start this upload. Please try again later.", color=discord.Colour.red()), view=None)
+        return
+    if not submitted:
+        await message_to_edit.edit(embed=discord.Embed(title="Error", description=f"This server already has {scheduler.max_queued_per_guild} uploads waiting. Try again once they're done.", color=discord.Colour.red()), view=None)
+
+async def get_job_chatbot(job, platform):
+    chatbot = await dbhandler.get_cb(job.chatbot_name, platform.chatbots)
+    if chatbot is None:
+        raise jobscheduler.JobError(f"{job.chatbot_name} no longer exists.")
+    return chatbot
+
+async def upsert_job_data(job, data, *args, **kwargs):
+    """upsert_data for an ingestion job, from the job's offset. Windows that couldn't be stored fail the job."""
     try:
-        text = await message.attachments[0].read()
-        text = text.decode('utf-8')
-        lines = text.split('\n')
-        chunked_text = [line for line in lines if line.strip() != ''] # get rid of empty lines
-        lorebook_name = platform.waiting_for[platform.waiting_for.find(":") + 1:].strip() # get the lorebook name from the waiting_for string, which is in the form "lorebook:lorebook_name"
-        embed = discord.Embed(title="Lorebook Creation", description=f"Creating lorebook: {lorebook_name}", color=discord.Color.blue())
-        message_to_edit = await message.channel.send(embed=embed) 
-        data = [{'role': 'entry', 'content': line} for line in chunked_text]
-        await upsert_data(data, f"{platform.id}-{platform.current_cb.name}-{lorebook_name}", 0, 2, 2, batch_size=100, type="lorebook", message_to_edit=message_to_edit)
-        platform.current_cb.lorebooks.append(lorebook_name)
-        embed=discord.Embed(title=f"Lorebook: {lorebook_name}", description="Lorebook created!", color=discord.Color.blue())
-        await message_to_edit.edit(embed=embed)
+        await upsert_data(data, job.namespace, *args, start=job.offset, **kwargs)
+    except IngestionIncomplete as e:
+        raise jobscheduler.JobError(f"{e.dropped} of {e.total} parts of {job.name} couldn't be stored. Please try again from `/settings`.")
+
+async def run_lorebook_job(job, platform, message_to_edit, on_progress):
+    """Ingestion job: downloads a lorebook (rentry.org raw page or .txt attachment) and stores it, one entry per line."""
+    chatbot = await get_job_chatbot(job, platform)
+    text = await extract_text_from_url(job.source)
+    if not text:
+        raise jobscheduler.JobError("Invalid Rentry link. Try again from `/settings` with a valid link")
+    chunked_text = [line for line in text.split('\n') if line.strip() != ''] # get rid of empty lines
+    data = [{'role': 'entry', 'content': line} for line in chunked_text]
+    await upsert_job_data(job, data, 0, 2, 2, batch_size=100, type="lorebook", message_to_edit=message_to_edit, on_progress=on_progress)
+    if job.name not in chatbot.lorebooks:
+        chatbot.lorebooks.append(job.name)
+    if message_to_edit:
+        embed=discord.Embed(title=f"Lorebook: {job.name}", description="Lorebook created!", color=discord.Color.blue())
+        await message_to_edit.edit(embed=embed, view=None)
+
+async def run_video_job(job, platform, message_to_edit, on_progress):
+    """Ingestion job: stores a YouTube video's transcript as the chatbot's data."""
+    chatbot = await get_job_chatbot(job, platform)
+    transcript = await executors.run_io(YouTubeTranscriptApi.get_transcript, job.source)
+    data = [{'location': await convert_seconds_to_timestamp(int(line['start'])), 'content': line['text']} for line in transcript] # data is a {'location', 'content'} dict
+    if not job.offset: # a resumed job already deleted the old data (and stored some of the new)
+        await delete_namespace(job.namespace) # delete any old data in pinecone.
+    title = await get_video_title(job.source)
+    data_name = f"YouTube Video - '{title[:120]}'"
+    await upsert_job_data(job, data, job.batch_number, window=YOUTUBE_VIDEO_WINDOW, stride=YOUTUBE_VIDEO_STRIDE, batch_size=100, type="Video",
+                          message_to_edit=message_to_edit, on_progress=on_progress)
+    chatbot.data_name = data_name
+    if message_to_edit:
+        await message_to_edit.edit(embed=create_video_stored_embed(data_name, chatbot, platform), view=None)
+
+async def run_pdf_job(job, platform, message_to_edit, on_progress):
+    """Ingestion job: stores a PDF's text as the chatbot's data."""
+    chatbot = await get_job_chatbot(job, platform)
+    too_big = jobscheduler.JobError(f"PDFs must be fewer than 1000 pages and less than 25 MB.")
+    no_text = jobscheduler.JobError(f"{job.name}' either contains no text or failed to process. \nTry again from `/settings`")
+    pdf_data = await download_pdf(job.source)
+    if pdf_data == -1:
+        raise too_big
+    try:
+        num_pages = await executors.run_process(pdfextract.count_pages, pdf_data) if pdf_data else 0
     except Exception as e:
-        print(e)
-        await send_error_message("Invalid Rentry link. Try again from `/settings` with a valid link", message)
+        logging.error(f"pdf parse err: {e}")
+        raise no_text
+    if num_pages > MAX_PAGES:
+        raise too_big
+    data = []
+    try:
+        async for page, text in iter_pdf_pages(pdf_data, num_pages): # chunk pages as they're extracted
+            for i in range(0, len(text), PDF_CHUNK_LENGTH):
+                data.append({'location': page, 'content': text[i:i+PDF_CHUNK_LENGTH]})
+    except Exception as e:
+        logging.error(f"pdf extract err: {e}")
+        raise no_text
+    if not data:
+        raise no_text
+    if not job.offset:
+        await delete_namespace(job.namespace)
+    await upsert_job_data(job, data, job.batch_number, window=PDF_WINDOW, stride=PDF_STRIDE, batch_size=100, type="PDF",
+                          message_to_edit=message_to_edit, on_progress=on_progress)
+    chatbot.data_name = job.name
+    if message_to_edit:
+        await message_to_edit.edit(embed=create_pdf_stored_embed(job.name, chatbot, platform), view=None)
+
+def register_ingestion_jobs(scheduler):
+    scheduler.register(LOREBOOK_JOB, run_lorebook_job)
+    scheduler.register(VIDEO_JOB, run_video_job)
+    scheduler.register(PDF_JOB, run_pdf_job)
     
 async def handle_tavern_waiting_for(platform, message):
     """Handles Tavern waiting for events."""
@@ -407,28 +486,29 @@ async def handle_tavern_png(platform, message):
     """Handles TavernAI PNG files."""
     try:
         link = message.content if message.content.endswith(PNG_EXTENSION) else message.attachments[0].url
-        async with aiohttp.ClientSession() as session:
-            async with session.get(link) as response:
-                # read the png file and get the prompt from the metadata
-                png_file = await response.read()
-                image = Image.open(io.BytesIO(png_file))
-                exif_data = image.getexif()
-                prompt = base64.b64decode(image.info['chara']).decode("utf-8", errors="ignore")
-                
-                # start formatting the prompt and create the chatbot
-                prompt = replace_strings(prompt, platform, message)
-                prompt += "\n\n<START>\n"
-                prompt = main_prompt + prompt
-                platform.current_cb.prompt = prompt
-                platform.current_cb.context.clear()
-                platform.current_cb.avatar_url = link
-                await dbhandler.add_cb_to_db(platform.id, await dbhandler.make_bot_dict(platform.current_cb))
-                platform.chatbots.append(platform.current_cb)
-                platform.current_cb.context.clear()
-                embed = create_tavern_chatbot_embed(platform.current_cb)
-                view = make_inviteview()
-                view.add_item(PromptJailbreakButton(platform, platform.current_cb))
-                await message.channel.send(embed=embed, view=view)
+        session = await httphandler.get_session()
+        async with session.get(link) as response:
+            # read the png file and get the prompt from the metadata
+            png_file = await response.read()
+            image = Image.open(io.BytesIO(png_file))
+            exif_data = image.getexif()
+            prompt = base64.b64decode(image.info['chara']).decode("utf-8", errors="ignore")
+            
+            # start formatting the prompt and create the chatbot
+            prompt = replace_strings(prompt, platform, message)
+            prompt += "\n\n<START>\n"
+            prompt = main_prompt + prompt
+            platform.current_cb.prompt = prompt
+            platform.current_cb.context.clear()
+            platform.current_cb.avatar_url = link
+            await dbhandler.add_cb_to_db(platform.id, await dbhandler.make_bot_dict(platform.current_cb))
+            platform.chatbots.append(platform.current_cb)
+            platform.chatbots_changed()
+            platform.current_cb.context.clear()
+            embed = create_tavern_chatbot_embed(platform.current_cb)
+            view = make_inviteview()
+            view.add_item(PromptJailbreakButton(platform, platform.current_cb))
+            await message.channel.send(embed=embed, view=view)
     except Exception as e:
         logging.error(f"process png err: {e}")
         await send_error_message("Invalid TavernAI PNG file. Try again from `/create` with a valid file\nYou can also upload .json files.", message)
@@ -451,6 +531,7 @@ async def handle_tavern_json(platform, message):
         platform.current_cb.prompt = prompt
         await dbhandler.add_cb_to_db(platform.id, await dbhandler.make_bot_dict(platform.current_cb))
         platform.chatbots.append(platform.current_cb)
+        platform.chatbots_changed()
         platform.current_cb.context.clear()
         embed = create_tavern_chatbot_embed(platform.current_cb)
         view = make_inviteview()
@@ -477,6 +558,7 @@ async def handle_long_prompt_waiting_for(platform, message):
             embed = discord.Embed(title=f"Set Prompt for {platform.current_cb.name}", description=f"Prompt name:\n{promptname}", color=discord.Colour.blue())
             await message.channel.send(embed=embed)
             try:
+                ltmarchiver.get_archiver().discard(platform.current_cb)
                 await delete_namespace(f"{platform.id}-{platform.current_cb.name}")
                 await delete_namespace(f"{platform.id}-{platform.current_cb.name}-data")
             except:
@@ -490,62 +572,20 @@ async def handle_long_prompt_waiting_for(platform, message):
     platform.current_cb = None
 
 async def handle_data_waiting_for(platform, message):
-    """Handle platform waiting_for event. (ie., user is uploading a tavern prompt, long prompt, YouTube/PDF, or lorebook)"""
-    data = []
-    texts = ""
-    youtube_video_id = check_for_youtube_link(message.content)
-    if youtube_video_id:
-        embed_message = await message.channel.send(embed=create_processing_video_embed())
-        try:
-            transcript = YouTubeTranscriptApi.get_transcript(youtube_video_id)
-            texts = [x['text'] for x in transcript] # transcript text
-            for i in range(len(texts)):
-                data.append({'location': await convert_seconds_to_timestamp(int(transcript[i]['start'])), 'content': texts[i]}) # data is a {'location', 'content'} dict
-            try:
-                await delete_namespace(f"{platform.id}-{platform.current_cb.name}-data") # delete any old data in pinecone.
-            except:
-                pass
-            title = await get_video_title(youtube_video_id)
-            platform.current_cb.data_name = f"YouTube Video - '{title[:120]}'"
-            await upsert_data(data, f"{platform.id}-{platform.current_cb.name}-data", platform.current_cb.batch_number + 1, window=YOUTUBE_VIDEO_WINDOW, stride=YOUTUBE_VIDEO_STRIDE, batch_size=100, type="Video", message_to_edit=embed_message)
-            await embed_message.edit(embed=create_video_stored_embed(platform.current_cb.data_name, platform))
-            texts = ''.join(texts)
-        except Exception as e:
-            await send_error_message(f"Unexpected error. Please join the support server if this persists.\n{e}", message)
-    elif (message.content.endswith(PDF_EXTENSION) or (message.attachments and message.attachments[0].url.endswith(PDF_EXTENSION))): # check if pdf uploaded. could be a url or direct upload
-        try:
-            embed_message = await message.channel.send(embed=create_processing_pdf_embed())
+    """Handle platform waiting_for event for a YouTube video or PDF upload. The upload itself runs as an ingestion job."""
+    try:
+        namespace = f"{platform.id}-{platform.current_cb.name}-data"
+        batch_number = platform.current_cb.batch_number + 1
+        youtube_video_id = check_for_youtube_link(message.content)
+        if youtube_video_id:
+            await enqueue_ingestion(platform, message, VIDEO_JOB, youtube_video_id, "YouTube Video", namespace, batch_number, jobscheduler.NORMAL, create_processing_video_embed())
+        elif (message.content.endswith(PDF_EXTENSION) or (message.attachments and message.attachments[0].url.endswith(PDF_EXTENSION))): # check if pdf uploaded. could be a url or direct upload
             url = message.content if message.content.endswith(PDF_EXTENSION) else message.attachments[0].url
-            platform.current_cb.data_name = f"PDF - '{os.path.basename(urllib.parse.urlparse(url).path)[:40]}'"
-            texts_w_pages = await download_pdf(url, f"{platform.id}-{platform.current_cb.name}")
-
-            if texts_w_pages == -1:
-                await send_error_message(f"PDFs must be fewer than 1000 pages and less than 25 MB.", message)
-                platform.waiting_for = ""
-                platform.current_cb = None
-                return
-            elif not texts_w_pages:
-                await send_error_message(f"{platform.current_cb.data_name}' either contains no text or failed to process. \nTry again from `/settings`", message)
-                platform.waiting_for = ""
-                platform.current_cb = None
-                return
-            texts = ''.join(texts_w_pages.values())
-            for page in texts_w_pages:
-                for i in range(0, len(texts_w_pages[page]), PDF_CHUNK_LENGTH):
-                    data.append({'location': page, 'content': texts_w_pages[page][i:i+PDF_CHUNK_LENGTH]})
-            try:
-                await delete_namespace(f"{platform.id}-{platform.current_cb.name}-data")
-                await upsert_data(data, f"{platform.id}-{platform.current_cb.name}-data", platform.current_cb.batch_number + 1, window=PDF_WINDOW, stride=PDF_STRIDE, batch_size=100, type="PDF", message_to_edit=embed_message)
-            except:
-                pass
-
-            await embed_message.edit(embed=create_pdf_stored_embed(platform.current_cb.data_name))
-
-        except Exception as e:
-            logging.error(f"pdf upload err: {e}")
-            await send_error_message(f"Unexpected error. Please join the support server if this persists.\n{e}", message)
-    else:
-        await send_error_message(f"No PDF or YouTube video has been uploaded. Please try again from /settings.", message)
+            data_name = f"PDF - '{os.path.basename(urllib.parse.urlparse(url).path)[:40]}'"
+            await enqueue_ingestion(platform, message, PDF_JOB, url, data_name, namespace, batch_number, jobscheduler.NORMAL, create_processing_pdf_embed())
+        else:
+            await send_error_message(f"No PDF or YouTube video has been uploaded. Please try again from /settings.", message)
+    finally:
         platform.waiting_for = ""
         platform.current_cb = None
 
@@ -573,9 +613,9 @@ def create_processing_video_embed():
         color=discord.Colour.blue()
     )
 
-def create_video_stored_embed(data_name, platform):
+def create_video_stored_embed(data_name, chatbot, platform):
     return discord.Embed(
-        title=f"{data_name} has been stored in {platform.current_cb.name}'s long term memory",
+        title=f"{data_name} has been stored in {chatbot.name}'s long term memory",
         description=f"Any preexisting PDF or YouTube Video has been removed from memory.\nYou have 🪙 x{platform.credits} credits remaining.",
         color=discord.Colour.blue()
     )
@@ -587,35 +627,31 @@ def create_processing_pdf_embed():
         color=discord.Colour.blue()
     )
 
-def create_pdf_stored_embed(data_name, platform):
+def create_pdf_stored_embed(data_name, chatbot, platform):
     return discord.Embed(
-        title=f"{data_name} has been stored in {platform.current_cb.name}'s long term memory",
+        title=f"{data_name} has been stored in {chatbot.name}'s long term memory",
         description=f"Any preexisting PDF or YouTube Video for this chatbot has been removed from memory.\nYou have 🪙 x{platform.credits} credits remaining.",
         color=discord.Colour.blue()
     )
 
 async def on_raw_reaction_add(bot, payload):
-    """Handles the event when a reaction is added to a message."""
+    """Handles the event when a reaction is added to a message. Runs for every reaction the bot can see, so anything that isn't
+    a control emoji on a Dis.AI reply is dropped before making any Discord calls."""
     try:
         if payload.user_id == bot.user.id:
             return
-
-        channel = await bot.fetch_channel(payload.channel_id)
-        our_webhook = await get_webhook(channel, payload.guild_id)
-
-        if our_webhook is None:
+        entry = bot.response_index.get(payload.message_id) if payload.emoji.name in CONTROL_EMOJIS else None
+        if entry is None:
+            bot.response_index.rejected += 1
             return
-
-        message = await channel.fetch_message(payload.message_id)
-        user = message.author
-        id = message.guild.id if message.guild else channel.id
-        chatbot = await get_chatbot(our_webhook, user, id, bot.platforms)
-
-        if chatbot is None:
+        platform_id, chatbot = entry
+        message = chatbot.last_message
+        if message is None or message.id != payload.message_id: # only the newest reply can be regenerated/continued/deleted
+            bot.response_index.rejected += 1
             return
+        platform = bot.platforms[platform_id]
 
-        platform = bot.platforms[id]
-
+        # replies are sent with buttons (ResponseControlButton). this handles users reacting with the same emojis instead
         if payload.emoji.name == REGENERATE_EMOJI:
             await handle_reaction(chatbot, message, platform, Analytics.REGENERATE.value, True)
         elif payload.emoji.name == CONTINUE_EMOJI:
@@ -626,41 +662,27 @@ async def on_raw_reaction_add(bot, payload):
     except Exception as e:
         logger.error(f"reaction err: {e}")
 
-async def get_webhook(channel, guild_id):
-    """Fetches the webhook for the given channel and guild."""
-    if guild_id:
-        webhooks = await channel.webhooks() if not isinstance(channel, discord.Thread) else await channel.parent.webhooks()
-        for webhook in webhooks:
-            if webhook.name == WEBHOOK_NAME:
-                return webhook
-    else:
-        return None
-
-async def get_chatbot(our_webhook, user, id, platforms):
-    """Fetches the chatbot for the given webhook, user, and id."""
-    if user.bot and user.id == our_webhook.id:
-        platform = await get_platform(platforms, None, id=id)
-        for chatbot in platform.chatbots:
-            if isinstance(platform, Server) and chatbot.name == user.name:
-                return chatbot
-            elif chatbot.channels and chatbot.channels[0] == id:
-                return chatbot
-
 async def handle_reaction(our_chatbot, message, platform, action, regen_mode):
-    """Handles a reaction event."""
-    await update_analytics(platform.analytics, action)
+    """Handles a regenerate/continue reaction or button click. Makes no Discord calls of its own before the response."""
+    await update_analytics(platform, action)
     cost = get_credits_cost(our_chatbot.model)
-    await message.clear_reactions()
-    if regen_mode:
-        del our_chatbot.context[-1]
-    else:
-        our_chatbot.context.append({'role':'system','content':'Continue'})
-    response_success = await handle_gpt_response(platform, our_chatbot, user_message=message, credits_cost=cost, response_message=our_chatbot.last_message if regen_mode else None, should_append_context=False)
+    async with chatbotqueue.get_queue(our_chatbot).turn(): # wait for a queued reply to finish before touching the context
+        if regen_mode:
+            del our_chatbot.context[-1]
+        else:
+            our_chatbot.context.append({'role':'system','content':'Continue'})
+        response_success = await handle_gpt_response(platform, our_chatbot, user_message=message, credits_cost=cost, response_message=our_chatbot.last_message if regen_mode else None, should_append_context=False)
     if response_success:
         platform.credits -= cost
 
-async def handle_delete_reaction(our_chatbot):
-    """Handles a delete reaction event."""
-    del our_chatbot.context[-2:]
-    await our_chatbot.last_message.delete()
-    our_chatbot.last_message = None
+async def handle_delete_reaction(our_chatbot, interaction=None):
+    """Handles a delete reaction or button click."""
+    async with chatbotqueue.get_queue(our_chatbot).turn():
+        del our_chatbot.context[-2:]
+        if our_chatbot.last_message is not None:
+            responseindex.get_index().discard(our_chatbot.last_message.id)
+            await our_chatbot.last_message.delete()
+        elif interaction is not None: # reply was sent before a restart. the button's interaction can still delete it
+            await interaction.delete_original_response()
+        our_chatbot.last_message = None
+        our_chatbot.last_message_id = None
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from utils import services
+
+"""Bot-wide executor service. Every blocking call (Pinecone, the sync OpenAI SDK, YouTube transcripts, PDF parsing, tokenizing) runs in one of
+the bounded pools owned by the bot, instead of a fresh ThreadPoolExecutor per call that was never shut down."""
+
+# Constants
+IO_WORKERS = 32 # network bound calls. they mostly sleep, so there can be many
+CPU_WORKERS = max(2, (os.cpu_count() or 2)) # parsing / tokenizing. more threads than cores just fight over the GIL
+PROCESS_WORKERS = max(1, min(4, os.cpu_count() or 1)) # pure Python work too long to hold the GIL for (PDF text extraction)
+SHUTDOWN_TIMEOUT = 10 # seconds to wait for running calls on shutdown
+
+logger = logging.getLogger(__name__)
+
+
+class ManagedPool:
+    """A bounded thread pool that keeps queue depth and wait time metrics."""
+    def __init__(self, name: str, max_workers: int, executor=None):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = executor if executor else ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"disai-{name}")
+        self._lock = threading.Lock() # counters are updated from the worker threads
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0 # cancelled, or cut by shutdown, before a worker picked them up
+        self.queued = 0 # waiting for a worker right now
+        self.running = 0
+        self.total_wait = 0.0 # seconds spent queued, summed
+        self.max_wait = 0.0
+        self.total_run = 0.0
+
+    async def run(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the pool and await the result."""
+        submitted_at = time.perf_counter()
+        with self._lock:
+            self.submitted += 1
+            self.queued += 1
+        dequeued = False # set by whichever side takes the call off `queued` first: the worker, or the awaiting side if it never started
+
+        def call():
+            nonlocal dequeued
+            started_at = time.perf_counter()
+            with self._lock:
+                if not dequeued:
+                    dequeued = True
+                    self.queued -= 1
+                self.running += 1
+                wait = started_at - submitted_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            failed = False
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.total_run += time.perf_counter() - started_at
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        finally:
+            with self._lock:
+                if not dequeued:
+                    dequeued = True
+                    self.queued -= 1
+                    self.dropped += 1
+
+    def shutdown(self, wait: bool = True):
+        """Drop calls that haven't started and (optionally) wait for the running ones."""
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed
+        started = self.submitted - self.queued - self.dropped
+        return {
+            "workers": self.max_workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "queued": self.queued,
+            "running": self.running,
+            "avg_wait": self.total_wait / started if started else 0,
+            "max_wait": self.max_wait,
+            "avg_run": self.total_run / finished if finished else 0,
+        }
+
+
+class ManagedProcessPool(ManagedPool):
+    """
+    A bounded process pool with the same metrics. func and its arguments must be picklable (a module-level function).
+    The parent can't see when a call leaves the queue, so queue time counts as run time and "running" means in flight.
+    """
+    def __init__(self, name: str, max_workers: int):
+        super().__init__(name, max_workers, ProcessPoolExecutor(max_workers=max_workers)) # workers start on first use
+
+    async def run(self, func, *args):
+        started_at = time.perf_counter()
+        with self._lock:
+            self.submitted += 1
+            self.running += 1
+        failed = False
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args))
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.total_run += time.perf_counter() - started_at
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+
+class ExecutorService:
+    """The bot's I/O, CPU and process pools."""
+    def __init__(self, io_workers: int = IO_WORKERS, cpu_workers: int = CPU_WORKERS, process_workers: int = PROCESS_WORKERS):
+        self.io = ManagedPool("io", io_workers)
+        self.cpu = ManagedPool("cpu", cpu_workers)
+        self.process = ManagedProcessPool("process", process_workers)
+        self.closed = False
+
+    async def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT):
+        if self.closed:
+            return
+        self.closed = True
+        for pool in (self.io, self.cpu, self.process):
+            pool.shutdown(wait=False) # cancels everything still queued
+        try: # joining the running threads / processes blocks, so do it off the event loop
+            await asyncio.wait_for(asyncio.to_thread(partial(_join, self.io, self.cpu, self.process)), timeout=timeout)
+            logger.info("Executor service shut down")
+        except asyncio.TimeoutError:
+            logger.error(f"Executor service: calls still running after {timeout}s, not waiting for them")
+
+    def stats(self) -> dict:
+        return {"io": self.io.stats(), "cpu": self.cpu.stats(), "process": self.process.stats()}
+
+def _join(*pools):
+    for pool in pools:
+        pool.shutdown(wait=True)
+
+
+get_service = services.accessor("executors", ExecutorService)
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking network call (Pinecone, sync OpenAI SDK, YouTube transcripts, file writes)."""
+    return await get_service().io.run(func, *args, **kwargs)
+
+async def run_cpu(func, *args, **kwargs):
+    """Run a CPU heavy call that releases the GIL or is short (tokenizing)."""
+    return await get_service().cpu.run(func, *args, **kwargs)
+
+async def run_process(func, *args):
+    """Run long pure Python work in a worker process (PDF text extraction). func must be a module-level function."""
+    return await get_service().process.run(func, *args)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+import aiohttp
+
+from utils import services
+
+"""Bot-lifetime HTTP client. One pooled aiohttp session is shared by every outgoing request (OpenAI streaming, YouTube, rentry, attachments)
+so replies reuse warm keep-alive connections instead of paying a TCP+TLS handshake each time."""
+
+# Constants
+CONNECTION_LIMIT = 100 # total open connections across all hosts
+CONNECTION_LIMIT_PER_HOST = 30 # api.openai.com gets most of the traffic
+DNS_CACHE_TTL = 300 # seconds
+KEEPALIVE_TIMEOUT = 60 # seconds an idle connection is kept around
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=10)
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPPool:
+    """
+    Owns the shared aiohttp session and its connection pool.
+    Counters are filled in by aiohttp's tracing hooks.
+    """
+    def __init__(self, limit: int = CONNECTION_LIMIT, limit_per_host: int = CONNECTION_LIMIT_PER_HOST,
+                 dns_cache_ttl: int = DNS_CACHE_TTL, keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+                 timeout: aiohttp.ClientTimeout = DEFAULT_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        # counters
+        self.requests = 0
+        self.connection_hits = 0 # request reused a pooled keep-alive connection
+        self.connection_misses = 0 # request had to open a new connection
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self.queued = 0 # request had to wait for a free connection slot
+        self.queue_wait_time = 0.0 # total seconds spent waiting for a slot
+
+    async def start(self):
+        """Create the session. Must be called from inside the running event loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host, ttl_dns_cache=self.dns_cache_ttl,
+                                             use_dns_cache=True, keepalive_timeout=self.keepalive_timeout, enable_cleanup_closed=True)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, trace_configs=[self._make_trace_config()])
+            logger.info(f"HTTP pool started (limit={self.limit}, limit_per_host={self.limit_per_host}, dns_ttl={self.dns_cache_ttl}s)")
+        return self._session
+
+    async def close(self):
+        """Close the session and every pooled connection."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            await asyncio.sleep(0.25) # give SSL transports a moment to shut down cleanly
+            logger.info("HTTP pool closed")
+        self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            raise RuntimeError("HTTP pool has not been started")
+        return self._session
+
+    def _make_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            self.requests += 1
+
+        async def on_connection_queued_start(session, ctx, params):
+            ctx.queued_at = time.perf_counter()
+
+        async def on_connection_queued_end(session, ctx, params):
+            self.queued += 1
+            self.queue_wait_time += time.perf_counter() - getattr(ctx, "queued_at", time.perf_counter())
+
+        async def on_connection_create_end(session, ctx, params):
+            self.connection_misses += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self.connection_hits += 1
+
+        async def on_dns_cache_hit(session, ctx, params):
+            self.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, ctx, params):
+            self.dns_cache_misses += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    def stats(self) -> dict:
+        connections = self.connection_hits + self.connection_misses
+        return {
+            "requests": self.requests,
+            "connection_hits": self.connection_hits,
+            "connection_misses": self.connection_misses,
+            "connection_hit_rate": self.connection_hits / connections if connections else 0,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+            "queued": self.queued,
+            "avg_queue_wait": self.queue_wait_time / self.queued if self.queued else 0,
+        }
+
+
+get_pool = services.accessor("http_pool", HTTPPool)
+
+async def get_session() -> aiohttp.ClientSession:
+    """Returns the shared session, starting the pool if needed."""
+    return await get_pool().start()
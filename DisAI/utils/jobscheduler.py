@@ -0,0 +1,318 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import uuid
+from collections import Counter
+
+import discord
+
+from utils import dbhandler, services
+
+"""Background jobs for data ingestion (PDFs, YouTube videos, lorebooks). The upload flows only enqueue a job; a bounded pool of workers
+runs them by priority with a per-server cap. Job records live in the database with the offset of the windows already stored,
+so a job that was running or queued when the bot stopped resumes where it left off."""
+
+# Constants
+JOB_WORKERS = 3 # jobs running at once, whole bot
+JOBS_PER_GUILD = 1 # jobs running at once per server
+MAX_QUEUED_PER_GUILD = 5 # jobs waiting per server
+SAVE_INTERVAL = 5 # min seconds between offset saves of a running job
+CLOSE_TIMEOUT = 10 # seconds to wait for running jobs to save their offset on shutdown
+
+# Priorities (lower runs first)
+HIGH = 0 # lorebooks: small, and the user is waiting on them
+NORMAL = 1 # PDFs, videos
+
+# Statuses
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """A job failed in a way the user should be told about. The message is shown as is."""
+
+
+class Job:
+    """
+    One ingestion. source is what the handler downloads (a URL); name is the lorebook or data name; namespace is where the vectors go.
+    offset: windows already stored, so a resumed job skips them.
+    """
+    def __init__(self, kind: str, platform_id: int, chatbot_name: str, channel_id: int, message_id: int, user_id: int, source: str, name: str,
+                 namespace: str, batch_number: int = 0, priority: int = NORMAL, offset: int = 0, status: str = QUEUED, job_id: str = None, created: float = None):
+        self.id = job_id if job_id else uuid.uuid4().hex
+        self.kind = kind
+        self.platform_id = platform_id
+        self.chatbot_name = chatbot_name
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.user_id = user_id
+        self.source = source
+        self.name = name
+        self.namespace = namespace
+        self.batch_number = batch_number
+        self.priority = priority
+        self.offset = offset
+        self.status = status
+        self.created = created if created else time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "_id": self.id,
+            "kind": self.kind,
+            "platform_id": self.platform_id,
+            "chatbot_name": self.chatbot_name,
+            "channel_id": self.channel_id,
+            "message_id": self.message_id,
+            "user_id": self.user_id,
+            "source": self.source,
+            "name": self.name,
+            "namespace": self.namespace,
+            "batch_number": self.batch_number,
+            "priority": self.priority,
+            "offset": self.offset,
+            "status": self.status,
+            "created": self.created,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(d['kind'], d['platform_id'], d['chatbot_name'], d['channel_id'], d['message_id'], d['user_id'], d['source'], d['name'],
+                   d['namespace'], batch_number=d['batch_number'], priority=d['priority'], offset=d['offset'], status=d['status'],
+                   job_id=d['_id'], created=d['created'])
+
+
+class JobScheduler:
+    """
+    Handlers are registered per job kind: handler(job, platform, message_to_edit, on_progress) does the work, where message_to_edit is the
+    job's progress message (or None if it's gone) and on_progress(offset) records how many windows are stored.
+    """
+    def __init__(self, workers: int = JOB_WORKERS, per_guild: int = JOBS_PER_GUILD, max_queued_per_guild: int = MAX_QUEUED_PER_GUILD):
+        self.workers = workers
+        self.per_guild = per_guild
+        self.max_queued_per_guild = max_queued_per_guild
+        self.bot = None
+        self._handlers = {}
+        self._heap = [] # (priority, seq, job) of queued jobs
+        self._seq = itertools.count()
+        self._jobs = {} # id -> queued or running job
+        self._tasks = {} # id -> task of a running job
+        self._cancelled = set() # ids cancelled after leaving the queue, before their task started
+        self._messages = {} # id -> progress message, when we already have it
+        self._running_per_guild = Counter()
+        self._last_save = {}
+        self._changed = asyncio.Condition()
+        self._workers = []
+        self._closing = False
+        self.stats = {"submitted": 0, "resumed": 0, "done": 0, "failed": 0, "cancelled": 0, "rejected": 0}
+
+    def register(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    async def start(self, bot):
+        """Start the workers and queue the jobs that didn't finish before the last shutdown."""
+        if self._workers: # on_ready runs again after reconnects
+            return
+        self.bot = bot
+        try:
+            records = await dbhandler.get_jobs()
+        except Exception as e:
+            logger.error(f"load jobs err: {e}")
+            records = []
+        for record in records:
+            job = Job.from_dict(record)
+            if job.status in (QUEUED, RUNNING):
+                job.status = QUEUED
+                self._push(job)
+                self.stats["resumed"] += 1
+        if records:
+            logger.info(f"resuming {self.stats['resumed']} ingestion jobs")
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _push(self, job: Job):
+        self._jobs[job.id] = job
+        heapq.heappush(self._heap, (job.priority, next(self._seq), job))
+
+    def queued_in_guild(self, platform_id: int) -> int:
+        return sum(1 for _, _, job in self._heap if job.platform_id == platform_id)
+
+    def position(self, job: Job) -> int:
+        """1-based place in line among all queued jobs, 0 if it isn't queued."""
+        for position, (_, _, queued) in enumerate(sorted(self._heap), start=1):
+            if queued is job:
+                return position
+        return 0
+
+    async def submit(self, job: Job, message_to_edit=None) -> bool:
+        """Queue a job. False if its server already has max_queued_per_guild jobs waiting."""
+        if self.queued_in_guild(job.platform_id) >= self.max_queued_per_guild:
+            self.stats["rejected"] += 1
+            return False
+        await dbhandler.save_job(job.to_dict()) # may raise: nothing is queued then
+        if message_to_edit:
+            self._messages[job.id] = message_to_edit
+        async with self._changed:
+            self._push(job)
+            self._changed.notify_all()
+        self.stats["submitted"] += 1
+        return True
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job. Vectors it already stored stay in its namespace."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        task = self._tasks.get(job_id)
+        if task:
+            task.cancel() # _run records it
+            return True
+        if not any(queued is job for _, _, queued in self._heap): # between the queue and its task. _run cancels it before it starts
+            self._cancelled.add(job_id)
+            return True
+        async with self._changed:
+            self._heap = [entry for entry in self._heap if entry[2] is not job]
+            heapq.heapify(self._heap)
+        await self._show(job, discord.Embed(title=f"Cancelled: {job.name}", description="This upload was cancelled.", color=discord.Colour.blue()))
+        await self._finish(job, CANCELLED)
+        return True
+
+    def _next_job(self):
+        """Pop the first queued job whose server is under its cap, or None."""
+        skipped = []
+        job = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if self._running_per_guild[entry[2].platform_id] < self.per_guild:
+                job = entry[2]
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return job
+
+    async def _worker(self):
+        while not self._closing:
+            async with self._changed:
+                job = self._next_job()
+                while job is None and not self._closing:
+                    await self._changed.wait()
+                    job = self._next_job()
+                if self._closing: # a job taken just now keeps its record and resumes after the restart
+                    return
+                self._running_per_guild[job.platform_id] += 1
+            try:
+                await self._run(job)
+            except Exception as e:
+                logger.error(f"job worker err ({job.id}): {e}")
+            finally:
+                async with self._changed:
+                    self._running_per_guild[job.platform_id] -= 1
+                    self._changed.notify_all()
+
+    async def _run(self, job: Job):
+        handler = self._handlers.get(job.kind)
+        platform = self.bot.platforms.get(job.platform_id) if self.bot else None
+        if handler is None or platform is None:
+            logger.error(f"can't run job {job.id}: kind {job.kind}, platform {job.platform_id}")
+            await self._finish(job, FAILED)
+            return
+        job.status = RUNNING
+        try:
+            await dbhandler.save_job(job.to_dict())
+        except Exception as e: # fail it now rather than leave it stuck in _jobs until a restart
+            logger.error(f"start job err ({job.id}): {e}")
+            await self._show(job, discord.Embed(title="Error", description="Couldn't start this upload. Please try again later.", color=discord.Colour.red()))
+            await self._finish(job, FAILED)
+            return
+        message_to_edit = await self._get_message(job)
+        if job.id in self._cancelled:
+            await self._show(job, discord.Embed(title=f"Cancelled: {job.name}", description="This upload was cancelled.", color=discord.Colour.blue()))
+            await self._finish(job, CANCELLED)
+            return
+        task = self._tasks[job.id] = asyncio.create_task(handler(job, platform, message_to_edit, lambda offset: self._progress(job, offset)))
+        try:
+            await task
+        except asyncio.CancelledError:
+            if self._closing: # shutting down: leave the record, the job resumes from its offset
+                job.status = QUEUED
+                await dbhandler.save_job(job.to_dict())
+                return
+            await self._show(job, discord.Embed(title=f"Cancelled: {job.name}", description="This upload was cancelled.", color=discord.Colour.blue()))
+            await self._finish(job, CANCELLED)
+            return
+        except JobError as e:
+            await self._show(job, discord.Embed(title="Error", description=str(e), color=discord.Colour.red()))
+            await self._finish(job, FAILED)
+            return
+        except Exception as e:
+            logger.error(f"job err ({job.kind}, {job.namespace}): {type(e)} - {e}")
+            await self._show(job, discord.Embed(title="Error", description=f"Unexpected error. Please join the support server if this persists.\n{e}", color=discord.Colour.red()))
+            await self._finish(job, FAILED)
+            return
+        finally:
+            self._tasks.pop(job.id, None)
+        await self._finish(job, DONE)
+
+    async def _progress(self, job: Job, offset: int):
+        job.offset = offset
+        now = time.monotonic()
+        if now - self._last_save.get(job.id, 0) >= SAVE_INTERVAL:
+            self._last_save[job.id] = now
+            try:
+                await dbhandler.save_job(job.to_dict())
+            except Exception as e:
+                logger.error(f"save job progress err: {e}")
+
+    async def _finish(self, job: Job, status: str):
+        job.status = status
+        self.stats[status] += 1
+        self._jobs.pop(job.id, None)
+        self._messages.pop(job.id, None)
+        self._last_save.pop(job.id, None)
+        self._cancelled.discard(job.id)
+        try:
+            await dbhandler.delete_job(job.id)
+        except Exception as e:
+            logger.error(f"delete job err: {e}")
+
+    async def _get_message(self, job: Job):
+        message = self._messages.get(job.id)
+        if message is None and self.bot:
+            try:
+                channel = self.bot.get_channel(job.channel_id) or await self.bot.fetch_channel(job.channel_id)
+                message = self._messages[job.id] = await channel.fetch_message(job.message_id)
+            except Exception as e:
+                logger.error(f"job progress message err: {e}")
+        return message
+
+    async def _show(self, job: Job, embed: discord.Embed):
+        message = await self._get_message(job)
+        if message:
+            try:
+                await message.edit(embed=embed, view=None)
+            except Exception as e:
+                logger.error(f"job message edit err: {e}")
+
+    async def close(self):
+        """Stop the workers. Running jobs keep their records and resume after the restart."""
+        self._closing = True
+        for task in self._tasks.values():
+            task.cancel()
+        async with self._changed:
+            self._changed.notify_all() # wake the idle workers so they exit
+        try:
+            await asyncio.wait_for(asyncio.gather(*self._workers, return_exceptions=True), timeout=CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"job workers still busy after {CLOSE_TIMEOUT}s")
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "queued": len(self._heap), "running": len(self._tasks)}
+
+
+get_scheduler = services.accessor("jobs", JobScheduler)
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+"""Live rendering of streamed replies. The token loop only hands over the latest text; a per-message task edits the Discord
+message on its own schedule, so reading from OpenAI never waits on Discord."""
+
+# Constants
+CHUNK_SIZE = 1970 # characters per Discord message
+FLUSH_INTERVAL = 1.0 # min seconds between edits of the same message
+WEBHOOK_BUCKET_CAPACITY = 5 # Discord allows 5 webhook requests...
+WEBHOOK_BUCKET_WINDOW = 2.0 # ...per 2 seconds, per webhook
+BUCKET_SWEEP_INTERVAL = 60 # seconds between sweeps of idle webhook buckets
+
+logger = logging.getLogger(__name__)
+
+stats = {
+    "edits_sent": 0, # edits + overflow messages actually sent to Discord
+    "edits_coalesced": 0, # text updates that were merged into a later edit
+    "edits_skipped": 0, # flushes dropped because the message already showed that text
+    "ratelimits_avoided": 0, # times we waited for the webhook bucket instead of eating a 429
+}
+
+
+class WebhookBucket:
+    """Client-side copy of a webhook's rate limit bucket. Every live render using the same webhook shares one."""
+    def __init__(self, capacity: int = WEBHOOK_BUCKET_CAPACITY, window: float = WEBHOOK_BUCKET_WINDOW):
+        self.capacity = capacity
+        self.window = window
+        self._sent = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            while self._sent and now - self._sent[0] >= self.window:
+                self._sent.popleft()
+            if len(self._sent) >= self.capacity:
+                stats["ratelimits_avoided"] += 1
+                await asyncio.sleep(self.window - (now - self._sent[0]))
+                self._sent.popleft()
+            self._sent.append(time.monotonic())
+
+    def idle(self, now: float) -> bool:
+        """Nothing sent within the window and nobody waiting: a new bucket would behave the same."""
+        return not self._lock.locked() and (not self._sent or now - self._sent[-1] >= self.window)
+
+_buckets = {}
+_last_sweep = time.monotonic()
+
+def get_bucket(webhook_id: int) -> WebhookBucket:
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep >= BUCKET_SWEEP_INTERVAL:
+        _last_sweep = now
+        for idle_id in [bucket_id for bucket_id, bucket in _buckets.items() if bucket.idle(now)]:
+            del _buckets[idle_id]
+    if webhook_id not in _buckets:
+        _buckets[webhook_id] = WebhookBucket()
+    return _buckets[webhook_id]
+
+
+class LiveRender:
+    """
+    Keeps one streamed reply on screen.
+    message: the webhook message being edited.
+    send_overflow: coroutine function taking the text of a new message, used when the reply outgrows CHUNK_SIZE.
+    """
+    def __init__(self, message, send_overflow, webhook_id: int, loading_suffix: str = "", chunk_size: int = CHUNK_SIZE,
+                 interval: float = FLUSH_INTERVAL):
+        self.message = message
+        self.send_overflow = send_overflow
+        self.webhook_id = webhook_id
+        self.loading_suffix = loading_suffix
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.page = 0 # index of the CHUNK_SIZE slice self.message shows
+        self._text = ""
+        self._pending = False # there's text that hasn't been flushed yet
+        self._last_sent = None
+        self._dirty = asyncio.Event()
+        self._closing = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.create_task(self._run())
+
+    def update(self, text: str):
+        """Hand over the latest full text. Never blocks."""
+        if self._closed:
+            return
+        if self._pending:
+            stats["edits_coalesced"] += 1
+        self._text = text
+        self._pending = True
+        self._dirty.set()
+
+    async def close(self):
+        """Stop the render task without a final flush. Returns the message currently being rendered into."""
+        if not self._closed:
+            self._closed = True
+            self._closing.set()
+            self._dirty.set()
+            await self._task
+        return self.message
+
+    async def finish(self, text: str, view=None):
+        """Stop the render task and show the final text (without the loading suffix). Returns the last message."""
+        await self.close()
+        self._text = text
+        await self._flush(final=True, view=view)
+        return self.message
+
+    @property
+    def bucket(self) -> WebhookBucket:
+        # looked up on every send: an idle bucket may have been swept and replaced since the last one
+        return get_bucket(self.webhook_id)
+
+    async def _run(self):
+        try:
+            while True:
+                await self._dirty.wait()
+                if self._closed:
+                    return
+                self._dirty.clear()
+                await self._flush(final=False)
+                try:
+                    await asyncio.wait_for(self._closing.wait(), timeout=self.interval)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as e:
+            logger.error(f"live render err: {type(e)} - {e}")
+
+    async def _flush(self, final: bool, view=None):
+        self._pending = False
+        text = self._text
+        while len(text) > (self.page + 1) * self.chunk_size: # current message is full. finish it and continue in a new one
+            await self._edit(text[self.page * self.chunk_size:(self.page + 1) * self.chunk_size])
+            self.page += 1
+            await self.bucket.acquire()
+            self.message = await self.send_overflow(f"--{text[self.page * self.chunk_size:(self.page + 1) * self.chunk_size]}")
+            stats["edits_sent"] += 1
+            self._last_sent = None
+        content = text[self.page * self.chunk_size:(self.page + 1) * self.chunk_size]
+        if not final:
+            content = f"{content}{self.loading_suffix}"
+        await self._edit(content, view)
+
+    async def _edit(self, content: str, view=None):
+        if content == self._last_sent and view is None:
+            stats["edits_skipped"] += 1
+            return
+        await self.bucket.acquire()
+        if view is None:
+            edited = await self.message.edit(content=content)
+        else:
+            edited = await self.message.edit(content=content, view=view)
+        if edited is not None: # keep the newest copy so .components reflects what's on screen
+            self.message = edited
+        self._last_sent = content
+        stats["edits_sent"] += 1
+
+
+def get_stats() -> dict:
+    return dict(stats)
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import weakref
+
+from utils import pineconehandler, services
+
+"""Background long term memory archiver. Messages evicted from a chatbot's context wait in chatbot.ltm_pending (saved by backup_db)
+and are embedded and upserted off the reply path, batched across every chatbot with something pending. Vector ids are content
+hashes of the window text, so archiving the same messages twice changes nothing."""
+
+# Constants
+FLUSH_DELAY = 3 # seconds to let evictions from other chatbots pile up before a flush
+RETRY_DELAY = 30 # seconds before a failed flush is tried again
+EMBED_BATCH = 100 # texts per embedding request
+WINDOW = 2 # messages per archived window, same as before
+STRIDE = 1
+CLOSE_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+class LTMArchiver:
+    """
+    chatbot.ltm_archived counts the messages stored so far (the archived-through offset); ltm_pending holds the ones after it.
+    discard(chatbot) drops the pending messages when the memory namespace is deleted, including a flush already on its way.
+    """
+    def __init__(self, delay: float = FLUSH_DELAY):
+        self.delay = delay
+        self._dirty = weakref.WeakKeyDictionary() # chatbot -> platform id, for chatbots with pending messages
+        self._epochs = weakref.WeakKeyDictionary() # chatbot -> times its memory was discarded
+        self._task = None
+        self._in_flight = [] # [(chatbot, platform id)] being flushed right now
+        self.stats = {"archived": 0, "windows": 0, "flushes": 0, "failed_flushes": 0, "discarded": 0}
+
+    def archive(self, chatbot, platform_id: int, messages: list):
+        """Queue messages evicted from the context. Returns right away."""
+        if not messages:
+            return
+        chatbot.ltm_pending.extend(messages)
+        self._mark(chatbot, platform_id)
+
+    def _mark(self, chatbot, platform_id: int):
+        self._dirty[chatbot] = platform_id
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def resume(self, platforms: dict):
+        """Queue the messages that were still pending at the last backup."""
+        for platform in platforms.values():
+            for chatbot in platform.chatbots:
+                if chatbot.ltm_pending:
+                    self._mark(chatbot, platform.id)
+
+    def discard(self, chatbot):
+        """The chatbot's memory namespace is being deleted: forget what's pending so it isn't archived into the fresh namespace."""
+        self.stats["discarded"] += len(chatbot.ltm_pending)
+        chatbot.ltm_pending.clear()
+        chatbot.ltm_archived = 0
+        self._epochs[chatbot] = self._epochs.get(chatbot, 0) + 1
+        self._dirty.pop(chatbot, None)
+
+    async def _run(self):
+        while len(self._dirty):
+            await asyncio.sleep(self.delay)
+            dirty = list(self._dirty.items())
+            self._dirty.clear()
+            self._in_flight = dirty
+            try:
+                await self.flush(dirty)
+            except Exception as e:
+                self.stats["failed_flushes"] += 1
+                logger.error(f"ltm archive err, retrying in {RETRY_DELAY}s: {e}")
+                for chatbot, platform_id in dirty:
+                    if chatbot.ltm_pending:
+                        self._dirty[chatbot] = platform_id
+                await asyncio.sleep(RETRY_DELAY)
+            finally:
+                self._in_flight = []
+
+    async def flush(self, dirty: list):
+        """Archive what's pending for [(chatbot, platform id)]: one set of embedding requests for all of them, then one upsert per namespace."""
+        work = []
+        for chatbot, platform_id in dirty:
+            messages = list(chatbot.ltm_pending)
+            if messages:
+                windows = pineconehandler.make_windows(messages, 0, WINDOW, STRIDE, "chatbot", "role", hash_ids=True)
+                work.append((chatbot, platform_id, len(messages), windows, self._epochs.get(chatbot, 0)))
+        if not work:
+            return
+        self.stats["flushes"] += 1
+        texts = [window['text'] for *_, windows, _ in work for window in windows]
+        embeds = []
+        for start in range(0, len(texts), EMBED_BATCH):
+            batch = texts[start:start + EMBED_BATCH]
+            await pineconehandler.reserve_tokens(pineconehandler.estimate_tokens(batch))
+            embeds += await pineconehandler.with_backoff(pineconehandler.get_embeddings, batch)
+
+        position = 0
+        for chatbot, platform_id, count, windows, epoch in work:
+            vectors = embeds[position:position + len(windows)]
+            position += len(windows)
+            if self._epochs.get(chatbot, 0) != epoch: # memory was cleared while embedding
+                continue
+            to_upsert = [(window['id'], vector, {'text': window['text']}) for window, vector in zip(windows, vectors)]
+            try:
+                await pineconehandler.upsert_vectors(to_upsert, f"{platform_id}-{chatbot.name}")
+            except Exception as e:
+                logger.error(f"ltm upsert err ({platform_id}-{chatbot.name}): {e}")
+                self._mark(chatbot, platform_id)
+                continue
+            if self._epochs.get(chatbot, 0) == epoch:
+                del chatbot.ltm_pending[:count] # messages evicted meanwhile were appended after these
+                chatbot.ltm_archived += count
+                self.stats["archived"] += count
+                self.stats["windows"] += len(windows)
+
+    async def close(self):
+        """Archive what's pending now instead of after the delay. Whatever doesn't make it is still in ltm_pending for the next backup."""
+        dirty = list(self._dirty.items()) + self._in_flight
+        if self._task:
+            self._task.cancel()
+        try:
+            await asyncio.wait_for(self.flush(dirty), timeout=CLOSE_TIMEOUT)
+        except Exception as e:
+            logger.error(f"ltm archive on shutdown err: {type(e)} - {e}")
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "pending_chatbots": len(self._dirty)}
+
+
+get_archiver = services.accessor("ltm_archiver", LTMArchiver)
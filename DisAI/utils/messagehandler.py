@@ -1,11 +1,10 @@
 import asyncio
 import json
 import time
-from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
 from math import ceil
 
-import aiohttp
 import discord
 import openai
 from discord import PartialEmoji
@@ -18,12 +17,16 @@ from extensions.constants import Analytics
 from extensions.embeds import get_credits_needed_embed
 from extensions.helpers import (get_credits_cost, has_time_passed,
                                 send_error_message, update_analytics, get_tokens)
-from extensions.uiactions import CreditsView
+from extensions.uiactions import CreditsView, make_response_controls_view
 import utils.pineconehandler as pineconehandler
+from utils import admission, chatbotqueue, executors, httphandler, liverender, ltmarchiver, responseindex, ssedecoder, webhookhandler
 
 # Constants
 CHUNK_SIZE = 1970
 LOADING_EMOJI = PartialEmoji(name="", animated=True, id=1120087219928051843)
+EARLIER_REPLIES_TIMEOUT = 120 # max seconds a chatbot waits for the chatbots replying before it
+RETRIEVAL_DEADLINE = 6 # max seconds for embedding a message + querying every namespace it needs
+_background_tasks = set() # keeps fire-and-forget tasks referenced until they finish
 
 # Set up logging
 import logging
@@ -46,40 +49,36 @@ except FileNotFoundError:
 
 
 
-async def pre_gpt_response(converse_mode, regen_mode, platform, chatbot, user_message, should_append_context, processed_chatbots):
-    """Do things before getting a GPT response."""
+async def pre_gpt_response(converse_mode, regen_mode, platform, chatbot, user_message, should_append_context, processed_chatbots, before_completion=None):
+    """Do things before getting a GPT response. before_completion is awaited after retrieval, right before the other chatbots' replies are added."""
     if not converse_mode and not regen_mode: # if it's in converse mode, then don't pamper context / get bing responses, since that's already been done 
         await pamper_context(platform.id, chatbot, user_message, should_append_context)
+    if before_completion: # e.g. wait for the chatbots replying before this one
+        await before_completion()
     platform.last_interaction_date = datetime.now().replace(microsecond=0) # update last interaction date for the platform
     for processed_chatbot in processed_chatbots: # add the messages of the other, processed chatbots to the current chatbot
-        for entry in reversed(processed_chatbot.context): # find last assistant message
-            if entry['role'] == 'assistant':
-                last_assistant_message = entry['content']
-                break
-        else:
-            last_assistant_message = ""
+        last_assistant_message = get_last_assistant_message(processed_chatbot)
         if last_assistant_message:
             chatbot.context.append({'role': 'user','content': f"{processed_chatbot.name}: {last_assistant_message}"})
     chatbot.context.append({'role': 'assistant','content': ""})
 
 async def handle_gpt_response(platform, chatbot, user_message, credits_cost, response_message=None, converse_mode=False, should_make_buttons=True, 
-                              should_append_context=True, regen_mode=False, processed_chatbots=[]):
+                              should_append_context=True, regen_mode=False, processed_chatbots=[], before_completion=None):
     try:
         if platform.credits - credits_cost < 0: # if not enough credits, return False
             if has_time_passed(platform.last_creditsembed_date, 45):
                 platform.last_creditsembed_date = datetime.now().replace(microsecond=0)
-                await update_analytics(platform.analytics, Analytics.RAN_OUT_OF_CREDITS.value)
+                await update_analytics(platform, Analytics.RAN_OUT_OF_CREDITS.value)
                 await user_message.channel.send(embed=await get_credits_needed_embed(chatbot), view=CreditsView(platform))
             return False  
-        try:
-            if chatbot.last_message:
-                await chatbot.last_message.clear_reactions()
-        except:
-            pass
-        
-        response_message = await handle_gpt_output_server(chatbot, user_message, response_message, converse_mode, regen_mode, platform, should_append_context, processed_chatbots)
+        if chatbot.last_message is not response_message: # only the newest reply keeps its buttons
+            remove_response_controls(chatbot.last_message)
+        controls_view = make_response_controls_view(platform.id, chatbot, converse_mode) if should_make_buttons else None
+        response_message = await handle_gpt_output_server(chatbot, user_message, response_message, converse_mode, regen_mode, platform, should_append_context, processed_chatbots, controls_view, before_completion)
     except Exception as e:
         logger.error(f"{platform.id} {chatbot.name} - handle gpt response err :{type(e)} - {e}\n{chatbot.context}")
+        if webhookhandler.is_unknown_webhook(e): # our webhook was deleted mid-reply. the next reply will make a new one
+            webhookhandler.get_registry().invalidate(webhookhandler.resolve_channel(user_message.channel).id)
         if "avatar_url" in str(e):
             await send_error_message("The avatar URL you set is invalid. Please set a valid URL from /settings.", user_message)
             chatbot.avatar_url = ICON_URL
@@ -89,18 +88,44 @@ async def handle_gpt_response(platform, chatbot, user_message, credits_cost, res
         return False
     if not response_message:
         return False
-    chatbot.last_message = response_message # is a webhook message
-    # add reactions
-    if should_make_buttons:
-        await response_message.add_reaction('⏩')
-        await response_message.add_reaction('🔃')
-    if not converse_mode and (should_make_buttons):
-        await response_message.add_reaction('🗑️')
+    chatbot.last_message = response_message # is a webhook message. the regenerate/continue/delete buttons were sent with the final edit
+    chatbot.last_message_id = response_message.id
+    responseindex.get_index().add(response_message.id, platform.id, chatbot)
     logger.info(f"Finished and got GPT response. Platform: {platform.name} - {platform.id} - Chatbot: {chatbot.name}")
     return True
         
     
-async def handle_gpt_output_server(chatbot, user_message, response_message, converse_mode, regen_mode, platform, should_append_context, processed_chatbots):
+def remove_response_controls(message):
+    """Strips the buttons off an older reply in the background, so the new reply isn't held up."""
+    if message is None or not getattr(message, 'components', None):
+        return
+    task = asyncio.create_task(_remove_view(message))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _remove_view(message):
+    try:
+        await message.edit(view=None)
+    except Exception as e:
+        logger.info(f"could not remove response controls: {e}")
+
+async def send_loading_message(chatbot, user_message):
+    """Sends the loading message a reply streams into, as the chatbot."""
+    channel = webhookhandler.resolve_channel(user_message.channel)
+    thread_kwargs = {'thread': user_message.channel} if isinstance(user_message.channel, discord.Thread) else {}
+    webhook_registry = webhookhandler.get_registry()
+    og_webhook = await webhook_registry.get(channel) # cached per channel (created if missing). we use webhooks to send messages to get custom avatar URLs and names
+    try:
+        return await og_webhook.send(content=str(LOADING_EMOJI), username=chatbot.name, avatar_url=chatbot.avatar_url, wait=True, **thread_kwargs)
+    except discord.NotFound as e:
+        if not webhookhandler.is_unknown_webhook(e):
+            raise
+        webhook_registry.invalidate(channel.id) # webhook was deleted, make a new one
+        og_webhook = await webhook_registry.get(channel)
+        return await og_webhook.send(content=str(LOADING_EMOJI), username=chatbot.name, avatar_url=chatbot.avatar_url, wait=True, **thread_kwargs)
+
+async def handle_gpt_output_server(chatbot, user_message, response_message, converse_mode, regen_mode, platform, should_append_context, processed_chatbots, controls_view=None,
+                                   before_completion=None):
     logger.info("In handle gpt output server")
     if isinstance(user_message.channel, discord.Thread): # have to change some of the terminology if the message channel is a thread
         channel = user_message.channel.parent
@@ -108,103 +133,78 @@ async def handle_gpt_output_server(chatbot, user_message, response_message, conv
     else:
         thread_to_send = None
         channel = user_message.channel
-    webhooks = await channel.webhooks() # get the webhooks. if no DisAI webhook in the channel, create one. we use webhooks to send messages to get custom avatar URLs and names
-    og_webhook = None # the original webhook  
-    for webhook in webhooks:
-        if webhook.name == "Dis.AI Webhook":
-            og_webhook = webhook
-            break
-    else:
-        og_webhook = await channel.create_webhook(name="Dis.AI Webhook")
     if response_message: # response_message is a webhook message from dis.ai. if already there, edit it
-        await response_message.edit(content=str(LOADING_EMOJI))
+        if response_message.content != str(LOADING_EMOJI): # placeholders sent by run_response_plan already show it
+            await response_message.edit(content=str(LOADING_EMOJI))
     else: # otherwise, gotta send a message
-        
-        if thread_to_send:
-            response_message = await og_webhook.send(content=str(LOADING_EMOJI), username=chatbot.name, avatar_url=chatbot.avatar_url, thread=thread_to_send, wait=True)
-        else:
-            response_message = await og_webhook.send(content=str(LOADING_EMOJI), username=chatbot.name, avatar_url=chatbot.avatar_url, wait=True)
+        response_message = await send_loading_message(chatbot, user_message)
+    og_webhook = await webhookhandler.get_registry().get(channel) # cached, used for overflow messages
     tic = time.perf_counter()
-    await pre_gpt_response(converse_mode, regen_mode, platform, chatbot, user_message, should_append_context, processed_chatbots)
+    await pre_gpt_response(converse_mode, regen_mode, platform, chatbot, user_message, should_append_context, processed_chatbots, before_completion)
     toc = time.perf_counter()
     logger.info(f"{platform.name} ({platform.id}) - {chatbot.name}: pre gpt response took {toc-tic} seconds")
     i = 0 # represents the tokens
-    numbreaks = 0 # the number of CHUNK_SIZE-character batches
-    chunks = [] # store the batches
     context = chatbot.context[-1] # refer to the assistant content we just appended to 
     function_call_details = [] # if there's a function call, store the details here (since we stream it)
-    async with aiohttp.ClientSession() as session:
-        if chatbot.web_search:
-            payload = {
-                "model": chatbot.model,
-                "messages": chatbot.context,
-                "max_tokens": MAX_TOKENS,
-                "temperature": chatbot.temperature,
-                "top_p": chatbot.top_p,
-                "presence_penalty": chatbot.presence_penalty,
-                "frequency_penalty": chatbot.frequency_penalty,
-                "stream": True,
-                "functions": functions,
-                "function_call": "auto"
-            }
-        else:
-            payload = {
-                "model": chatbot.model,
-                "messages": chatbot.context,
-                "max_tokens": MAX_TOKENS,
-                "temperature": chatbot.temperature,
-                "top_p": chatbot.top_p,
-                "presence_penalty": chatbot.presence_penalty,
-                "frequency_penalty": chatbot.frequency_penalty,
-                "stream": True
-            }
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    session = await httphandler.get_session() # pooled, so the completions endpoint connection stays warm between replies
+    if chatbot.web_search:
+        payload = {
+            "model": chatbot.model,
+            "messages": chatbot.context,
+            "max_tokens": MAX_TOKENS,
+            "temperature": chatbot.temperature,
+            "top_p": chatbot.top_p,
+            "presence_penalty": chatbot.presence_penalty,
+            "frequency_penalty": chatbot.frequency_penalty,
+            "stream": True,
+            "functions": functions,
+            "function_call": "auto"
+        }
+    else:
+        payload = {
+            "model": chatbot.model,
+            "messages": chatbot.context,
+            "max_tokens": MAX_TOKENS,
+            "temperature": chatbot.temperature,
+            "top_p": chatbot.top_p,
+            "presence_penalty": chatbot.presence_penalty,
+            "frequency_penalty": chatbot.frequency_penalty,
+            "stream": True
+        }
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
+    # the render task edits the message on its own schedule (and starts new messages past CHUNK_SIZE), so the loop below never waits on Discord
+    send_overflow = partial(send_channel_msg_for_webhook, og_webhook, avatar_url=chatbot.avatar_url, chatbot_name=chatbot.name, should_send_LOADING_EMOJI=True, thread_to_send=thread_to_send)
+    render = liverender.LiveRender(response_message, send_overflow, og_webhook.id, loading_suffix=f" {str(LOADING_EMOJI)}", chunk_size=CHUNK_SIZE)
+    try:
         async with session.post("https://api.openai.com/v1/chat/completions", json=payload, headers=headers) as resp:
-            async for data in resp.content.iter_any(): 
-                data_strings = data.decode('utf-8').strip().split("\n\n") # convert the data to a json
-                for string in data_strings:
-                    if string != "data: [DONE]":
-                        data_dict = json.loads(string.replace("data: ", "")) # get rid of the 'data: ' prefix so we can convert it to a dictionary
+            async for data_dict in ssedecoder.iter_events(resp): # buffered, so frames split across reads are put back together
+                if 'error' in data_dict: # check for errors
+                    logger.error(f"handle gpt response ERROR: {platform.name} ({platform.id}) - {chatbot.name}: {data_dict}")
+                    del chatbot.context[-2:]
+                    if data_dict['error']['code'] == "context_length_exceeded":
+                        await send_error_message("The chat history is too long for this GPT Model.\nPlease use `/clearmemory` and try again.", user_message)
+                    elif data_dict['error']['type'] == 'server_error':
+                        logger.error(f"OpenAI server error: {data_dict}")
+                        await send_error_message("OpenAI had a server error. Please try again!\n(Sorry, this is OpenAI's fault, not ours!)", user_message)
                     else:
-                        break
-                    if 'error' in data_dict: # check for errors
-                        logger.error(f"handle gpt response ERROR: {platform.name} ({platform.id}) - {chatbot.name}: {data_dict}")
-                        del chatbot.context[-2:]
-                        if data_dict['error']['code'] == "context_length_exceeded":
-                            await send_error_message("The chat history is too long for this GPT Model.\nPlease use `/clearmemory` and try again.", user_message)
-                        elif data_dict['error']['type'] == 'server_error':
-                            logger.error(f"OpenAI server error: {data_strings}")
-                            await send_error_message("OpenAI had a server error. Please try again!\n(Sorry, this is OpenAI's fault, not ours!)", user_message)
-                        else:
-                            logger.error(f"Unexpected error: {data_strings}")
-                            await send_error_message(f"There was a small hiccup getting your response. Please try again.", user_message)
-                        return
-                    if i == 0:
-                        if 'function_call' in data_dict['choices'][0]['delta']: # check if the response is empty
-                            function_call_details.append(data_dict['choices'][0]['delta']['function_call']['name'])
-                        i += 1
-                        continue
-                    if 'function_call' in data_dict['choices'][0]['delta']:
-                        function_call_details.append(data_dict['choices'][0]['delta']['function_call']['arguments'])
-                    if 'content' in data_dict['choices'][0]['delta']:
-                        chunks.append(data_dict['choices'][0]['delta']['content'])
-                    if (i + 1) % 15 == 0:  # reached chunk threshold, update message with new chunk
-                        context['content'] += "".join(chunks)
-                        chunks = []
-                        if response_message is not None: # check if a response_message exists. if it doesn't, then create one by send_channel_msg. if it does, edit the response_message.
-                            # messages are chunked in groups in CHUNK_SIZE characters
-                            if len(context['content']) / (numbreaks + 1) <= CHUNK_SIZE: # check if the current message would exceed CHUNK_SIZE characters
-                                await response_message.edit(content=f"{context['content'][numbreaks*CHUNK_SIZE:(numbreaks+1)*CHUNK_SIZE]} {str(LOADING_EMOJI)}")
-                            else: #if yes, then edit the message w/ the rest of the chunk. then send the rest of the message.
-                                await response_message.edit(content=f"{context['content'][numbreaks*CHUNK_SIZE:(numbreaks+1)*CHUNK_SIZE]}")
-                                numbreaks += 1
-                                response_message = await send_channel_msg_for_webhook(og_webhook, f"--{context['content'][numbreaks*CHUNK_SIZE:(numbreaks+1)*CHUNK_SIZE]}", avatar_url=chatbot.avatar_url, chatbot_name=chatbot.name, should_send_LOADING_EMOJI=True, thread_to_send=thread_to_send)
-                                
-                        else: # response_message is none, which also means no webhook has been made. create the webhook for the chatbot and send the chunk. 
-                            response_message = await send_channel_msg_for_webhook(og_webhook, context['content'], avatar_url=chatbot.avatar_url, chatbot_name=chatbot.name, should_send_LOADING_EMOJI=True, thread_to_send=thread_to_send)
-                        await asyncio.sleep(1)
+                        logger.error(f"Unexpected error: {data_dict}")
+                        await send_error_message(f"There was a small hiccup getting your response. Please try again.", user_message)
+                    return
+                if i == 0:
+                    if 'function_call' in data_dict['choices'][0]['delta']: # check if the response is empty
+                        function_call_details.append(data_dict['choices'][0]['delta']['function_call']['name'])
                     i += 1
-    
+                    continue
+                if 'function_call' in data_dict['choices'][0]['delta']:
+                    function_call_details.append(data_dict['choices'][0]['delta']['function_call']['arguments'])
+                if 'content' in data_dict['choices'][0]['delta']:
+                    context['content'] += data_dict['choices'][0]['delta']['content']
+                    render.update(context['content'])
+                i += 1
+    finally:
+        response_message = await render.close()
+        chatbot.mark_dirty("context") # the reply was written into its entry in place, which the change tracking can't see
+
     # check for function call. 
     if function_call_details:
         if "google" in function_call_details[0]:
@@ -219,116 +219,193 @@ async def handle_gpt_output_server(chatbot, user_message, response_message, conv
             search_results = await search_google_using_natural_language(''.join(search_query), chatbot.bing_bots[user_message.channel.id])
             del chatbot.context[-1]
             chatbot.context.append({'role':"function", 'name': 'search_google_using_natural_language', 'content': search_results})
-            return await handle_gpt_output_server(chatbot, user_message, response_message, converse_mode, regen_mode, platform, should_append_context=False, processed_chatbots=processed_chatbots)
+            return await handle_gpt_output_server(chatbot, user_message, response_message, converse_mode, regen_mode, platform, should_append_context=False, processed_chatbots=processed_chatbots, controls_view=controls_view)
         
-    # send any remaining tokens that haven't been sent yet
-    context['content'] += "".join(chunks)
-    if response_message != None: # 
-        await response_message.edit(content=context['content'][numbreaks*CHUNK_SIZE:(numbreaks+1)*CHUNK_SIZE])
-    elif context['content']: # this happens if number of tokens never reaches 50. create a webhook and then send response_message
-        # og_webhook = await user_message.channel.create_webhook(name="Dis.AI Webhook")
-        if thread_to_send:
-            response_message = await og_webhook.send(username=chatbot.name, wait=True, content=context['content'][numbreaks*CHUNK_SIZE:(numbreaks+1)*CHUNK_SIZE], avatar_url=chatbot.avatar_url, thread=thread_to_send)
-        else:
-            response_message = await og_webhook.send(username=chatbot.name, wait=True, content=context['content'][numbreaks*CHUNK_SIZE:(numbreaks+1)*CHUNK_SIZE], avatar_url=chatbot.avatar_url)
+    # always flush the final text (without the loading emoji). the buttons ride along with this edit
+    if context['content']:
+        response_message = await render.finish(context['content'], view=controls_view)
     else:
         logger.error("Uknown error in handle_gpt_response_server.")
-        await send_error_message("Unknown error. Please join the support server for more help.", response_message, user_message.channel)
-    token_count = get_tokens(chatbot.model, chatbot.context)
-    platform.analytics.append((Analytics.GOT_GPT_RESPONSE.value, datetime.now(), token_count))
+        await send_error_message("Unknown error. Please join the support server for more help.", user_message)
+    token_count = await executors.run_cpu(get_tokens, chatbot.model, list(chatbot.context))
+    await update_analytics(platform, Analytics.GOT_GPT_RESPONSE.value, token_count)
     return response_message
                                 
-def find_order_in_string(string, chatbots):
-    found_chatbots = {chatbot: string.find(chatbot.name.lower()) for chatbot in chatbots if string.find(chatbot.name.lower()) != -1}
-    ordered_chatbots = sorted(found_chatbots.items(), key=lambda t: t[1])
-    return [chatbot for chatbot, _ in ordered_chatbots]
-
-async def handle_chatbot_list(chatbot_list, message, botuser, platform, processed_chatbots, ignore_mention_mode=False):
-    for i in range(len(chatbot_list)):
-        chatbot = chatbot_list[i]
-        if message.channel.id in chatbot.channels: # if chatbot is supposed to respond in this channel
+def is_addressed(chatbot, message, botuser):
+    """Whether a mention mode chatbot was mentioned / replied to."""
+    return botuser in message.mentions or bool(message.reference and message.reference.cached_message and message.reference.cached_message.author.name == chatbot.name)
+
+def get_last_assistant_message(chatbot):
+    for entry in reversed(chatbot.context):
+        if entry['role'] == 'assistant':
+            return entry['content']
+    return ""
+
+async def run_response_plan(plan, message, platform):
+    """
+    Queues a reply from every chatbot in plan (list of (chatbot, should_respond), in reply order). See utils/chatbotqueue:
+    each chatbot replies from its own queue, all at the same time, at most MAX_CONCURRENT_RESPONSES per server.
+    Loading messages for idle chatbots are sent up front in plan order, so replies show up in the same order as before.
+    Chatbots that see other bots start retrieval right away but wait for the earlier chatbots' replies before their own completion.
+    Earlier means earlier in platform.chatbots, not in the message: every plan waits in the same order, so two messages naming the same
+    chatbots in opposite orders can't each hold one chatbot's turn while waiting on the other.
+    """
+    rank = {chatbot: i for i, chatbot in enumerate(platform.chatbots)}
+    requests = {}
+    for chatbot, should_respond in sorted(plan, key=lambda entry: rank.get(entry[0], len(rank))): # earlier chatbots first, so their requests exist
+        if not should_respond: # mention mode chatbot that wasn't mentioned still keeps up with the conversation
+            add_context_only(chatbot, message)
+            continue
+        earlier = [cb for cb, _ in plan if rank.get(cb, len(rank)) < rank.get(chatbot, len(rank))]
+        wait_for = [requests[cb].done for cb in earlier if cb in requests] if chatbot.sees_other_bots else []
+        requests[chatbot] = chatbotqueue.ChatBotRequest(message, platform, plan, earlier, wait_for, make_buttons=False)
+    if not requests:
+        return
+    requests = {chatbot: requests[chatbot] for chatbot, should_respond in plan if should_respond} # back to the message's order
+    list(requests.values())[-1].make_buttons = True # only the last reply gets the regenerate/continue/delete buttons
+    for chatbot, request in requests.items(): # placeholders in order. the replies then stream into them in whatever order they finish
+        if not chatbotqueue.get_queue(chatbot).busy and platform.credits - get_credits_cost(chatbot.model) >= 0:
             try:
-                if (not chatbot.mention_mode or ignore_mention_mode or (chatbot.mention_mode and (botuser in message.mentions or (message.reference and message.reference.cached_message.author.name == chatbot.name)))):
-                    
-                        cost = get_credits_cost(chatbot.model)
-                        try:
-                            await processed_chatbots[-1].last_message.clear_reactions()
-                        except:
-                            pass
-                        response_success = await handle_gpt_response(platform, chatbot, message, cost, None, False, chatbot.should_make_buttons, processed_chatbots=processed_chatbots)
-                        if response_success:
-                            platform.credits -= cost
-                        for processed_chatbot in processed_chatbots:
-                            processed_chatbot.context.append({'role': 'user', 'content': f"{chatbot.name}: {chatbot.context[-1]['content']}"})
-                        processed_chatbots.append(chatbot)
-                elif chatbot.mention_mode:
-                    chatbot.context.append({'role': 'user', 'content': f"{message.author.display_name}: {message.content}"})
-                    for processed_chatbot in processed_chatbots:
-                        for entry in reversed(processed_chatbot.context): # find last assistant message
-                            if entry['role'] == 'assistant':
-                                last_assistant_message = entry['content']
-                                break
-                        chatbot.context.append({'role': 'user','content': f"{processed_chatbot.name}: {last_assistant_message}"})
-                    processed_chatbots.append(chatbot)
+                request.placeholder = await send_loading_message(chatbot, message)
             except Exception as e:
-                logger.error(f"handle_chatbot_list err {platform.name} ({platform.id}) - {chatbot.name}: {type(e)} - {e}")
+                logger.error(f"loading message err {platform.name} ({platform.id}) - {chatbot.name}: {type(e)} - {e}")
+    for chatbot, request in requests.items():
+        chatbotqueue.get_queue(chatbot).submit(request, run_turn)
+
+def add_context_only(chatbot, message):
+    chatbotqueue.get_queue(chatbot).add_context({'role': 'user', 'content': f"{message.author.display_name}: {message.content}"})
+
+async def send_busy_notice(message):
+    try:
+        await message.channel.send(embed=discord.Embed(title="Slow down!", description="Chatbots in this server are getting more messages than they can answer. Some messages were skipped.", color=discord.Colour.blue()), delete_after=30)
+    except discord.HTTPException as e:
+        logger.info(f"could not send busy notice: {e}")
+
+async def delete_placeholder(request):
+    if request.placeholder:
+        try:
+            await request.placeholder.delete()
+        except discord.HTTPException as e:
+            logger.info(f"could not delete loading message: {e}")
+        request.placeholder = None
+
+async def run_turn(chatbot, batch):
+    """
+    One turn of a chatbot's queue: a single reply to the newest queued message.
+    The messages before it (that arrived while the last reply was being generated) are added to the context first, so the reply covers the whole burst.
+    """
+    request = batch[-1]
+    platform, message = request.platform, request.message
+    for coalesced in batch[:-1]:
+        await handle_user_message(chatbot, coalesced.message, True, None)
+        await delete_placeholder(coalesced)
+
+    async def wait_for_earlier():
+        platform.response_semaphore.release() # don't hold a slot while waiting for other chatbots
+        try:
+            await asyncio.wait_for(asyncio.gather(*[event.wait() for event in request.wait_for]), timeout=EARLIER_REPLIES_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"{platform.name} ({platform.id}) - {chatbot.name}: gave up waiting for earlier chatbots")
+        finally:
+            await platform.response_semaphore.acquire()
+
+    async with platform.response_semaphore:
+        cost = get_credits_cost(chatbot.model)
+        if platform.credits - cost < 0: # credits ran out while it was queued
+            await delete_placeholder(request)
+        response_success = await handle_gpt_response(platform, chatbot, message, cost, request.placeholder, False, should_make_buttons=chatbot.should_make_buttons and request.make_buttons,
+                                                     processed_chatbots=request.earlier if chatbot.sees_other_bots else [],
+                                                     before_completion=wait_for_earlier if chatbot.sees_other_bots and request.wait_for else None)
+    if not response_success:
+        return
+    platform.credits -= cost
+    reply = get_last_assistant_message(chatbot)
+    if not reply:
+        return
+    for other, should_respond in request.plan: # cross-bot context
+        if other is chatbot:
+            continue
+        # earlier chatbots, silent ones and independent ones never saw this reply. later chatbots that see other bots read it themselves
+        if other in request.earlier or not should_respond or not other.sees_other_bots:
+            chatbotqueue.get_queue(other).add_context({'role': 'user', 'content': f"{chatbot.name}: {reply}"})
 
 async def process_ai_response(platform, message, botuser):
-    chatbot_channels = [chatbot.channels for chatbot in platform.chatbots]
-    for channels_list in chatbot_channels:
-        if message.channel.id in channels_list:
-            break
-    else:
+    channel_chatbots = platform.chatbots_in_channel(message.channel.id)
+    if not channel_chatbots:
         return
-    processed_chatbots = []
-    tic = time.perf_counter()
-    chatbots_order = find_order_in_string(message.content[:700].lower(), platform.chatbots)
-    toc = time.perf_counter()
-    
-    if not chatbots_order:
-        chatbots_order = []
-    await handle_chatbot_list(chatbots_order, message, botuser, platform, processed_chatbots, ignore_mention_mode=True)
-    remaining_chatbots = [chatbot for chatbot in platform.chatbots if chatbot not in chatbots_order]
-    await handle_chatbot_list(remaining_chatbots, message, botuser, platform, processed_chatbots, ignore_mention_mode=False)
+    plan = make_response_plan(platform, message, botuser, channel_chatbots)
+    if not any(should_respond for _, should_respond in plan): # chatter no chatbot answers only adds context. it costs no admission tokens
+        await run_response_plan(plan, message, platform)
+        return
+    result = await admission.get_controller().admit(platform.id, message) # may wait for this server's turn
+    if result.decision == admission.SHED:
+        for chatbot, should_respond in plan: # the silent chatbots still keep up with the conversation
+            if not should_respond:
+                add_context_only(chatbot, message)
+        if result.notify:
+            await send_busy_notice(message)
+        return
+    if result.decision == admission.COALESCED: # the message already waiting in this channel will answer it
+        return
+    *coalesced, message = result.messages
+    channel_chatbots = platform.chatbots_in_channel(message.channel.id) # may have changed while waiting
+    for chatbot in channel_chatbots: # messages merged while waiting are only added to the context
+        for earlier_message in coalesced:
+            chatbotqueue.get_queue(chatbot).add_context(make_user_entry(chatbot, earlier_message))
+    plan = make_response_plan(platform, message, botuser, channel_chatbots) # again: the message may be a newer one merged while waiting
+    await run_response_plan(plan, message, platform)
+
+def make_response_plan(platform, message, botuser, channel_chatbots):
+    """[(chatbot, should_respond)] in reply order. Named chatbots reply first, even in mention mode."""
+    chatbots_order = platform.find_named_chatbots(message.content[:700].lower())
+    named_chatbots = set(chatbots_order)
+    plan = [(chatbot, True) for chatbot in chatbots_order if message.channel.id in chatbot.channels]
+    for chatbot in channel_chatbots:
+        if chatbot not in named_chatbots:
+            plan.append((chatbot, not chatbot.mention_mode or is_addressed(chatbot, message, botuser)))
+    return plan
         
         
 async def handle_system_message(chatbot, working_index):
     if not chatbot.context or chatbot.context[working_index]['role'] != 'system':
         chatbot.context.insert(working_index, {'role':'system','content':chatbot.prompt})
 
-async def handle_user_message(chatbot, message, should_append_content, working_index):
+def make_user_entry(chatbot, message):
     content = message.content
+    if chatbot.include_usernames:
+        content = f"{message.author.display_name}: {content}"
+    return {'role': 'user', 'content': content}
+
+async def handle_user_message(chatbot, message, should_append_content, working_index):
     if should_append_content:
-        if chatbot.include_usernames:
-            content = f"{message.author.display_name}: {content}"
-        chatbot.context.append({'role': 'user', 'content': content})
+        chatbot.context.append(make_user_entry(chatbot, message))
+
+async def archive_long_term_memory(chatbot, platform_id):
+    """Moves old messages out of the context. The archiver stores them in the long term memory namespace in the background."""
+    if chatbot.long_term_memory and len(chatbot.context) > MEMORY_LENGTH:
+        non_system_index = next((index for index, dict in enumerate(chatbot.context) if dict['role'] != 'system'), 0) # index of first non-system message
+        ltmarchiver.get_archiver().archive(chatbot, platform_id, chatbot.context[non_system_index:len(chatbot.context) - 3])
+        del chatbot.context[non_system_index:len(chatbot.context) - 3]
 
-async def handle_long_term_memory(chatbot, platform_id, message, working_index):
+async def handle_long_term_memory(chatbot, platform_id, results, working_index):
     if chatbot.long_term_memory:
-        executor = ThreadPoolExecutor()
-        if len(chatbot.context) > MEMORY_LENGTH:
-            non_system_index = next((index for index, dict in enumerate(chatbot.context) if dict['role'] != 'system'), 0) # index of first non-system message
-            chatbot.batch_number = await pineconehandler.upsert_data(chatbot.context[non_system_index:len(chatbot.context) - 3], 
-                                                                     f"{platform_id}-{chatbot.name}", chatbot.batch_number + 1, window=2,stride=1,batch_size=10)
-            del chatbot.context[non_system_index:len(chatbot.context) - 3]
         try:
-            pinecone_query = await asyncio.get_event_loop().run_in_executor(executor, pineconehandler.search_pinecone, message.content, f"{platform_id}-{chatbot.name}")
+            pinecone_query = results.get(f"{platform_id}-{chatbot.name}")
             if pinecone_query:
                 working_index += 1
                 queries = '\n'.join(pinecone_query)
                 prompt_pamper = f"<Here are some previous chat messages. If relevant, use the information from these messages in your response>\n{queries}\n</END OF PREVIOUS CHAT MESSAGES>"
                 if working_index < len(chatbot.context) and chatbot.context[working_index]['content'].endswith("MESSAGES>") and chatbot.context[working_index]['role'] == "system":
-                    chatbot.context[working_index]['content'] = prompt_pamper
+                    chatbot.context[working_index] = {**chatbot.context[working_index], 'content': prompt_pamper} # a new entry, so backups see the change
                 else:
                     chatbot.context.insert(working_index, {'role':'system','content':prompt_pamper})
         except Exception as e:
             logger.error(f"pinecone query err: {e}")
 
-async def handle_data(chatbot, platform_id, message, working_index):
+async def handle_data(chatbot, platform_id, results, working_index):
     if chatbot.data_name:
         working_index += 1
-        executor = ThreadPoolExecutor()
-        pinecone_query = await asyncio.get_event_loop().run_in_executor(executor, pineconehandler.search_pinecone, message.content, f"{platform_id}-{chatbot.name}-data")
+        pinecone_query = results.get(f"{platform_id}-{chatbot.name}-data")
         if pinecone_query:
             queries = ''.join(pinecone_query)
             if chatbot.data_name[0] == "Y":
@@ -337,31 +414,46 @@ async def handle_data(chatbot, platform_id, message, working_index):
                 stamp_str = "page number"
             prompt_pamper = f"The user uploaded the data of a {chatbot.data_name}. If relevant, respond to the user using this new information. If you cannot answer the user, tell them to be more specific about the question. Always include the {stamp_str} from which you derived your answer. The following is an excerpt from the new information.\n<Excerpt>\n{queries}\n</Excerpt>"
             if working_index < len(chatbot.context) and chatbot.context[working_index]['content'].endswith("</Excerpt>") and chatbot.context[0]['role'] == "system":
-                chatbot.context[working_index]['content'] = prompt_pamper.replace('\n', '')
+                chatbot.context[working_index] = {**chatbot.context[working_index], 'content': prompt_pamper.replace('\n', '')}
             else:
                 chatbot.context.insert(working_index, {'role':'system','content':prompt_pamper})
 
 
-async def handle_lorebooks(chatbot, platform_id, message, working_index):
-    executor = ThreadPoolExecutor()
+async def handle_lorebooks(chatbot, platform_id, results, working_index):
     for lorebook in chatbot.lorebooks:
         working_index += 1
-        pinecone_query = await asyncio.get_event_loop().run_in_executor(executor, pineconehandler.search_pinecone, message.content, f"{platform_id}-{chatbot.name}-{lorebook}")
+        pinecone_query = results.get(f"{platform_id}-{chatbot.name}-{lorebook}")
         if pinecone_query:
             queries = ''.join(pinecone_query)
             prompt_pamper = f"[Important character and world information for {chatbot.name}]:\n{queries}\n[End of character and world information]. Be sure to dynamically and creatively use this information in your response."
             if working_index < len(chatbot.context) and chatbot.context[working_index]['content'].endswith("r response.") and chatbot.context[0]['role'] == "system":
-                chatbot.context[working_index]['content'] = prompt_pamper.replace('\n', '')
+                chatbot.context[working_index] = {**chatbot.context[working_index], 'content': prompt_pamper.replace('\n', '')}
             else:
                 chatbot.context.insert(working_index, {'role':'system','content':prompt_pamper})
 
+async def retrieve_context(chatbot, platform_id, message):
+    """Embeds the message once and queries the lorebook, data and long term memory namespaces concurrently."""
+    namespaces = [f"{platform_id}-{chatbot.name}-{lorebook}" for lorebook in chatbot.lorebooks]
+    if chatbot.data_name:
+        namespaces.append(f"{platform_id}-{chatbot.name}-data")
+    if chatbot.long_term_memory:
+        namespaces.append(f"{platform_id}-{chatbot.name}")
+    if not namespaces or not message.content:
+        return {}
+    results, timings = await pineconehandler.retrieve(message.content, namespaces, RETRIEVAL_DEADLINE)
+    logger.info(f"{platform_id} {chatbot.name} - retrieval: embed {timings['embed']:0.3f}s, {len(namespaces)} queries {timings['query']:0.3f}s, total {timings['total']:0.3f}s")
+    return results
+
 async def pamper_context(platform_id, chatbot, message, should_append_content=True):
     try:
         working_index = 0
         await handle_system_message(chatbot, working_index)
-        await handle_lorebooks(chatbot, platform_id, message, working_index)
-        await handle_data(chatbot, platform_id, message, working_index)
-        await handle_long_term_memory(chatbot, platform_id, message, working_index)
+        await archive_long_term_memory(chatbot, platform_id)
+        results = await retrieve_context(chatbot, platform_id, message)
+        # injections are applied in a fixed order once every query is in, whatever order the queries finished in
+        await handle_lorebooks(chatbot, platform_id, results, working_index)
+        await handle_data(chatbot, platform_id, results, working_index)
+        await handle_long_term_memory(chatbot, platform_id, results, working_index)
         await handle_user_message(chatbot, message, should_append_content, working_index)
     except Exception as e:
         logger.error(f"{platform_id} {chatbot.name} - pamper err: {e}") 
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+import pymongo
+
+from config import MONGO_LINK, MONGO_NAME
+from utils.executors import ManagedPool
+from utils import services
+
+"""Async data access for MongoDB. pymongo blocks, so every operation runs in a pool of threads of its own, sized to the driver's
+connection pool: a slow Mongo round trip holds one of those threads, never the event loop or the shared I/O pool. Each operation has
+a timeout, enforced by the driver, and its latency goes into a per-operation histogram."""
+
+# Constants
+DB_WORKERS = 8 # threads, and pymongo's maxPoolSize, so a thread never waits for a connection
+MIN_POOL_SIZE = 1
+CONNECT_TIMEOUT = 5 # seconds
+SERVER_SELECTION_TIMEOUT = 5 # seconds to find a usable server before an operation fails
+OP_TIMEOUT = 10 # seconds per operation, unless the caller passes its own
+CLOSE_TIMEOUT = 10
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500) # ms, upper bounds. the last bucket is everything slower
+
+logger = logging.getLogger(__name__)
+
+
+class OperationStats:
+    """Latency histogram of one kind of operation."""
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds: float, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.total_time += seconds
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds * 1000)] += 1
+
+    def percentile(self, share: float) -> float:
+        """Upper bound (ms) of the bucket holding the given share of calls. inf if it's the last bucket."""
+        target = share * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}ms"]
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": self.total_time / self.calls * 1000 if self.calls else 0,
+            "p50_ms": self.percentile(0.5) if self.calls else 0,
+            "p95_ms": self.percentile(0.95) if self.calls else 0,
+            "histogram": dict(zip(labels, self.buckets)),
+        }
+
+
+class MongoRepository:
+    """
+    The bot's database. Methods take a collection name and mirror the pymongo calls dbhandler used; find returns a list.
+    The client is created here but connects in the background, so constructing this doesn't block.
+    """
+    def __init__(self, link: str = MONGO_LINK, name: str = MONGO_NAME, workers: int = DB_WORKERS):
+        self.client = pymongo.MongoClient(link, maxPoolSize=workers, minPoolSize=MIN_POOL_SIZE, connectTimeoutMS=CONNECT_TIMEOUT * 1000,
+                                          serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT * 1000)
+        self.db = self.client[name]
+        self.pool = ManagedPool("db", workers)
+        self._lock = threading.Lock()
+        self._operations = {} # operation name -> OperationStats
+
+    async def _run(self, operation: str, func, timeout: float):
+        def call():
+            with pymongo.timeout(timeout): # the driver gives up (and tells the server to) once this runs out
+                return func()
+
+        tic = time.perf_counter()
+        failed = True
+        try:
+            result = await self.pool.run(call)
+            failed = False
+            return result
+        except Exception as e:
+            logger.error(f"mongo {operation} err: {type(e)} - {e}")
+            raise
+        finally:
+            with self._lock:
+                self._operations.setdefault(operation, OperationStats()).record(time.perf_counter() - tic, failed)
+
+    async def find_one(self, collection: str, filter: dict, timeout: float = OP_TIMEOUT):
+        return await self._run("find_one", lambda: self.db[collection].find_one(filter), timeout)
+
+    async def find(self, collection: str, filter: dict = None, projection: dict = None, timeout: float = OP_TIMEOUT) -> list:
+        return await self._run("find", lambda: list(self.db[collection].find(filter if filter else {}, projection)), timeout)
+
+    async def insert_one(self, collection: str, document: dict, timeout: float = OP_TIMEOUT):
+        return await self._run("insert_one", lambda: self.db[collection].insert_one(document), timeout)
+
+    async def insert_many(self, collection: str, documents: list, ordered: bool = True, timeout: float = OP_TIMEOUT):
+        return await self._run("insert_many", lambda: self.db[collection].insert_many(documents, ordered=ordered), timeout)
+
+    async def update_one(self, collection: str, filter: dict, update: dict, upsert: bool = False, timeout: float = OP_TIMEOUT):
+        return await self._run("update_one", lambda: self.db[collection].update_one(filter, update, upsert=upsert), timeout)
+
+    async def replace_one(self, collection: str, filter: dict, document: dict, upsert: bool = False, timeout: float = OP_TIMEOUT):
+        return await self._run("replace_one", lambda: self.db[collection].replace_one(filter, document, upsert=upsert), timeout)
+
+    async def delete_one(self, collection: str, filter: dict, timeout: float = OP_TIMEOUT):
+        return await self._run("delete_one", lambda: self.db[collection].delete_one(filter), timeout)
+
+    async def bulk_write(self, collection: str, requests: list, ordered: bool = False, timeout: float = OP_TIMEOUT):
+        return await self._run("bulk_write", lambda: self.db[collection].bulk_write(requests, ordered=ordered), timeout)
+
+    async def close(self):
+        """Let running operations finish (queued ones are dropped), then close the connections."""
+        self.pool.shutdown(wait=False)
+        try:
+            await asyncio.wait_for(asyncio.to_thread(self.pool.shutdown, True), timeout=CLOSE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"mongo operations still running after {CLOSE_TIMEOUT}s")
+        self.client.close()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {"pool": self.pool.stats(), "operations": {operation: stats.to_dict() for operation, stats in self._operations.items()}}
+
+
+get_repository = services.accessor("database", MongoRepository)
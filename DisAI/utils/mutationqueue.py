@@ -0,0 +1,187 @@
+import asyncio
+import json
+import logging
+import os
+from collections import deque
+
+from utils import executors, retrievalcache, services, vectorstore
+
+"""Work queue for vector store mutations. Namespace deletes return as soon as they're queued (and saved to disk, so a restart finishes them);
+upserts are awaited by upsert_data for backpressure. One worker applies everything in order per namespace, merging what piled up.
+Every applied mutation bumps the namespace's version in utils/retrievalcache, so cached query results never outlive a change."""
+
+# Constants
+PENDING_PATH = "pending_deletes.json"
+UPSERT_BATCH = 100 # vectors per store call
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1 # seconds, doubled after each failed attempt
+RETRY_LATER = 60 # seconds before a delete that ran out of attempts is tried again
+
+# Mutation kinds
+UPSERT = "upsert"
+DELETE = "delete"
+
+logger = logging.getLogger(__name__)
+
+
+class Mutation:
+    def __init__(self, kind: str, namespace: str, vectors: list = None):
+        self.kind = kind
+        self.namespace = namespace
+        self.vectors = vectors
+        self.future = asyncio.get_running_loop().create_future() if kind == UPSERT else None # deletes are fire-and-forget
+
+
+class MutationQueue:
+    """
+    Per namespace, mutations run in the order they were queued: an upsert queued after a delete lands after it, and a delete
+    makes the upserts queued before it moot (they are skipped). Different namespaces are applied concurrently.
+    While a namespace has a delete pending, is_deleting is true and retrieval skips it, so it's never read half deleted.
+    """
+    def __init__(self, path: str = PENDING_PATH):
+        self.path = path
+        self._pending = deque()
+        self._deleting = {} # namespace -> deletes queued and not yet applied
+        self._held = {} # namespace -> mutations waiting behind a delete that failed, to be retried later
+        self._save_lock = asyncio.Lock() # one save at a time, so an older snapshot never lands after a newer one
+        self._task = None
+        self.stats = {"upserts": 0, "deletes": 0, "superseded": 0, "batches": 0, "retries": 0, "failed": 0}
+
+    async def start(self):
+        """Re-queue the deletes that were pending when the bot stopped."""
+        try:
+            namespaces = await executors.run_io(self._load)
+        except Exception as e:
+            logger.error(f"pending deletes load err: {e}")
+            return
+        for namespace in namespaces:
+            self._enqueue(Mutation(DELETE, namespace))
+        if namespaces:
+            logger.info(f"resuming {len(namespaces)} namespace deletes")
+
+    def _load(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save(self, namespaces: list):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(namespaces, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    async def _persist(self):
+        async with self._save_lock:
+            try:
+                await executors.run_io(self._save, list(self._deleting)) # snapshot taken once it's our turn, so it's the latest
+            except Exception as e:
+                logger.error(f"pending deletes save err: {e}")
+
+    def is_deleting(self, namespace: str) -> bool:
+        return namespace in self._deleting
+
+    def _enqueue(self, mutation: Mutation):
+        if mutation.kind == DELETE:
+            self._deleting[mutation.namespace] = self._deleting.get(mutation.namespace, 0) + 1
+        self._pending.append(mutation)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def delete(self, namespace: str):
+        """Queue a namespace delete. Returns once it's saved, not once it's applied."""
+        self._enqueue(Mutation(DELETE, namespace))
+        retrievalcache.get_cache().bump(namespace)
+        await self._persist()
+
+    async def upsert(self, namespace: str, vectors: list):
+        """Queue an upsert and wait for it to be applied (or skipped because the namespace was deleted after it)."""
+        mutation = Mutation(UPSERT, namespace, vectors)
+        self._enqueue(mutation)
+        await mutation.future
+
+    async def _run(self):
+        while self._pending:
+            batch = list(self._pending)
+            self._pending.clear()
+            by_namespace = {}
+            for mutation in batch:
+                by_namespace.setdefault(mutation.namespace, []).append(mutation)
+            self.stats["batches"] += 1
+            await asyncio.gather(*(self._apply(namespace, mutations) for namespace, mutations in by_namespace.items()))
+
+    async def _apply(self, namespace: str, mutations: list):
+        if namespace in self._held: # keep the order behind the failed delete
+            self._held[namespace].extend(mutations)
+            return
+        deletes = [i for i, mutation in enumerate(mutations) if mutation.kind == DELETE]
+        if deletes:
+            for mutation in mutations[:deletes[-1]]: # everything before the last delete is deleted anyway
+                if mutation.kind == UPSERT and not mutation.future.done():
+                    mutation.future.set_result(None)
+                    self.stats["superseded"] += 1
+            try:
+                await self._attempt(vectorstore.get_store().delete_namespace, namespace)
+            except Exception as e:
+                logger.error(f"delete namespace err ({namespace}), retrying in {RETRY_LATER}s: {e}")
+                self._held[namespace] = mutations[deletes[-1]:]
+                asyncio.get_running_loop().call_later(RETRY_LATER, self._requeue, namespace)
+                return
+            self._deleting[namespace] -= len(deletes)
+            if self._deleting[namespace] <= 0:
+                del self._deleting[namespace]
+            self.stats["deletes"] += len(deletes)
+            retrievalcache.get_cache().bump(namespace)
+            await self._persist()
+            mutations = mutations[deletes[-1] + 1:]
+
+        upserts = [mutation for mutation in mutations if not mutation.future.done()] # the waiter may have been cancelled
+        vectors = [vector for mutation in upserts for vector in mutation.vectors]
+        try:
+            for start in range(0, len(vectors), UPSERT_BATCH):
+                await self._attempt(vectorstore.get_store().upsert, namespace, vectors[start:start + UPSERT_BATCH])
+        except Exception as e:
+            self.stats["failed"] += len(upserts)
+            logger.error(f"upsert err ({namespace}): {e}")
+            for mutation in upserts:
+                if not mutation.future.done():
+                    mutation.future.set_exception(e)
+            return
+        finally:
+            if vectors: # some batches may have landed even if a later one failed
+                retrievalcache.get_cache().bump(namespace)
+        self.stats["upserts"] += len(upserts)
+        for mutation in upserts:
+            if not mutation.future.done():
+                mutation.future.set_result(None)
+
+    async def _attempt(self, func, *args):
+        """Run a store call in the I/O pool, retrying with backoff. Upserts by id and namespace deletes are idempotent, so retrying is safe."""
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return await executors.run_io(func, *args)
+            except Exception as e:
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                self.stats["retries"] += 1
+                logger.error(f"vector store call failed (attempt {attempt + 1}/{MAX_ATTEMPTS}): {e}")
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+
+    def _requeue(self, namespace: str):
+        # the deletes are still counted in _deleting, so put them back without _enqueue
+        self._pending.extend(self._held.pop(namespace))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10):
+        """Give queued mutations a moment to finish. Deletes that don't are already saved and run after the restart."""
+        if self._task and not self._task.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"vector store queue: {len(self._pending)} mutations still pending at shutdown")
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "pending": len(self._pending), "deleting": len(self._deleting)}
+
+
+get_queue = services.accessor("vector_queue", MutationQueue)
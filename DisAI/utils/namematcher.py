@@ -0,0 +1,108 @@
+import random
+import re
+import string
+import time
+
+"""Multi-pattern chatbot name matcher. Finds every chatbot named in a message in one regex pass over all the names,
+instead of two str.find calls per chatbot. Each Platform keeps one, rebuilt only when its chatbots change.
+Measured with benchmark() on ~140 character messages: about even with str.find up to ~10 chatbots, faster past that
+(~1.2x at 13 chatbots, ~1.6x at 43), since the regex scans the text once however many names there are."""
+
+
+class NameMatcher:
+    """
+    Compiled alternation over the lowercase names of a list of chatbots, longest name first. One finditer over the text yields
+    non-overlapping matches (the longest name at the leftmost position); any other name starting inside a match comes from tables
+    built once: the names contained in it are there for sure, the ones running past its end are checked with one startswith.
+    find_order(text) returns the named chatbots ordered by where their name first appears (ties keep list order), same as the str.find version it replaced.
+    """
+    def __init__(self, chatbots: list):
+        self.chatbots = list(chatbots)
+        self.names = [chatbot.name.lower() for chatbot in self.chatbots]
+        self._indexes = {} # name -> indexes of the chatbots with that name
+        for index, name in enumerate(self.names):
+            if name:
+                self._indexes.setdefault(name, []).append(index)
+        self._contained = {} # name -> [(offset, other name)] of the other names inside it (offset 0: a prefix, shorter)
+        self._overlapping = {} # name -> [(offset, other name)] of the names that start inside it and run past its end
+        for name in self._indexes:
+            self._contained[name] = sorted((offset, other) for other in self._indexes if other != name
+                                           for offset in _occurrences(name, other))
+            self._overlapping[name] = sorted((offset, other) for other in self._indexes for offset in range(1, len(name))
+                                             if len(other) > len(name) - offset and other.startswith(name[offset:]))
+        patterns = sorted(self._indexes, key=len, reverse=True)
+        self._regex = re.compile("|".join(map(re.escape, patterns))) if patterns else None
+
+    def find_order(self, text: str) -> list:
+        if self._regex is None:
+            return []
+        first_seen = {} # name -> start of its first occurrence
+        for match in self._regex.finditer(text):
+            start = match.start()
+            name = match.group()
+            if name not in first_seen:
+                first_seen[name] = start
+            for offset, other in self._contained[name]:
+                if other not in first_seen:
+                    first_seen[other] = start + offset
+            for offset, other in self._overlapping[name]:
+                if other not in first_seen and text.startswith(other, start + offset):
+                    first_seen[other] = start + offset
+            if len(first_seen) == len(self._indexes):
+                break
+        found = sorted((start, index) for name, start in first_seen.items() for index in self._indexes[name])
+        return [self.chatbots[index] for _, index in found]
+
+
+def _occurrences(text: str, name: str):
+    start = text.find(name)
+    while start != -1:
+        yield start
+        start = text.find(name, start + 1)
+
+def _legacy_find_order(string, chatbots):
+    """The old per-chatbot str.find version, kept for benchmark comparison."""
+    found_chatbots = {chatbot: string.find(chatbot.name.lower()) for chatbot in chatbots if string.find(chatbot.name.lower()) != -1}
+    ordered_chatbots = sorted(found_chatbots.items(), key=lambda t: t[1])
+    return [chatbot for chatbot, _ in ordered_chatbots]
+
+class _BenchBot:
+    def __init__(self, name):
+        self.name = name
+
+def benchmark(bots=20, messages=2000, rounds=20, overlapping=True):
+    """Cost of finding the named chatbots in a message, for a server with `bots` chatbots. Run with `python -m utils.namematcher`."""
+    random.seed(0)
+    chatbots = [_BenchBot("".join(random.choices(string.ascii_letters, k=random.randint(3, 12)))) for _ in range(bots)]
+    if overlapping: # names that contain / overlap each other, the case a single leftmost-match scan would get wrong
+        chatbots += [_BenchBot(chatbots[0].name[:3]), _BenchBot(chatbots[1].name + "bot"), _BenchBot(chatbots[2].name)]
+    words = ["hey", "what", "do", "you", "think", "about", "the", "new", "update", "lol", "and", "me", "?"]
+    texts = []
+    for _ in range(messages):
+        message_words = random.choices(words, k=random.randint(3, 60))
+        for _ in range(random.choice((0, 0, 1, 2))): # most messages don't name a chatbot
+            message_words.insert(random.randint(0, len(message_words)), random.choice(chatbots).name)
+        texts.append(" ".join(message_words)[:700].lower())
+
+    tic = time.perf_counter()
+    matcher = NameMatcher(chatbots)
+    build = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    for _ in range(rounds):
+        results = [matcher.find_order(text) for text in texts]
+    compiled = (time.perf_counter() - tic) / (rounds * messages)
+
+    tic = time.perf_counter()
+    for _ in range(rounds):
+        legacy_results = [_legacy_find_order(text, chatbots) for text in texts]
+    legacy = (time.perf_counter() - tic) / (rounds * messages)
+    assert results == legacy_results
+
+    print(f"{len(chatbots)} chatbots, {messages} messages (avg {sum(map(len, texts)) / len(texts):0.0f} chars)")
+    print(f"matcher build: {build * 1e6:0.1f} us")
+    print(f"compiled matcher: {compiled * 1e6:0.2f} us/message")
+    print(f"str.find per chatbot: {legacy * 1e6:0.2f} us/message")
+
+if __name__ == "__main__":
+    benchmark()
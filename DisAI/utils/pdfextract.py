@@ -0,0 +1,24 @@
+import io
+
+import PyPDF2
+
+"""PDF text extraction, run in the process pool (utils/executors.run_process). Kept free of bot imports, so worker processes
+start fast. Everything reads the PDF from its bytes in memory; nothing is written to disk."""
+
+# Constants
+MIN_PAGES_PER_TASK = 25 # smaller ranges cost more in re-parsing and pickling the PDF than they save
+
+
+def count_pages(pdf_data: bytes) -> int:
+    """Parses only the page tree, so the page limit is checked before any text is extracted."""
+    return len(PyPDF2.PdfReader(io.BytesIO(pdf_data)).pages)
+
+def split_pages(num_pages: int, workers: int) -> list:
+    """[(start, end)] page ranges, in order, about one per worker."""
+    per_task = max(MIN_PAGES_PER_TASK, -(-num_pages // max(1, workers)))
+    return [(start, min(num_pages, start + per_task)) for start in range(0, num_pages, per_task)]
+
+def extract_pages(pdf_data: bytes, start: int, end: int) -> list:
+    """[(page number, text)] for pages start..end-1."""
+    reader = PyPDF2.PdfReader(io.BytesIO(pdf_data))
+    return [(page_num, reader.pages[page_num].extract_text().replace('\n', '')) for page_num in range(start, end)]
@@ -1,33 +1,174 @@
-import pinecone
 import openai
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import discord
+import hashlib
 import logging
+import random
 
-from time import perf_counter
-from config import PINECONE_API_KEY, PINECONE_ENV, OPENAI_API_KEY
-pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENV)
+from collections import deque
+from time import perf_counter, time
+from config import OPENAI_API_KEY
+from utils import admission, embedbatcher, embeddingcache, executors, mutationqueue, retrievalcache, vectorstore
 openai.api_key = OPENAI_API_KEY
 
-index = pinecone.Index("disai")
 embed_model = "text-embedding-ada-002"
 window = 1
 stride = 1
 batch_size=10
+TOP_K = 3
+EMBED_CONCURRENCY = 4 # embedding batches in flight per ingestion
+EMBED_TPM = 1000000 # tokens per minute for the embedding model, shared by every ingestion
+MAX_EMBED_ATTEMPTS = 6
+BACKOFF_BASE = 1 # seconds, doubled after each failed attempt (with jitter)
+BACKOFF_CAP = 30
+PROGRESS_INTERVAL = 3 # min seconds between progress edits
+DEAD_LETTERS = 100 # failed batches kept for inspection
+
+embed_budget = admission.TokenBucket(EMBED_TPM / 60, EMBED_TPM)
+dead_letters = deque(maxlen=DEAD_LETTERS)
+ingestion_stats = {
+    "ingestions": 0,
+    "batches": 0,
+    "vectors": 0,
+    "retries": 0,
+    "dead_lettered": 0, # batches given up on
+}
+
+retrieval_stats = {
+    "retrievals": 0,
+    "namespace_queries": 0,
+    "embed_time": 0.0, # total seconds
+    "query_time": 0.0, # total seconds from embedding done to last query done
+    "deadline_misses": 0, # namespace queries (or embeddings) dropped because the deadline passed
+}
 
 logger = logging.getLogger(__name__)
 
+
+class IngestionIncomplete(Exception):
+    """upsert_data stored everything it could, but dropped windows were dead-lettered."""
+    def __init__(self, dropped, total):
+        super().__init__(f"{dropped} of {total} windows couldn't be stored")
+        self.dropped = dropped
+        self.total = total
+
 def create_embedding(texts, embed_model):
     return openai.Embedding.create(input=texts, engine=embed_model)
 
-def upsert_vectors(to_upsert, namespace):
-    index.upsert(vectors=to_upsert, namespace=namespace)
+async def send_embeddings(texts):
+    res = await executors.run_io(create_embedding, texts, embed_model)
+    return [record['embedding'] for record in res['data']]
+
+embed_batcher = embedbatcher.EmbeddingBatcher(send_embeddings) # retrieval queries from every server, sent together
+
+async def get_embeddings(texts):
+    """
+    Embeddings for texts, from the embedding cache where possible. Only the misses are sent to OpenAI, in one request.
+    Small requests (retrieval queries) join the micro-batcher so concurrent ones share a request; ingestion batches go straight out.
+    """
+    cache = embeddingcache.get_cache()
+    vectors = await cache.get_many(embed_model, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+        if len(missing_texts) < embed_batcher.max_items:
+            new_vectors = await embed_batcher.embed(missing_texts)
+        else:
+            new_vectors = await send_embeddings(missing_texts)
+        await cache.put_many(embed_model, missing_texts, new_vectors)
+        by_text = dict(zip(missing_texts, new_vectors))
+        for i in missing:
+            vectors[i] = by_text[texts[i]]
+    return vectors
+
+async def upsert_vectors(to_upsert, namespace):
+    await mutationqueue.get_queue().upsert(namespace, to_upsert)
+
+
+class IngestionProgress:
+    """
+    Shows the share of windows that are done (stored or dead-lettered) on message_to_edit, at most every PROGRESS_INTERVAL seconds.
+    offset is how many windows from the start are all done (batches finish out of order); on_progress(offset) is awaited when it moves.
+    """
+    def __init__(self, message_to_edit, data_str, total, start=0, on_progress=None):
+        self.message_to_edit = message_to_edit
+        self.data_str = data_str
+        self.total = total
+        self.done = start
+        self.offset = start
+        self.on_progress = on_progress
+        self._finished = {} # batch offset -> windows, for batches done past self.offset
+        self._last_edit = float("-inf")
+
+    async def advance(self, batch_offset, count):
+        self.done += count
+        self._finished[batch_offset] = count
+        if self.offset in self._finished:
+            while self.offset in self._finished:
+                self.offset += self._finished.pop(self.offset)
+            if self.on_progress:
+                await self.on_progress(self.offset)
+        if not self.message_to_edit or self.done >= self.total or perf_counter() - self._last_edit < PROGRESS_INTERVAL:
+            return
+        self._last_edit = perf_counter()
+        percent = self.done / self.total * 100
+        try:
+            await self.message_to_edit.edit(embed=discord.Embed(title=f"Processing {self.data_str}...",  description=f"{percent:.2f}% Processed\n\n(This may take a while for large data...)", color=discord.Colour.blue()))
+        except Exception as e:
+            logger.error(f"ingestion progress edit err: {e}")
+
+def make_windows(data, batch_number, window, stride, type, secondary_listing, hash_ids=False):
+    """Merges each window of items in data into one text to embed (skipping by stride). hash_ids: ids are sha256 hashes of the text instead of positions."""
+    new_data = []
+    join_str = " "
+    for i in range(0, len(data), stride): # for each {role, content} in data (skip by stride amount)
+        i_end = min(len(data), i+window) 
+        text_values = [item['content'] for item in data[i:i_end]]
+        stamp = f"{secondary_listing} {data[i]['location']})" if (type != "chatbot" and type != "lorebook") else ""
+        text = f"{stamp}{join_str.join(text_values)}{join_str}"
+        new_data.append({
+            'text': text,
+            'id': hashlib.sha256(text.encode('utf-8')).hexdigest() if hash_ids else str(i + batch_number),
+        })
+    return new_data
+
+def estimate_tokens(texts):
+    return sum(len(text) for text in texts) // 4 + len(texts) # ~4 characters per token, close enough for budgeting
+
+async def reserve_tokens(tokens):
+    """Wait until the embedding budget has room for tokens, then take them."""
+    while (delay := embed_budget.time_until(tokens)) > 0:
+        await asyncio.sleep(delay)
+    embed_budget.take(tokens)
+
+async def with_backoff(func, *args, attempts=MAX_EMBED_ATTEMPTS):
+    """Await func(*args), retrying with full jitter exponential backoff. Raises the last error after `attempts` tries."""
+    for attempt in range(attempts):
+        try:
+            return await func(*args)
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            ingestion_stats["retries"] += 1
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            logger.error(f"Ratelimited (attempt {attempt + 1}/{attempts}), retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
 
+def dead_letter(namespace, batch, stage, error):
+    dead_letters.append({"namespace": namespace, "ids": [x['id'] for x in batch], "texts": [x['text'] for x in batch],
+                         "stage": stage, "error": str(error), "time": time()})
+    ingestion_stats["dead_lettered"] += 1
+    logger.error(f"ingestion {stage} gave up on {len(batch)} windows in {namespace}: {error}")
 
-async def upsert_data(data, namespace, batch_number, window=1, stride=1, batch_size=10, type="chatbot", message_to_edit=None):
-    """https://docs.pinecone.io/docs/gen-qa-openai to learn more about this function"""
-    executor = ThreadPoolExecutor()
+async def upsert_data(data, namespace, batch_number, window=1, stride=1, batch_size=10, type="chatbot", message_to_edit=None, start=0, on_progress=None):
+    """
+    Embeds data in windows and upserts them into namespace. Returns the next batch number.
+    start skips windows stored by an earlier run (resumed ingestion jobs); on_progress(offset) is awaited as the stored prefix grows.
+    Pipelined: up to EMBED_CONCURRENCY batches are embedded at once (within the EMBED_TPM budget) while finished batches are upserted.
+    A batch that keeps failing goes to dead_letters after MAX_EMBED_ATTEMPTS instead of being retried forever; the other batches
+    are still stored, then IngestionIncomplete is raised with the number of windows dropped.
+    https://docs.pinecone.io/docs/gen-qa-openai to learn more about this function
+    """
     if type == "chatbot":
         secondary_listing = "role"
         data_str = ""
@@ -40,78 +181,131 @@ async def upsert_data(data, namespace, batch_number, window=1, stride=1, batch_s
     elif type == "lorebook":
         secondary_listing = "entry"
         data_str = ""
-    new_data = []
-    join_str = " "
-    for i in range(0, len(data), stride): # for each {role, content} in data (skip by stride amount)
-        await asyncio.sleep(0)
-        i_end = min(len(data), i+window) 
-        text_values = [item['content'] for item in data[i:i_end]]
-        stamp = f"{secondary_listing} {data[i]['location']})" if (type != "chatbot" and type != "lorebook") else ""
-        text = f"{stamp}{join_str.join(text_values)}{join_str}"
-        # create the new merged dataset
-        # join the text from the window together in one paragraph.
-        new_data.append({
-            'text': text,
-            'id': str(i + batch_number),
-        })
+    new_data = make_windows(data, batch_number, window, stride, type, secondary_listing)
     # at this point, new_data is a list of text windows. now, prepare to upsert in batches of text windows.
-    threshhold = 0
-    for i in range(0, len(new_data), batch_size):
-        
-        await asyncio.sleep(0.02)
-        percent = i / len(new_data) * 100
-        print(percent)
-        if message_to_edit and percent > threshhold:
-            await message_to_edit.edit(embed=discord.Embed(title=f"Processing {data_str}...",  description=f"{percent:.2f}% Processed\n\n(This may take a while for large data...)", color=discord.Colour.blue()))
-            threshhold += 20
-        # find end of batch
-        i_end = min(len(new_data), i+batch_size)
-        meta_batch = new_data[i:i_end]
-        # get ids
-        ids_batch = [x['id'] for x in meta_batch]
-        # get texts to encode
-        texts = [x['text'] for x in meta_batch]
-        try:
-            res = await asyncio.get_event_loop().run_in_executor(executor, create_embedding, texts,embed_model)
-        except Exception as e:
-            done = False
-            while not done:
-                await asyncio.sleep(5)
-                try:
-                    res = await asyncio.get_event_loop().run_in_executor(executor, create_embedding, texts,embed_model)
-                    done = True
-                except Exception as e:
-                    logger.error(f"Ratelimited: {e}")
-        embeds = [record['embedding'] for record in res['data']]
-        # cleanup metadatav
-        meta_batch = [{
-            'text': x['text'],
-        } for x in meta_batch]
-        to_upsert = list(zip(ids_batch, embeds, meta_batch))
-        # upsert to Pinecone
-        await asyncio.get_event_loop().run_in_executor(executor, upsert_vectors, to_upsert, namespace)
+    batches = iter([(i, new_data[i:i + batch_size]) for i in range(start, len(new_data), batch_size)])
+    ingestion_stats["ingestions"] += 1
+    progress = IngestionProgress(message_to_edit, data_str, len(new_data), start, on_progress)
+    embedded = asyncio.Queue(maxsize=EMBED_CONCURRENCY) # embedded batches waiting to be upserted
+    dropped = 0 # windows dead-lettered
+
+    async def embed_stage():
+        nonlocal dropped
+        for offset, batch in batches: # shared iterator, so the workers split the batches between them
+            texts = [x['text'] for x in batch]
+            try:
+                await reserve_tokens(estimate_tokens(texts))
+                embeds = await with_backoff(get_embeddings, texts)
+            except Exception as e:
+                dead_letter(namespace, batch, "embed", e)
+                dropped += len(batch)
+                await progress.advance(offset, len(batch))
+                continue
+            await embedded.put((offset, batch, embeds))
+
+    async def upsert_stage():
+        nonlocal dropped
+        while (item := await embedded.get()) is not None:
+            offset, batch, embeds = item
+            to_upsert = [(x['id'], embed, {'text': x['text']}) for x, embed in zip(batch, embeds)]
+            try:
+                await upsert_vectors(to_upsert, namespace) # the mutation queue retries on its own
+                ingestion_stats["vectors"] += len(to_upsert)
+            except Exception as e:
+                dead_letter(namespace, batch, "upsert", e)
+                dropped += len(batch)
+            ingestion_stats["batches"] += 1
+            await progress.advance(offset, len(batch))
+
+    upserter = asyncio.create_task(upsert_stage())
+    try:
+        await asyncio.gather(*(embed_stage() for _ in range(EMBED_CONCURRENCY)))
+        await embedded.put(None)
+        await upserter
+    finally:
+        upserter.cancel()
+    if dropped:
+        raise IngestionIncomplete(dropped, len(new_data) - start)
     return len(new_data) + batch_number + 1
     
-def search_pinecone(query, namespace):
+def query_namespace(embedding, namespace, top_k=TOP_K):
     try:
-        res = openai.Embedding.create(
-            input=[query],
-            engine=embed_model
-        )
-        
-        res = index.query(res['data'][0]['embedding'], top_k=3, include_metadata=True, namespace=namespace)
-        return [match['metadata']['text'] for match in res['matches']]
-
+        matches = vectorstore.get_store().query(namespace, embedding, top_k)
+        return [match['metadata']['text'] for match in matches]
     except Exception as e:
-        logger.error(f"search pinecone err: {e}")
+        logger.error(f"query namespace err ({namespace}): {e}")
         return []
 
+async def query_namespace_cached(embedding, key, namespace):
+    """query_namespace through the retrieval cache. key is the embedding's hash."""
+    cache = retrievalcache.get_cache()
+    results = cache.get(namespace, key, TOP_K)
+    if results is not None:
+        return results
+    version = cache.version(namespace)
+    tic = perf_counter()
+    results = await executors.run_io(query_namespace, embedding, namespace)
+    if results: # a failed query also returns [], so empty results aren't cached
+        cache.put(namespace, key, TOP_K, version, results, perf_counter() - tic)
+    return results
+
+async def retrieve(query, namespaces, deadline):
+    """
+    Embeds query once and queries every namespace with it at the same time, or takes the results from the retrieval cache.
+    Returns ({namespace: [texts]}, {stage: seconds}). Namespaces that didn't answer within deadline seconds (overall) are left out.
+    """
+    tic = perf_counter()
+    timings = {"embed": 0.0, "query": 0.0, "total": 0.0}
+    retrieval_stats["retrievals"] += 1
+    namespaces = [namespace for namespace in namespaces if not mutationqueue.get_queue().is_deleting(namespace)] # never read a namespace mid-delete
+    if not namespaces:
+        return {}, timings
+    try:
+        embedding = (await asyncio.wait_for(get_embeddings([query]), timeout=deadline))[0]
+    except asyncio.TimeoutError:
+        retrieval_stats["deadline_misses"] += len(namespaces)
+        logger.error(f"retrieval embedding missed the {deadline}s deadline")
+        return {}, timings
+    except Exception as e:
+        logger.error(f"retrieval embedding err: {e}")
+        return {}, timings
+    timings["embed"] = perf_counter() - tic
+    key = retrievalcache.embedding_hash(embedding)
+    # a query that misses the deadline keeps running and fills the cache for the next try (regenerate, continue)
+    tasks = {namespace: asyncio.ensure_future(query_namespace_cached(embedding, key, namespace)) for namespace in dict.fromkeys(namespaces)}
+    done, pending = await asyncio.wait(tasks.values(), timeout=max(0.0, deadline - timings["embed"]))
+    results = {namespace: task.result() for namespace, task in tasks.items() if task in done}
+    if pending:
+        retrieval_stats["deadline_misses"] += len(pending)
+        logger.error(f"retrieval deadline ({deadline}s) missed for {[namespace for namespace, task in tasks.items() if task in pending]}")
+    timings["total"] = perf_counter() - tic
+    timings["query"] = timings["total"] - timings["embed"]
+    retrieval_stats["namespace_queries"] += len(tasks)
+    retrieval_stats["embed_time"] += timings["embed"]
+    retrieval_stats["query_time"] += timings["query"]
+    return results, timings
+
+def get_ingestion_stats():
+    return {**ingestion_stats, "budget_left": int(embed_budget.tokens)}
+
+def get_embed_batcher_stats():
+    return embed_batcher.get_stats()
+
+def get_retrieval_stats():
+    retrievals = retrieval_stats["retrievals"]
+    return {
+        **retrieval_stats,
+        "avg_embed_time": retrieval_stats["embed_time"] / retrievals if retrievals else 0,
+        "avg_query_time": retrieval_stats["query_time"] / retrievals if retrievals else 0,
+    }
+
 async def delete_namespace(namespace):
-    index.delete(deleteAll='true', namespace=namespace)
+    """Queues the delete and returns right away. Retrieval skips the namespace until it's done."""
+    await mutationqueue.get_queue().delete(namespace)
     
 
 def delete_namespace_nonasync(namespace):
-    index.delete(deleteAll='true', namespace=namespace)
+    vectorstore.get_store().delete_namespace(namespace)
 
 if __name__ == "__main__":
     while True:
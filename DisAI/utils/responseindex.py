@@ -0,0 +1,47 @@
+import time
+from collections import OrderedDict
+
+from utils import services
+
+"""Index of the reply messages Dis.AI has sent: message id -> (platform id, chatbot).
+on_raw_reaction_add fires for every reaction in every guild; this lets it drop reactions on unrelated messages without any REST calls."""
+
+# Constants
+MAX_ENTRIES = 50000
+MAX_AGE = 6 * 3600 # seconds. older replies are forgotten even if there's room
+
+
+class ResponseIndex:
+    """Bounded LRU + time window map. Lookups refresh an entry's LRU position but not its age."""
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_age: float = MAX_AGE):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._entries = OrderedDict() # message id -> (added at, platform id, chatbot)
+        self.rejected = 0 # raw reaction events dropped without touching Discord
+
+    def add(self, message_id: int, platform_id: int, chatbot):
+        self._entries[message_id] = (time.monotonic(), platform_id, chatbot)
+        self._entries.move_to_end(message_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, message_id: int):
+        """Returns (platform id, chatbot) or None."""
+        entry = self._entries.get(message_id)
+        if entry is None:
+            return None
+        added_at, platform_id, chatbot = entry
+        if time.monotonic() - added_at > self.max_age:
+            del self._entries[message_id]
+            return None
+        self._entries.move_to_end(message_id)
+        return platform_id, chatbot
+
+    def discard(self, message_id: int):
+        self._entries.pop(message_id, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+get_index = services.accessor("response_index", ResponseIndex)
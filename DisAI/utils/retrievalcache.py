@@ -0,0 +1,77 @@
+import hashlib
+import logging
+import time
+from array import array
+from collections import OrderedDict
+
+from utils import services
+
+"""Short-lived cache of namespace query results, keyed by (namespace, sha256 of the query embedding, top_k). Regenerate, continue and
+chatbots sharing a lorebook search the same namespace with the same query; they get the results without a vector store round trip.
+Every namespace has a version, bumped whenever its vectors change, and an entry only counts for the version it was queried at."""
+
+# Constants
+TTL = 120 # seconds an entry is served
+MAX_ENTRIES = 2000
+
+logger = logging.getLogger(__name__)
+
+
+def embedding_hash(embedding: list) -> str:
+    return hashlib.sha256(array('f', embedding).tobytes()).hexdigest()
+
+
+class RetrievalCache:
+    """
+    version(namespace) is read before a query and passed to put, so a query that was running while the namespace changed is stored
+    under the old version and never served. bump(namespace) drops the namespace's entries too, so stale ones don't wait out the TTL.
+    """
+    def __init__(self, ttl: float = TTL, max_entries: int = MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # (namespace, embedding hash, top_k) -> (version, expires, results, query seconds)
+        self._keys = {} # namespace -> set of its keys in _entries
+        self._versions = {}
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "saved_time": 0.0}
+
+    def version(self, namespace: str) -> int:
+        return self._versions.get(namespace, 0)
+
+    def bump(self, namespace: str):
+        """The namespace's vectors changed (upsert applied, or delete queued)."""
+        self._versions[namespace] = self.version(namespace) + 1
+        for key in self._keys.pop(namespace, ()):
+            self._entries.pop(key, None)
+        self.stats["invalidations"] += 1
+
+    def get(self, namespace: str, key: str, top_k: int):
+        """Cached results, or None."""
+        entry = self._entries.get((namespace, key, top_k))
+        if entry is None or entry[0] != self.version(namespace) or entry[1] < time.monotonic():
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end((namespace, key, top_k))
+        self.stats["hits"] += 1
+        self.stats["saved_time"] += entry[3]
+        return entry[2]
+
+    def put(self, namespace: str, key: str, top_k: int, version: int, results: list, query_time: float):
+        if version != self.version(namespace): # changed while the query ran
+            return
+        self._entries[(namespace, key, top_k)] = (version, time.monotonic() + self.ttl, results, query_time)
+        self._entries.move_to_end((namespace, key, top_k))
+        self._keys.setdefault(namespace, set()).add((namespace, key, top_k))
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            keys = self._keys.get(old_key[0])
+            if keys is not None:
+                keys.discard(old_key)
+                if not keys:
+                    del self._keys[old_key[0]]
+
+    def get_stats(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {**self.stats, "hit_rate": self.stats["hits"] / lookups if lookups else 0, "entries": len(self._entries)}
+
+
+get_cache = services.accessor("retrieval_cache", RetrievalCache)
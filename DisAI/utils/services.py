@@ -0,0 +1,21 @@
+"""Services owned by the bot (shared pools, caches, queues...). DisAI.__init__ creates and registers each one;
+module-level helpers reach them through the get_x functions made with accessor. Outside the bot (a script, a test) nothing is
+registered, so the first get_x call builds a default instance instead."""
+
+_services = {}
+
+
+def register(name: str, service):
+    """Register the bot's service under name. Returns it, so it can be assigned in the same line."""
+    _services[name] = service
+    return service
+
+def accessor(name: str, default):
+    """A get_x function returning the service registered under name, or one made by default() on first use."""
+    def get():
+        service = _services.get(name)
+        if service is None:
+            service = _services[name] = default()
+        return service
+    get.__name__ = f"get_{name}"
+    return get
@@ -0,0 +1,301 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from utils import services
+
+"""Vector store interface for long term memory, data and lorebooks, with a hosted (Pinecone) and a local (memory-mapped NumPy) backend.
+All methods are blocking; pineconehandler runs them in the I/O pool. Pick the backend with the VECTOR_STORE env var."""
+
+# Constants
+BACKEND = os.getenv("VECTOR_STORE", "pinecone") # pinecone / local / tiered
+PINECONE_INDEX = "disai"
+LOCAL_PATH = os.getenv("VECTOR_STORE_PATH", "vectors")
+LOCAL_MAX_VECTORS = 5000 # tiered: namespaces bigger than this move to Pinecone
+MIN_CAPACITY = 64 # rows allocated for a new local namespace. the file doubles when it fills up
+MIGRATE_BATCH = 100
+
+logger = logging.getLogger(__name__)
+
+
+class VectorStore(ABC):
+    """
+    Vectors are (id, values, metadata) tuples, same as Pinecone's upsert.
+    query returns [{"id", "score", "metadata"}], best match first.
+    """
+    name = "base"
+
+    @abstractmethod
+    def upsert(self, namespace: str, vectors: list):
+        ...
+
+    @abstractmethod
+    def query(self, namespace: str, vector: list, top_k: int) -> list:
+        ...
+
+    @abstractmethod
+    def delete_namespace(self, namespace: str):
+        ...
+
+    @abstractmethod
+    def namespace_stats(self, namespace: str) -> dict:
+        """{"vector_count": int}. 0 for a namespace that doesn't exist."""
+
+    def close(self):
+        pass
+
+
+class PineconeStore(VectorStore):
+    """The hosted index. Connects on first use, not on import."""
+    name = "pinecone"
+
+    def __init__(self, index_name: str = PINECONE_INDEX):
+        self.index_name = index_name
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        with self._lock:
+            if self._index is None:
+                import pinecone
+                from config import PINECONE_API_KEY, PINECONE_ENV
+                pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENV)
+                self._index = pinecone.Index(self.index_name)
+            return self._index
+
+    def upsert(self, namespace: str, vectors: list):
+        self.index.upsert(vectors=vectors, namespace=namespace)
+
+    def query(self, namespace: str, vector: list, top_k: int) -> list:
+        res = self.index.query(vector, top_k=top_k, include_metadata=True, namespace=namespace)
+        return [{"id": match['id'], "score": match['score'], "metadata": match['metadata']} for match in res['matches']]
+
+    def delete_namespace(self, namespace: str):
+        self.index.delete(deleteAll='true', namespace=namespace)
+
+    def namespace_stats(self, namespace: str) -> dict:
+        namespaces = self.index.describe_index_stats()['namespaces']
+        return {"vector_count": namespaces[namespace]['vector_count'] if namespace in namespaces else 0}
+
+
+class LocalNamespace:
+    """
+    One namespace on disk: vectors.f32 is a (capacity, dimension) float32 matrix of unit vectors, memory-mapped;
+    meta.json has the ids and metadata of the first len(ids) rows.
+    """
+    def __init__(self, path: str, namespace: str):
+        self.path = path
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.ids = []
+        self.metadata = []
+        self.dimension = None
+        self.matrix = None
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.ids = meta['ids']
+            self.metadata = meta['metadata']
+            self.dimension = meta['dimension']
+            self.matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r+").reshape(-1, self.dimension)
+        self.rows = {vector_id: row for row, vector_id in enumerate(self.ids)}
+
+    @property
+    def _vectors_path(self):
+        return os.path.join(self.path, "vectors.f32")
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def _reserve(self, rows: int):
+        capacity = 0 if self.matrix is None else self.matrix.shape[0]
+        if rows <= capacity:
+            return
+        capacity = max(rows, capacity * 2, MIN_CAPACITY)
+        self.matrix = None # drop the old mapping before resizing the file
+        os.makedirs(self.path, exist_ok=True)
+        with open(self._vectors_path, "ab") as f:
+            f.truncate(capacity * self.dimension * 4)
+        self.matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dimension))
+
+    def upsert(self, vectors: list):
+        with self.lock:
+            values = np.asarray([v[1] for v in vectors], dtype=np.float32)
+            if self.dimension is None:
+                self.dimension = values.shape[1]
+            norms = np.linalg.norm(values, axis=1, keepdims=True)
+            values /= np.where(norms == 0, 1, norms) # store unit vectors, so cosine similarity is a dot product
+            new_ids = [vector_id for vector_id in dict.fromkeys(v[0] for v in vectors) if vector_id not in self.rows]
+            self._reserve(self.count + len(new_ids))
+            for vector_id in new_ids:
+                self.rows[vector_id] = len(self.ids)
+                self.ids.append(vector_id)
+                self.metadata.append(None)
+            for (vector_id, _, metadata), vector in zip(vectors, values):
+                row = self.rows[vector_id]
+                self.matrix[row] = vector
+                self.metadata[row] = metadata
+            self.matrix.flush()
+            meta_path = os.path.join(self.path, "meta.json")
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"namespace": self.namespace, "dimension": self.dimension, "ids": self.ids, "metadata": self.metadata}, f)
+            os.replace(meta_path + ".tmp", meta_path)
+
+    def query(self, vector: list, top_k: int) -> list:
+        with self.lock:
+            if not self.count or top_k <= 0:
+                return []
+            query = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(query)
+            if norm:
+                query /= norm
+            scores = self.matrix[:self.count] @ query
+            k = min(top_k, self.count)
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [{"id": self.ids[row], "score": float(scores[row]), "metadata": self.metadata[row]} for row in best]
+
+    def export(self) -> list:
+        """Every vector as an (id, values, metadata) tuple."""
+        with self.lock:
+            return [(vector_id, self.matrix[row].tolist(), self.metadata[row]) for row, vector_id in enumerate(self.ids)]
+
+
+class LocalStore(VectorStore):
+    """In-process backend. Each namespace is a memory-mapped matrix under LOCAL_PATH, queried with one matrix-vector product."""
+    name = "local"
+
+    def __init__(self, path: str = LOCAL_PATH):
+        self.path = path
+        self._namespaces = {}
+        self._lock = threading.Lock()
+
+    def _namespace_path(self, namespace: str) -> str:
+        # namespaces contain chatbot names, so they can't be used as folder names directly
+        return os.path.join(self.path, hashlib.sha1(namespace.encode("utf-8")).hexdigest())
+
+    def _get(self, namespace: str, create: bool = False):
+        with self._lock:
+            local = self._namespaces.get(namespace)
+            if local is None:
+                path = self._namespace_path(namespace)
+                if not create and not os.path.exists(path):
+                    return None
+                local = self._namespaces[namespace] = LocalNamespace(path, namespace)
+            return local
+
+    def has_namespace(self, namespace: str) -> bool:
+        local = self._get(namespace)
+        return local is not None and local.count > 0
+
+    def upsert(self, namespace: str, vectors: list):
+        if vectors:
+            self._get(namespace, create=True).upsert(vectors)
+
+    def query(self, namespace: str, vector: list, top_k: int) -> list:
+        local = self._get(namespace)
+        return local.query(vector, top_k) if local else []
+
+    def export(self, namespace: str) -> list:
+        local = self._get(namespace)
+        return local.export() if local else []
+
+    def delete_namespace(self, namespace: str):
+        with self._lock:
+            local = self._namespaces.pop(namespace, None)
+            path = self._namespace_path(namespace)
+            if local:
+                with local.lock:
+                    local.matrix = None
+                    shutil.rmtree(path, ignore_errors=True)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def namespace_stats(self, namespace: str) -> dict:
+        local = self._get(namespace)
+        return {"vector_count": local.count if local else 0}
+
+    def close(self):
+        with self._lock:
+            for local in self._namespaces.values():
+                if local.matrix is not None:
+                    local.matrix.flush()
+
+
+class TieredStore(VectorStore):
+    """
+    New namespaces start in the local store and move to Pinecone once they pass local_max vectors. Namespaces that already
+    have vectors in Pinecone stay there. So small servers' memories are answered in-process, without a network hop.
+    """
+    name = "tiered"
+
+    def __init__(self, local: LocalStore, remote: VectorStore, local_max: int = LOCAL_MAX_VECTORS):
+        self.local = local
+        self.remote = remote
+        self.local_max = local_max
+        self._remote_namespaces = {} # namespace -> lives in remote (cached, so routing only costs a stats call once)
+        self._lock = threading.Lock()
+
+    def _is_remote(self, namespace: str) -> bool:
+        with self._lock:
+            if namespace in self._remote_namespaces:
+                return self._remote_namespaces[namespace]
+        remote = not self.local.has_namespace(namespace) and self.remote.namespace_stats(namespace)['vector_count'] > 0
+        with self._lock:
+            self._remote_namespaces[namespace] = remote
+        return remote
+
+    def upsert(self, namespace: str, vectors: list):
+        if self._is_remote(namespace):
+            self.remote.upsert(namespace, vectors)
+            return
+        self.local.upsert(namespace, vectors)
+        if self.local.namespace_stats(namespace)['vector_count'] > self.local_max:
+            self._migrate(namespace)
+
+    def _migrate(self, namespace: str):
+        vectors = self.local.export(namespace)
+        for start in range(0, len(vectors), MIGRATE_BATCH):
+            self.remote.upsert(namespace, vectors[start:start + MIGRATE_BATCH])
+        with self._lock:
+            self._remote_namespaces[namespace] = True
+        self.local.delete_namespace(namespace)
+        logger.info(f"moved namespace {namespace} ({len(vectors)} vectors) to {self.remote.name}")
+
+    def query(self, namespace: str, vector: list, top_k: int) -> list:
+        store = self.remote if self._is_remote(namespace) else self.local
+        return store.query(namespace, vector, top_k)
+
+    def delete_namespace(self, namespace: str):
+        self.local.delete_namespace(namespace)
+        self.remote.delete_namespace(namespace)
+        with self._lock:
+            self._remote_namespaces.pop(namespace, None)
+
+    def namespace_stats(self, namespace: str) -> dict:
+        store = self.remote if self._is_remote(namespace) else self.local
+        return store.namespace_stats(namespace)
+
+    def close(self):
+        self.local.close()
+        self.remote.close()
+
+
+def make_store(backend: str = BACKEND) -> VectorStore:
+    if backend == "local":
+        return LocalStore()
+    if backend == "tiered":
+        return TieredStore(LocalStore(), PineconeStore())
+    return PineconeStore()
+
+
+get_store = services.accessor("vector_store", make_store)
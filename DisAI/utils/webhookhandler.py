@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+
+import discord
+
+from utils import services
+
+"""Per-channel cache of the Dis.AI webhook. Replies and reaction handling used to list a channel's webhooks on every event;
+now that happens once per channel until the webhook changes."""
+
+# Constants
+WEBHOOK_NAME = "Dis.AI Webhook"
+UNKNOWN_WEBHOOK = 10015 # Discord error code when a webhook was deleted under us
+OWN_UPDATE_WINDOW = 10 # seconds after we create a webhook during which the channel's update event is taken to be ours
+_NO_WEBHOOK = object() # cached "this channel has no Dis.AI webhook" (only when create=False)
+
+logger = logging.getLogger(__name__)
+
+
+def resolve_channel(channel):
+    """Webhooks belong to the parent channel of a thread."""
+    return channel.parent if isinstance(channel, discord.Thread) else channel
+
+def is_unknown_webhook(error: Exception) -> bool:
+    return isinstance(error, discord.NotFound) and getattr(error, "code", None) == UNKNOWN_WEBHOOK
+
+
+class WebhookRegistry:
+    """
+    Maps channel id -> Dis.AI webhook.
+    Lookups/creation for a channel are single-flight, so concurrent replies never create duplicate webhooks.
+    """
+    def __init__(self):
+        self._webhooks = {}
+        self._locks = {} # channel id -> [lock, lookups using it], only while a lookup runs
+        self._created_at = {} # channel id -> when we created its webhook, until its update event comes in
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.invalidations = 0
+
+    async def get(self, channel, create: bool = True):
+        """Returns the Dis.AI webhook for the channel (or the thread's parent). If create=False and there is none, returns None."""
+        channel = resolve_channel(channel)
+        webhook = self._webhooks.get(channel.id)
+        if webhook is not None and (webhook is not _NO_WEBHOOK or not create):
+            self.hits += 1
+            return None if webhook is _NO_WEBHOOK else webhook
+        entry = self._locks.setdefault(channel.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                webhook = self._webhooks.get(channel.id) # someone else may have fetched it while we waited
+                if webhook is not None and (webhook is not _NO_WEBHOOK or not create):
+                    self.hits += 1
+                    return None if webhook is _NO_WEBHOOK else webhook
+                self.misses += 1
+                webhooks = await channel.webhooks()
+                for candidate in webhooks:
+                    if candidate.name == WEBHOOK_NAME:
+                        webhook = candidate
+                        break
+                else:
+                    if create:
+                        webhook = await channel.create_webhook(name=WEBHOOK_NAME)
+                        self._created_at[channel.id] = time.monotonic()
+                        self.created += 1
+                        logger.info(f"Created webhook in channel {channel.id}")
+                    else:
+                        webhook = _NO_WEBHOOK
+                self._webhooks[channel.id] = webhook
+        finally:
+            entry[1] -= 1
+            if not entry[1]: # nobody else is waiting on this channel's lock
+                del self._locks[channel.id]
+        return None if webhook is _NO_WEBHOOK else webhook
+
+    def webhooks_updated(self, channel_id: int):
+        """A webhooks update event. The one our own create_webhook causes is skipped, so the webhook we just cached stays."""
+        created_at = self._created_at.pop(channel_id, None)
+        if created_at is not None and time.monotonic() - created_at < OWN_UPDATE_WINDOW:
+            return
+        self.invalidate(channel_id)
+
+    def invalidate(self, channel_id: int):
+        """Forget the cached webhook, e.g. after an Unknown Webhook error or a webhooks update event."""
+        if self._webhooks.pop(channel_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self._webhooks),
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "invalidations": self.invalidations,
+        }
+
+
+get_registry = services.accessor("webhook_registry", WebhookRegistry)